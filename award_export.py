@@ -0,0 +1,125 @@
+import re
+import time
+import zipfile
+
+
+class _ChunkBuffer:
+    """Файловый объект без seek/tell: zipfile пишет в него, а мы забираем накопленное кусками."""
+
+    def __init__(self) -> None:
+        self._chunks: list[bytes] = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def take(self) -> bytes:
+        data, self._chunks = b"".join(self._chunks), []
+        return data
+
+
+def safe_filename(text: str, default: str = "file") -> str:
+    """Имя файла из ФИО/названия: буквы (в т.ч. кириллица), цифры, «-» и «_»."""
+    name = re.sub(r"[^\w\-]+", "_", str(text or ""), flags=re.UNICODE).strip("_")
+    return name[:80] or default
+
+
+class ZipStreamWriter:
+    """ZIP-архив, который отдаётся по частям: add() и finish() возвращают готовые байты.
+
+    Поток не перематывается (размеры пишутся в data descriptor после файла),
+    поэтому в памяти одновременно только текущий файл. Файлы кладутся без сжатия:
+    PNG/JPEG и так сжаты.
+    """
+
+    def __init__(self) -> None:
+        self._buf = _ChunkBuffer()
+        self._zip = zipfile.ZipFile(self._buf, "w", compression=zipfile.ZIP_STORED)
+
+    def start(self) -> bytes:
+        return b""
+
+    def add(self, name: str, data: bytes) -> bytes:
+        info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+        info.compress_type = zipfile.ZIP_STORED
+        self._zip.writestr(info, data)
+        return self._buf.take()
+
+    def finish(self) -> bytes:
+        self._zip.close()
+        return self._buf.take()
+
+
+class PdfStreamWriter:
+    """Многостраничный PDF из JPEG-страниц, который отдаётся по частям.
+
+    Каждая страница — картинка (DCTDecode, JPEG вставляется как есть) размером с шаблон
+    при dpi точек на дюйм. Объекты пишутся сразу, от них остаются только смещения
+    для таблицы xref; дерево страниц и каталог дописываются в finish().
+    """
+
+    def __init__(self, dpi: float = 150.0) -> None:
+        self.dpi = float(dpi)
+        self._pos = 0
+        self._offsets: dict[int, int] = {}
+        self._page_ids: list[int] = []
+        # 1 — каталог, 2 — дерево страниц (пишутся в конце).
+        self._next_id = 3
+
+    def _emit(self, data: bytes) -> bytes:
+        self._pos += len(data)
+        return data
+
+    def _obj(self, num: int, body: bytes) -> bytes:
+        self._offsets[num] = self._pos
+        return self._emit(b"%d 0 obj\n" % num + body + b"\nendobj\n")
+
+    def _stream(self, num: int, header: bytes, data: bytes) -> bytes:
+        return self._obj(num, b"<< " + header + b" /Length %d >>\nstream\n" % len(data) + data + b"\nendstream")
+
+    def start(self) -> bytes:
+        return self._emit(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def add(self, jpeg: bytes, width_px: int, height_px: int) -> bytes:
+        image_id, content_id, page_id = self._next_id, self._next_id + 1, self._next_id + 2
+        self._next_id += 3
+        w_pt = width_px * 72.0 / self.dpi
+        h_pt = height_px * 72.0 / self.dpi
+
+        out = [
+            self._stream(
+                image_id,
+                b"/Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace /DeviceRGB"
+                b" /BitsPerComponent 8 /Filter /DCTDecode" % (width_px, height_px),
+                jpeg,
+            ),
+            self._stream(content_id, b"", b"q %.2f 0 0 %.2f 0 0 cm /Im0 Do Q" % (w_pt, h_pt)),
+            self._obj(
+                page_id,
+                b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.2f %.2f]"
+                b" /Resources << /XObject << /Im0 %d 0 R >> >> /Contents %d 0 R >>"
+                % (w_pt, h_pt, image_id, content_id),
+            ),
+        ]
+        self._page_ids.append(page_id)
+        return b"".join(out)
+
+    def finish(self) -> bytes:
+        kids = b" ".join(b"%d 0 R" % pid for pid in self._page_ids)
+        out = [
+            self._obj(2, b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(self._page_ids))),
+            self._obj(1, b"<< /Type /Catalog /Pages 2 0 R >>"),
+        ]
+        xref_pos = self._pos
+        size = self._next_id
+        xref = [b"xref\n0 %d\n" % size, b"0000000000 65535 f \n"]
+        for num in range(1, size):
+            offset = self._offsets.get(num)
+            # Номера без объекта (не бывает при штатной работе) помечаем свободными.
+            xref.append(b"%010d 00000 n \n" % offset if offset is not None else b"0000000000 65535 f \n")
+        out.append(self._emit(b"".join(xref)))
+        out.append(self._emit(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (size, xref_pos)))
+        return b"".join(out)
@@ -0,0 +1,144 @@
+import asyncio
+import itertools
+import logging
+import time
+
+
+class RateLimiter:
+    """Простой ограничитель частоты: не больше rate запусков в секунду (равномерно)."""
+
+    def __init__(self, rate: float) -> None:
+        self.interval = 1.0 / rate if rate and rate > 0 else 0.0
+        self._next_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        if self.interval <= 0:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            wait = self._next_at - now
+            if wait > 0:
+                await asyncio.sleep(wait)
+                now = time.monotonic()
+            self._next_at = max(now, self._next_at) + self.interval
+
+
+class AwardJob:
+    """Массовая выдача сертификатов: список получателей и прогресс по каждому.
+
+    recipients — список (telegram_id, full_name, score). Прогресс хранится по telegram_id,
+    поэтому остановленную задачу можно продолжить (resume): повторно обрабатываются
+    только не отправленные и завершившиеся ошибкой получатели.
+    """
+
+    def __init__(self, job_id: str, params: dict, recipients: list, admin_id: int) -> None:
+        self.id = job_id
+        self.params = dict(params)
+        self.recipients = list(recipients)
+        self.admin_id = admin_id
+        self.created_at = time.time()
+        self.finished_at: float | None = None
+        self.status = "pending"  # pending | running | done | cancelled
+        self.sent: set[int] = set()
+        self.failed: dict[int, str] = {}
+        self.task: asyncio.Task | None = None
+
+    def remaining(self) -> list:
+        return [r for r in self.recipients if r[0] not in self.sent]
+
+    def progress(self) -> dict:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "total": len(self.recipients),
+            "sent": len(self.sent),
+            "failed": len(self.failed),
+            "pending": len(self.recipients) - len(self.sent) - len(self.failed),
+            "errors": [
+                {"telegram_id": tg_id, "error": err}
+                for tg_id, err in list(self.failed.items())[:50]
+            ],
+            "params": self.params,
+            "created_at": int(self.created_at),
+            "finished_at": int(self.finished_at) if self.finished_at else None,
+        }
+
+
+class AwardJobManager:
+    """Запуск и учёт задач массовой выдачи (в памяти процесса).
+
+    process(job, recipient) — корутина, которая рендерит и отправляет один сертификат.
+    concurrency ограничивает число одновременно обрабатываемых получателей;
+    частоту запросов к платформам ограничивает сам process (см. RateLimiter).
+    """
+
+    def __init__(self, concurrency: int, keep: int = 20) -> None:
+        self.concurrency = max(1, int(concurrency))
+        self.keep = max(1, int(keep))
+        self._jobs: dict[str, AwardJob] = {}
+        self._ids = itertools.count(1)
+
+    def create(self, params: dict, recipients: list, admin_id: int) -> AwardJob:
+        job_id = f"{int(time.time())}-{next(self._ids)}"
+        job = AwardJob(job_id, params, recipients, admin_id)
+        self._jobs[job_id] = job
+        # Храним только последние keep задач, незавершённые не трогаем.
+        finished = [j for j in self._jobs.values() if j.status in {"done", "cancelled"}]
+        for old in finished[: max(0, len(self._jobs) - self.keep)]:
+            self._jobs.pop(old.id, None)
+        return job
+
+    def get(self, job_id: str) -> AwardJob | None:
+        return self._jobs.get(str(job_id))
+
+    def recent(self) -> list[AwardJob]:
+        return sorted(self._jobs.values(), key=lambda j: j.created_at, reverse=True)
+
+    def start(self, job: AwardJob, process, on_finish=None) -> None:
+        if job.task is not None and not job.task.done():
+            return
+        # При повторном запуске ошибки прошлых попыток снимаем — эти получатели пойдут заново.
+        job.failed = {}
+        job.status = "running"
+        job.finished_at = None
+        job.task = asyncio.create_task(self._run(job, process, on_finish))
+
+    def cancel(self, job: AwardJob) -> None:
+        if job.task is not None and not job.task.done():
+            job.task.cancel()
+
+    async def shutdown(self) -> None:
+        """Останавливает все идущие задачи и дожидается их завершения (при остановке сервера)."""
+        tasks = [j.task for j in self._jobs.values() if j.task is not None and not j.task.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self, job: AwardJob, process, on_finish) -> None:
+        sem = asyncio.Semaphore(self.concurrency)
+
+        async def _one(recipient) -> None:
+            tg_id = int(recipient[0])
+            async with sem:
+                try:
+                    await process(job, recipient)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    job.failed[tg_id] = str(e)[:300]
+                else:
+                    job.sent.add(tg_id)
+
+        try:
+            await asyncio.gather(*(_one(r) for r in job.remaining()))
+            job.status = "done"
+        except asyncio.CancelledError:
+            job.status = "cancelled"
+        finally:
+            job.finished_at = time.time()
+            if on_finish is not None:
+                try:
+                    await on_finish(job)
+                except Exception:
+                    logging.getLogger(__name__).exception("Award job %s on_finish failed", job.id)
@@ -2,8 +2,11 @@ import asyncio
 import os
 import logging
 from aiogram import Bot, Dispatcher
+from aiogram.fsm.storage.memory import MemoryStorage
 from dotenv import load_dotenv
-from database.db import create_table, close_db
+from database import db
+from database.db import create_table, close_db, close_score_buffer
+from fsm_storage import DbFSMStorage
 
 from web_server import run_web_server
 
@@ -12,6 +15,22 @@ from handlers import user_reg
 
 TOKEN = os.getenv("BOT_TOKEN")
 MAX_TOKEN = os.getenv("MAX_BOT_TOKEN")
+# Если задан — Telegram работает через webhook на web-сервере (см. create_app), а не polling.
+TG_WEBHOOK_URL = (os.getenv("TG_WEBHOOK_URL") or "").strip()
+
+
+def _create_fsm_storage():
+    """FSM-хранилище Telegram-бота: TG_FSM_STORAGE=db (по умолчанию, общее для процессов) или memory."""
+    if (os.getenv("TG_FSM_STORAGE") or "db").strip().lower() == "memory":
+        return MemoryStorage()
+    return DbFSMStorage(
+        db,
+        ttl=float(os.getenv("TG_FSM_TTL", str(24 * 3600))),
+        flush_interval=float(os.getenv("TG_FSM_FLUSH_MS", "500")) / 1000.0,
+        flush_max=int(os.getenv("TG_FSM_FLUSH_MAX", "100")),
+        cache_ttl=float(os.getenv("TG_FSM_CACHE_TTL", "5")),
+    )
+
 
 async def main():
     logging.basicConfig(level=logging.INFO)
@@ -22,26 +41,41 @@ async def main():
     bot = None
     dp = None
     if TOKEN:
-        bot = Bot(token=TOKEN)
-        dp = Dispatcher()
+        dp = Dispatcher(storage=_create_fsm_storage())
         dp.include_router(user_reg.router)
+        # В режиме webhook update обрабатывает web-сервер общим Bot из app["bot"].
+        if not TG_WEBHOOK_URL:
+            bot = Bot(token=TOKEN)
 
     # Поднимаем мини-веб-приложение (игра + админ-панель) вместе с polling.
     # Внешний URL нужно прокинуть в .env (WEBAPP_URL), а порт - WEB_PORT/PORT.
-    web_task = asyncio.create_task(run_web_server())
+    web_task = asyncio.create_task(run_web_server(dp if TG_WEBHOOK_URL else None))
 
     print("Сервис запущен...")
     try:
         # Если Telegram включён — работаем как раньше (polling).
         # MAX работает через webhook внутри web_server.py (если задан MAX_BOT_TOKEN).
         if dp and bot:
+            # Если раньше был включён webhook — снимаем его, иначе getUpdates не работает.
+            try:
+                await bot.delete_webhook()
+            except Exception:
+                logging.exception("Не удалось снять Telegram webhook")
             await dp.start_polling(bot)
         else:
-            # Только web_server (webapp + MAX webhook)
+            # Только web_server (webapp + MAX webhook + Telegram webhook, если включён)
             while True:
                 await asyncio.sleep(3600)
     finally:
         web_task.cancel()
+        # Незаписанные шаги FSM (пачка DbFSMStorage) — в БД до закрытия соединения.
+        if dp is not None:
+            await dp.storage.close()
+        # Дописываем в БД очки из write-behind буфера (SCORE_FLUSH_INTERVAL), пока соединение живо.
+        try:
+            await close_score_buffer()
+        except Exception:
+            logging.exception("Не удалось записать буфер очков при остановке")
         # Закрываем shared-соединение с SQLite
         await close_db()
 
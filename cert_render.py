@@ -0,0 +1,687 @@
+import asyncio
+import functools
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import string
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict
+from io import BytesIO
+from typing import NamedTuple
+
+from PIL import Image, ImageDraw, ImageFont
+
+from env_utils import env_int
+
+
+WEBAPP_DIR = os.path.join(os.path.dirname(__file__), "webapp")
+
+# Шаблоны грамот/дипломов (вариант A: PNG + наложение текста)
+CERT_TEMPLATES_DIR = os.path.join(WEBAPP_DIR, "assets", "cert_templates")
+
+
+def _resolve_font_paths(font_key: str):
+    """Возвращает (regular_path, bold_path) с безопасным фолбэком.
+
+    В админке доступен выбор нескольких шрифтов. Здесь оставляем только те,
+    которые гарантированно умеют кириллицу и часто присутствуют в Linux-окружении.
+    Если конкретного шрифта нет в системе — используем DejaVu Sans как фолбэк.
+    """
+
+    base = "/usr/share/fonts/truetype"
+
+    # В проекте оставляем только DejaVu Sans / DejaVu Serif.
+    # Все остальные ключи безопасно фолбэкаются в DejaVu Sans.
+    font_map = {
+        "dejavu_sans": (
+            f"{base}/dejavu/DejaVuSans.ttf",
+            f"{base}/dejavu/DejaVuSans-Bold.ttf",
+        ),
+        "dejavu_serif": (
+            f"{base}/dejavu/DejaVuSerif.ttf",
+            f"{base}/dejavu/DejaVuSerif-Bold.ttf",
+        ),
+        # Совместимость со старым ключом
+        "sans": (
+            f"{base}/dejavu/DejaVuSans.ttf",
+            f"{base}/dejavu/DejaVuSans-Bold.ttf",
+        ),
+        "serif": (
+            f"{base}/dejavu/DejaVuSerif.ttf",
+            f"{base}/dejavu/DejaVuSerif-Bold.ttf",
+        ),
+    }
+
+    key = str(font_key or "dejavu_sans").lower()
+    regular, bold = font_map.get(key, font_map["dejavu_sans"])
+
+    # если bold отсутствует — используем regular
+    if not os.path.exists(regular):
+        regular, bold = font_map["dejavu_sans"]
+    if not os.path.exists(bold):
+        bold = regular
+
+    return (regular, bold)
+
+
+@functools.lru_cache(maxsize=128)
+def _load_font(font_path: str, size: int) -> ImageFont.FreeTypeFont:
+    """Шрифт нужного размера. Разбор TTF дорогой, а размеров на шаблон — единицы."""
+    return ImageFont.truetype(font_path, size)
+
+
+def _fit_font(text: str, font_path: str, max_width: int, start_size: int, min_size: int = 18):
+    """Самый крупный шрифт в [min_size, start_size], при котором text влезает в max_width.
+
+    Ширина строки монотонно растёт с размером шрифта, поэтому размер ищем бинарным поиском
+    по дешёвому font.getlength (без растеризации).
+    """
+    lo, hi = min_size, start_size
+    best = min_size
+    while lo <= hi:
+        mid = (lo + hi) // 2
+        if _load_font(font_path, mid).getlength(text) <= max_width:
+            best = mid
+            lo = mid + 1
+        else:
+            hi = mid - 1
+    return _load_font(font_path, best)
+
+
+# -------------------------
+# Реестр шаблонов
+# -------------------------
+#
+# Каждый шаблон — картинка и JSON-описание рядом с ней в CERT_TEMPLATES_DIR, например sertificat.json:
+#
+#   {
+#     "key": "participation",              ключ для админки и API
+#     "title": "Сертификат за участие",    название в админке и первая строка подписи
+#     "image": "sertificat.webp",          файл шаблона (относительно CERT_TEMPLATES_DIR)
+#     "output": {"format": "png"},         необязательно: format / quality / compress_level
+#     "fields": [                          текстовые блоки, рисуются по порядку
+#       {"text": "{full_name}", "font": "bold", "x": 0.5, "anchor": "ma",
+#        "max_width": 0.78, "size": 0.05, "min_size": 28, "color": "#141e2d"}
+#     ],
+#     "groups": [                          необязательно: блоки полей, центрируемые по вертикали
+#       {"fields": [1, 2], "between": [0, 3], "gap": 0.02, "min_gap": 10, "offset": -7}
+#     ]
+#   }
+#
+# x, y, max_width — доли ширины/высоты шаблона, size — доля высоты (стартовый размер шрифта,
+# уменьшается до min_size, пока текст не влезет в max_width), anchor — якорь Pillow.
+# В text доступны {full_name}, {event_name}, {event_date}, {score}.
+#
+# Группа (номера полей в fields) ставит свои поля столбиком через gap (доля высоты, не меньше
+# min_gap px) и центрирует столбик между низом текста поля between[0] и верхом поля between[1]
+# (тоже с отступом gap); offset — сдвиг в px. Положение зависит от фактической высоты текста:
+# длинное название мероприятия, уменьшенное до min_size, освобождает место. y у полей группы
+# не задаётся, у полей группы и between якорь по вертикали — "a" (верх строки).
+# Новый диплом добавляется картинкой и JSON-файлом, без изменений в коде.
+
+TEMPLATE_PLACEHOLDERS = {"full_name", "event_name", "event_date", "score"}
+TEMPLATE_IMAGE_EXTS = {".png", ".webp", ".jpg", ".jpeg"}
+
+
+class TemplateError(ValueError):
+    """Ошибка в описании шаблона (JSON-файле) или в его картинке."""
+
+
+def _parse_color(value, where: str) -> tuple:
+    if isinstance(value, str):
+        raw = value.strip().lstrip("#")
+        if len(raw) in {6, 8}:
+            try:
+                parts = tuple(int(raw[i:i + 2], 16) for i in range(0, len(raw), 2))
+                return parts if len(parts) == 4 else parts + (255,)
+            except ValueError:
+                pass
+    elif isinstance(value, (list, tuple)) and len(value) in {3, 4} and all(isinstance(v, int) and 0 <= v <= 255 for v in value):
+        return tuple(value) if len(value) == 4 else tuple(value) + (255,)
+    raise TemplateError(f"{where}: color must be #RRGGBB[AA] or [r, g, b(, a)]")
+
+
+def _parse_fraction(raw: dict, name: str, where: str, default=None) -> float:
+    value = raw.get(name, default)
+    if not isinstance(value, (int, float)) or isinstance(value, bool) or not 0 <= value <= 1:
+        raise TemplateError(f"{where}: {name} must be a number in [0, 1]")
+    return float(value)
+
+
+class TextField:
+    """Текстовый блок шаблона: что писать, каким шрифтом, где и в каких пределах."""
+
+    def __init__(self, raw: dict, where: str) -> None:
+        if not isinstance(raw, dict):
+            raise TemplateError(f"{where}: field must be an object")
+        self.text = raw.get("text")
+        if not isinstance(self.text, str) or not self.text.strip():
+            raise TemplateError(f"{where}: text required")
+        try:
+            names = {name for _, name, _, _ in string.Formatter().parse(self.text) if name is not None}
+        except ValueError as e:
+            raise TemplateError(f"{where}: bad text format: {e}")
+        unknown = names - TEMPLATE_PLACEHOLDERS
+        if unknown:
+            raise TemplateError(f"{where}: unknown placeholders {sorted(unknown)}")
+
+        self.font = str(raw.get("font") or "regular")
+        if self.font not in {"regular", "bold"}:
+            raise TemplateError(f"{where}: font must be regular or bold")
+        self.x = _parse_fraction(raw, "x", where, 0.5)
+        # Без y — только у полей группы: их положение считает _layout_group.
+        self.y = _parse_fraction(raw, "y", where) if "y" in raw else None
+        self.max_width = _parse_fraction(raw, "max_width", where, 0.78)
+        self.size = _parse_fraction(raw, "size", where)
+        self.min_size = raw.get("min_size", 18)
+        if not isinstance(self.min_size, int) or self.min_size < 1:
+            raise TemplateError(f"{where}: min_size must be a positive integer")
+        self.anchor = str(raw.get("anchor") or "ma")
+        if len(self.anchor) != 2 or self.anchor[0] not in "lmr" or self.anchor[1] not in "atmsbd":
+            raise TemplateError(f"{where}: bad anchor {self.anchor!r}")
+        self.color = _parse_color(raw.get("color", "#141e2d"), where)
+
+
+class TextGroup:
+    """Поля шаблона, которые ставятся столбиком по центру промежутка между двумя другими полями."""
+
+    def __init__(self, raw: dict, fields: list[TextField], where: str) -> None:
+        if not isinstance(raw, dict):
+            raise TemplateError(f"{where}: group must be an object")
+
+        def _indexes(name: str) -> list[int]:
+            value = raw.get(name)
+            if not isinstance(value, list) or not value or not all(
+                isinstance(i, int) and not isinstance(i, bool) and 0 <= i < len(fields) for i in value
+            ):
+                raise TemplateError(f"{where}: {name} must be a list of field numbers")
+            return value
+
+        self.fields = _indexes("fields")
+        self.between = _indexes("between")
+        if len(self.between) != 2:
+            raise TemplateError(f"{where}: between must have two field numbers")
+        if len(set(self.fields)) != len(self.fields) or set(self.fields) & set(self.between):
+            raise TemplateError(f"{where}: fields and between must not repeat")
+        for i in self.fields + self.between:
+            if fields[i].anchor[1] != "a":
+                raise TemplateError(f"{where}: field {i} must have a top anchor (\"?a\")")
+        for i in self.between:
+            if fields[i].y is None:
+                raise TemplateError(f"{where}: field {i} needs y")
+        self.gap = _parse_fraction(raw, "gap", where, 0.02)
+        self.min_gap = raw.get("min_gap", 0)
+        self.offset = raw.get("offset", 0)
+        for name in ("min_gap", "offset"):
+            value = getattr(self, name)
+            if not isinstance(value, int) or isinstance(value, bool):
+                raise TemplateError(f"{where}: {name} must be an integer")
+
+
+class CertTemplate:
+    """Загруженный шаблон: описание из JSON и уже декодированная картинка (RGBA)."""
+
+    def __init__(self, sidecar_path: str) -> None:
+        where = os.path.basename(sidecar_path)
+        try:
+            with open(sidecar_path, "rb") as f:
+                raw_bytes = f.read()
+            raw = json.loads(raw_bytes.decode("utf-8"))
+        except (OSError, ValueError) as e:
+            raise TemplateError(f"{where}: {e}")
+        if not isinstance(raw, dict):
+            raise TemplateError(f"{where}: top level must be an object")
+
+        self.key = str(raw.get("key") or "").strip()
+        if not self.key:
+            raise TemplateError(f"{where}: key required")
+        self.title = str(raw.get("title") or self.key).strip()
+
+        image_name = str(raw.get("image") or "")
+        if os.path.splitext(image_name)[1].lower() not in TEMPLATE_IMAGE_EXTS or os.path.basename(image_name) != image_name:
+            raise TemplateError(f"{where}: image must be a file name with one of {sorted(TEMPLATE_IMAGE_EXTS)}")
+        self.image_path = os.path.join(os.path.dirname(sidecar_path), image_name)
+        try:
+            with Image.open(self.image_path) as src:
+                self.image = src.convert("RGBA")
+        except Exception as e:
+            raise TemplateError(f"{where}: cannot load image {image_name}: {e}")
+
+        output = raw.get("output") or {}
+        if not isinstance(output, dict):
+            raise TemplateError(f"{where}: output must be an object")
+        if "format" in output and output["format"] not in OUTPUT_FORMATS:
+            raise TemplateError(f"{where}: output.format must be one of {sorted(OUTPUT_FORMATS)}")
+        self.output = dict(output)
+
+        fields = raw.get("fields")
+        if not isinstance(fields, list) or not fields:
+            raise TemplateError(f"{where}: fields must be a non-empty list")
+        self.fields = [TextField(field, f"{where}: fields[{i}]") for i, field in enumerate(fields)]
+
+        groups = raw.get("groups") or []
+        if not isinstance(groups, list):
+            raise TemplateError(f"{where}: groups must be a list")
+        self.groups = [TextGroup(group, self.fields, f"{where}: groups[{i}]") for i, group in enumerate(groups)]
+        grouped = {i for group in self.groups for i in group.fields}
+        if len(grouped) != sum(len(group.fields) for group in self.groups):
+            raise TemplateError(f"{where}: a field can belong to one group only")
+        for i, field in enumerate(self.fields):
+            if field.y is None and i not in grouped:
+                raise TemplateError(f"{where}: fields[{i}]: y required")
+            if field.y is not None and i in grouped:
+                raise TemplateError(f"{where}: fields[{i}]: y is set by its group")
+
+        # Версия для ключа кеша готовых файлов: меняется при правке JSON или замене картинки.
+        stat = os.stat(self.image_path)
+        self.version = hashlib.sha256(raw_bytes + f"|{stat.st_mtime_ns}|{stat.st_size}".encode()).hexdigest()[:16]
+        self._previews: dict[int, Image.Image] = {}
+
+    @property
+    def size(self) -> tuple[int, int]:
+        return self.image.size
+
+    def preview_image(self, width: int) -> Image.Image:
+        """Уменьшенная копия шаблона для превью (считается один раз на ширину). Рисовать только на копии."""
+        w, h = self.image.size
+        # Шире оригинала не увеличиваем — и ключ кеша тот же, что у уже посчитанной копии.
+        width = min(width, w)
+        img = self._previews.get(width)
+        if img is None:
+            img = self.image.resize((width, max(1, round(h * width / w))), Image.LANCZOS)
+            self._previews[width] = img
+        return img
+
+
+class TemplateRegistry:
+    """Шаблоны из CERT_TEMPLATES_DIR (*.json) по ключу.
+
+    Загружается один раз: при старте сервера (load() с проверкой всех описаний)
+    и лениво в каждом процессе пула рендеринга. Шаблоны с ошибками в реестр не попадают.
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self._templates: dict[str, CertTemplate] | None = None
+        self.errors: list[str] = []
+
+    def load(self) -> list[str]:
+        """Читает и проверяет все описания; возвращает список ошибок (пустой, если всё в порядке)."""
+        templates: dict[str, CertTemplate] = {}
+        errors = []
+        try:
+            names = sorted(os.listdir(self.directory))
+        except OSError as e:
+            names = []
+            errors.append(f"{self.directory}: {e}")
+        for name in names:
+            if not name.endswith(".json"):
+                continue
+            try:
+                tpl = CertTemplate(os.path.join(self.directory, name))
+            except TemplateError as e:
+                errors.append(str(e))
+                continue
+            if tpl.key in templates:
+                errors.append(f"{name}: duplicate key {tpl.key!r}")
+                continue
+            templates[tpl.key] = tpl
+        self._templates = templates
+        self.errors = errors
+        return errors
+
+    @property
+    def templates(self) -> dict[str, CertTemplate]:
+        if self._templates is None:
+            self.load()
+        return self._templates
+
+    def __contains__(self, key) -> bool:
+        return key in self.templates
+
+    def get(self, key: str) -> CertTemplate:
+        tpl = self.templates.get(key)
+        if tpl is None:
+            raise TemplateError(f"Unknown certificate template: {key}")
+        return tpl
+
+    def items(self) -> list[CertTemplate]:
+        return list(self.templates.values())
+
+
+cert_templates = TemplateRegistry(CERT_TEMPLATES_DIR)
+
+
+def _draw_award(template_key: str, full_name: str, event_name: str, event_date: str, score: int | None = None, font_key: str = "sans", preview_width: int | None = None) -> Image.Image:
+    """Накладывает текст на копию шаблона и возвращает изображение (без кодирования).
+
+    Подбор размера шрифта для каждого блока, затем положение групп по высоте их текста
+    (font.getbbox, без отрисовки) и отрисовка по якорю. С preview_width рисует ту же раскладку
+    на уменьшенном шаблоне.
+    """
+    tpl = cert_templates.get(template_key)
+    base = tpl.preview_image(preview_width) if preview_width else tpl.image
+    img = base.copy()
+    w, h = img.size
+    scale = h / tpl.size[1]
+    draw = ImageDraw.Draw(img)
+
+    regular_font_path, bold_font_path = _resolve_font_paths(font_key)
+    try:
+        score_val = int(score) if score is not None else 0
+    except Exception:
+        score_val = 0
+    values = {
+        "full_name": (full_name or "").strip(),
+        "event_name": (event_name or "").strip(),
+        "event_date": (event_date or "").strip(),
+        "score": score_val,
+    }
+
+    lines = []
+    for field in tpl.fields:
+        text = field.text.format_map(values).strip()
+        font = None
+        if text:
+            font_path = bold_font_path if field.font == "bold" else regular_font_path
+            min_size = max(6, round(field.min_size * scale))
+            font = _fit_font(text, font_path, int(w * field.max_width), max(min_size, int(h * field.size)), min_size=min_size)
+        lines.append((text, font))
+
+    ys = [h * field.y if field.y is not None else None for field in tpl.fields]
+    for group in tpl.groups:
+        _layout_group(group, lines, ys, h, scale)
+
+    for field, (text, font), y in zip(tpl.fields, lines, ys):
+        if text:
+            draw.text((w * field.x, y), text, font=font, fill=field.color, anchor=field.anchor)
+
+    return img
+
+
+def _layout_group(group: TextGroup, lines: list, ys: list, h: int, scale: float) -> None:
+    """Записывает в ys верх строк полей группы: столбик по центру промежутка между полями between."""
+
+    def _height(i: int) -> int:
+        text, font = lines[i]
+        if not text:
+            return 0
+        _, top, _, bottom = font.getbbox(text, anchor="la")
+        return bottom - top
+
+    gap = max(group.min_gap * scale, int(h * group.gap))
+    above, below = group.between
+    top = ys[above] + _height(above) + gap
+    bottom = ys[below] - gap
+    heights = [_height(i) for i in group.fields]
+    block = sum(heights) + gap * (len(heights) - 1)
+    y = int(top + (bottom - top - block) / 2) if bottom > top + block else top
+    y += group.offset * scale
+    for i, height in zip(group.fields, heights):
+        ys[i] = y
+        y += height + gap
+
+
+# -------------------------
+# Формат результата
+# -------------------------
+
+# format -> (формат Pillow, расширение файла, content-type)
+OUTPUT_FORMATS = {
+    "png": ("PNG", ".png", "image/png"),
+    "jpeg": ("JPEG", ".jpg", "image/jpeg"),
+    "webp": ("WEBP", ".webp", "image/webp"),
+    "pdf": ("PDF", ".pdf", "application/pdf"),
+}
+
+
+class RenderedAward(NamedTuple):
+    data: bytes
+    ext: str
+    content_type: str
+
+
+def output_settings(template_key: str) -> dict:
+    """Формат и параметры сжатия для шаблона: "output" из его описания поверх окружения.
+
+    PNG с optimize=True — самый медленный путь Pillow и файлы в несколько мегабайт,
+    поэтому по умолчанию PNG без optimize с умеренным compress_level.
+    """
+    try:
+        overrides = cert_templates.get(template_key).output
+    except TemplateError:
+        overrides = {}
+    fmt = str(overrides.get("format") or os.getenv("CERT_OUTPUT_FORMAT") or "png").strip().lower()
+    if fmt not in OUTPUT_FORMATS:
+        fmt = "png"
+    quality = overrides.get("quality", env_int("CERT_JPEG_QUALITY" if fmt != "webp" else "CERT_WEBP_QUALITY", 92))
+    compress_level = overrides.get("compress_level", env_int("CERT_PNG_COMPRESS_LEVEL", 6))
+    return {
+        "format": fmt,
+        "png_compress_level": min(9, max(0, int(compress_level))),
+        "quality": min(100, max(1, int(quality))),
+    }
+
+
+def _encode(img: Image.Image, output: dict) -> RenderedAward:
+    fmt = output.get("format") or "png"
+    pil_format, ext, content_type = OUTPUT_FORMATS[fmt]
+    rgb = img.convert("RGB")
+    out = BytesIO()
+    if fmt == "png":
+        rgb.save(out, format=pil_format, compress_level=output.get("png_compress_level", 6))
+    elif fmt == "jpeg":
+        # subsampling=0 (4:4:4) — без цветных ореолов вокруг мелкого текста.
+        rgb.save(out, format=pil_format, quality=output.get("quality", 92), subsampling=0)
+    elif fmt == "webp":
+        rgb.save(out, format=pil_format, quality=output.get("quality", 92), method=4)
+    else:
+        # PDF: страница размером с шаблон, изображение внутри сжато как JPEG.
+        rgb.save(out, format=pil_format, resolution=150.0)
+    return RenderedAward(out.getvalue(), ext, content_type)
+
+
+def render_award(template_key: str, full_name: str, event_name: str, event_date: str, score: int | None = None, font_key: str = "sans", output: dict | None = None) -> RenderedAward:
+    img = _draw_award(template_key, full_name, event_name, event_date, score=score, font_key=font_key)
+    return _encode(img, output or output_settings(template_key))
+
+
+def render_award_preview(template_key: str, full_name: str, event_name: str, event_date: str, score: int | None = None, font_key: str = "sans", width: int = 360, fmt: str = "jpeg") -> RenderedAward:
+    """Быстрое превью для админки: та же раскладка на уменьшенном шаблоне, JPEG/WebP низкого качества."""
+    img = _draw_award(template_key, full_name, event_name, event_date, score=score, font_key=font_key, preview_width=width)
+    return _encode(img, {"format": fmt if fmt in {"jpeg", "webp"} else "jpeg", "quality": 80})
+
+
+def _clip_text(text: str, font: ImageFont.FreeTypeFont, max_width: int) -> str:
+    if font.getlength(text) <= max_width:
+        return text
+    while text and font.getlength(text + "…") > max_width:
+        text = text[:-1]
+    return text + "…"
+
+
+def render_text_pages(title: str, lines: list[str], size: tuple[int, int], font_key: str = "sans") -> list[bytes]:
+    """Служебные страницы (JPEG) размером с шаблон: заголовок и список строк, сколько нужно страниц.
+
+    Для выгрузки в PDF — список участников, сертификаты которых не удалось отрисовать.
+    Слишком длинные строки обрезаются многоточием.
+    """
+    w, h = size
+    regular_font_path, bold_font_path = _resolve_font_paths(font_key)
+    title_font = _fit_font(title, bold_font_path, int(w * 0.9), max(12, int(h * 0.03)), min_size=12)
+    font = _load_font(regular_font_path, max(10, int(h * 0.016)))
+    margin = int(w * 0.05)
+    line_h = int(font.size * 1.4)
+    top = margin + int(title_font.size * 1.8)
+    per_page = max(1, (h - top - margin) // line_h)
+
+    pages = []
+    for start in range(0, max(1, len(lines)), per_page):
+        img = Image.new("RGB", (w, h), "white")
+        draw = ImageDraw.Draw(img)
+        draw.text((margin, margin), title, font=title_font, fill=(150, 20, 20))
+        for i, line in enumerate(lines[start:start + per_page]):
+            draw.text((margin, top + i * line_h), _clip_text(line, font, w - 2 * margin), font=font, fill=(20, 30, 45))
+        out = BytesIO()
+        img.save(out, format="JPEG", quality=85)
+        pages.append(out.getvalue())
+    return pages
+
+
+class _RenderCache:
+    """Кеш готовых сертификатов по хешу входных данных (LRU с лимитом по байтам).
+
+    Повторная отправка или ретрай после ошибки загрузки не рендерят сертификат заново.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max(0, int(max_bytes))
+        self._items: OrderedDict[str, RenderedAward] = OrderedDict()
+        self._size = 0
+
+    @staticmethod
+    def key(params: dict) -> str:
+        try:
+            version = cert_templates.get(params.get("template_key")).version
+        except TemplateError:
+            version = ""
+        raw = repr((sorted(params.items()), version)).encode("utf-8")
+        return hashlib.sha256(raw).hexdigest()
+
+    def get(self, key: str) -> RenderedAward | None:
+        item = self._items.get(key)
+        if item is not None:
+            self._items.move_to_end(key)
+        return item
+
+    def put(self, key: str, item: RenderedAward) -> None:
+        size = len(item.data)
+        if size > self.max_bytes or key in self._items:
+            return
+        self._items[key] = item
+        self._size += size
+        while self._size > self.max_bytes and self._items:
+            _, old = self._items.popitem(last=False)
+            self._size -= len(old.data)
+
+
+# -------------------------
+# Пул рендеринга
+# -------------------------
+
+
+class RenderBusy(Exception):
+    """В очереди рендеринга нет места — вызывающий отвечает 503."""
+
+
+def _warm_worker() -> int:
+    """Прогрев воркера: загружает реестр шаблонов (с декодированием картинок) и шрифты нужных размеров.
+
+    Рисуем пробный сертификат по каждому шаблону без кодирования —
+    так в кешах оказываются ровно те размеры шрифтов, что понадобятся при реальном рендере.
+    """
+    warmed = 0
+    for tpl in cert_templates.items():
+        for font_key in ("dejavu_sans", "dejavu_serif"):
+            try:
+                _draw_award(tpl.key, "Иванов Иван", "Мероприятие", "01.01.2026", score=0, font_key=font_key)
+                warmed += 1
+            except Exception:
+                pass
+    return warmed
+
+
+class RenderPool:
+    """Рендеринг сертификатов вне event loop.
+
+    По умолчанию — ProcessPoolExecutor (Pillow держит GIL на части операций, а кодирование
+    большого изображения — сотни миллисекунд); если процессы недоступны — ThreadPoolExecutor.
+    max_pending ограничивает число заданий в работе и в очереди: при переполнении
+    render() сразу бросает RenderBusy, а не копит запросы.
+    """
+
+    def __init__(self, workers: int, max_pending: int, kind: str = "process", cache_bytes: int = 0) -> None:
+        self.workers = max(1, int(workers))
+        self.max_pending = max(1, int(max_pending))
+        self.kind = kind
+        self._executor: Executor | None = None
+        self._pending = 0
+        self._cache = _RenderCache(cache_bytes)
+
+    def _create_executor(self) -> Executor:
+        if self.kind == "process":
+            try:
+                # spawn, а не fork: к этому моменту в процессе уже работают потоки (aiosqlite и т.п.).
+                return ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_warm_worker,
+                )
+            except Exception as e:
+                logging.getLogger(__name__).warning("Process pool unavailable, using threads: %s", e)
+                self.kind = "thread"
+        return ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="cert-render")
+
+    @property
+    def executor(self) -> Executor:
+        if self._executor is None:
+            self._executor = self._create_executor()
+        return self._executor
+
+    async def warm(self) -> None:
+        """Запускает воркеры заранее, чтобы первый рендер не ждал старта процессов и прогрева."""
+        loop = asyncio.get_running_loop()
+        try:
+            jobs = [loop.run_in_executor(self.executor, _warm_worker) for _ in range(self.workers)]
+        except Exception as e:
+            logging.getLogger(__name__).warning("Render pool warm-up failed: %s", e)
+            return
+        await asyncio.gather(*jobs, return_exceptions=True)
+
+    async def render(self, use_cache: bool = True, **kwargs) -> RenderedAward:
+        """Рендерит сертификат (параметры как у render_award); повторные запросы — из кеша.
+
+        use_cache=False — для разовых выгрузок, чтобы сотни файлов не вытесняли кеш отправок.
+        """
+        kwargs.setdefault("output", output_settings(kwargs.get("template_key") or ""))
+        cache_key = self._cache.key(kwargs)
+        cached = self._cache.get(cache_key) if use_cache else None
+        if cached is not None:
+            return cached
+
+        if self._pending >= self.max_pending:
+            raise RenderBusy()
+        self._pending += 1
+        job = functools.partial(render_award, **kwargs)
+        try:
+            loop = asyncio.get_running_loop()
+            try:
+                result = await loop.run_in_executor(self.executor, job)
+            except BrokenProcessPool as e:
+                # Воркер упал (OOM-killer, ограничения хостинга) — дальше рендерим в потоках.
+                logging.getLogger(__name__).warning("Render process pool is broken, using threads: %s", e)
+                self.shutdown()
+                self.kind = "thread"
+                result = await loop.run_in_executor(self.executor, job)
+        finally:
+            self._pending -= 1
+        result = RenderedAward(*result)
+        if use_cache:
+            self._cache.put(cache_key, result)
+        return result
+
+    def shutdown(self) -> None:
+        executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+render_pool = RenderPool(
+    workers=env_int("CERT_RENDER_WORKERS", min(2, os.cpu_count() or 1)),
+    max_pending=env_int("CERT_RENDER_QUEUE", 8),
+    kind=(os.getenv("CERT_RENDER_EXECUTOR") or "process").strip().lower(),
+    cache_bytes=env_int("CERT_RENDER_CACHE_MB", 64) * 1024 * 1024,
+)
@@ -1,9 +1,18 @@
+import json
+import logging
 import os
 import time
 import asyncio
+import contextlib
 from datetime import datetime
 from pathlib import Path
 
+from env_utils import env_float, env_int
+from database.events import broadcaster
+from database.meta_cache import MetaCache
+from database.rank_index import ScoreRankIndex
+from database.score_buffer import ScoreBuffer
+
 
 def _project_root() -> Path:
     return Path(__file__).resolve().parents[1]
@@ -63,6 +72,228 @@ def _format_city_name(value: str | None) -> str | None:
     """
     return _format_person_name(value)
 
+
+# In-memory индекс рейтинга (место пользователя по очкам).
+# Загружается из БД при старте (create_table) и обновляется всеми функциями,
+# которые меняют score/состав users. Позволяет не делать COUNT(*) по всей таблице
+# на каждое нажатие «📊 Статистика».
+_rank_index = ScoreRankIndex()
+_rank_index_lock = asyncio.Lock()
+
+
+# Кеш уровней и глобальной метки сброса (см. MetaCache). Обновляется write-through
+# функциями записи ниже и перечитывается из БД раз в LEVELS_CACHE_TTL секунд
+# (0 — кеш выключен, каждый запрос идёт в БД).
+_meta_cache = MetaCache(ttl=env_float("LEVELS_CACHE_TTL", 5.0))
+
+
+# Write-behind буфер очков (см. ScoreBuffer). В конце раунда все игроки отправляют результат
+# почти одновременно, и отдельный UPDATE + commit на каждую отправку упирается в запись.
+# С буфером update_score только запоминает максимум, а в БД очки уходят одной пачкой
+# раз в SCORE_FLUSH_INTERVAL секунд или при SCORE_FLUSH_MAX пользователей в буфере.
+# SCORE_FLUSH_INTERVAL=0 (по умолчанию) — буфер выключен.
+_score_buffer = ScoreBuffer(
+    interval=env_float("SCORE_FLUSH_INTERVAL", 0),
+    max_size=env_int("SCORE_FLUSH_MAX", 500),
+)
+_score_flush_lock = asyncio.Lock()
+_score_flush_task: asyncio.Task | None = None
+
+
+async def flush_scores() -> int:
+    """Записывает накопленные очки в БД одной транзакцией и возвращает размер пачки.
+
+    Если запись не удалась, пачка возвращается в буфер (и будет записана следующим flush).
+    """
+    async with _score_flush_lock:
+        items = _score_buffer.drain()
+        if not items:
+            return 0
+        try:
+            await _write_score_batch(sorted(items))
+        except Exception:
+            _score_buffer.restore(items)
+            raise
+        return len(items)
+
+
+async def _flush_pending_scores() -> None:
+    """flush_scores перед чтениями, которым нужны точные очки из БД (топы, списки, бэкап)."""
+    if not len(_score_buffer):
+        return
+    try:
+        await flush_scores()
+    except Exception:
+        pass
+
+
+async def _score_flush_loop() -> None:
+    while True:
+        await asyncio.sleep(_score_buffer.interval)
+        try:
+            await flush_scores()
+        except Exception:
+            # Пачка осталась в буфере — попробуем на следующем тике.
+            pass
+
+
+def _ensure_score_flusher() -> None:
+    global _score_flush_task
+    if _score_flush_task is None or _score_flush_task.done():
+        _score_flush_task = asyncio.create_task(_score_flush_loop())
+
+
+async def close_score_buffer() -> None:
+    """Останавливает фоновый flush и записывает остаток буфера (при остановке сервиса)."""
+    global _score_flush_task
+    task, _score_flush_task = _score_flush_task, None
+    if task is not None:
+        task.cancel()
+        try:
+            await task
+        except (asyncio.CancelledError, Exception):
+            pass
+    await flush_scores()
+
+
+async def _buffer_score(tg_id: int, new_score: int) -> None:
+    _score_buffer.add(int(tg_id), int(new_score))
+    # Индекс рейтинга обновляем сразу — место пользователя видно до flush.
+    _rank_index.bump_score(int(tg_id), int(new_score))
+    if _score_buffer.is_full():
+        await flush_scores()
+    else:
+        _ensure_score_flusher()
+
+
+async def _drop_pending_scores(tg_id: int | None = None) -> None:
+    """Забывает незаписанные очки (одного пользователя или все) перед сбросом/удалением.
+
+    Берём lock, чтобы дождаться flush, который уже идёт: иначе он мог бы записать
+    старые очки поверх только что сброшенных.
+    """
+    async with _score_flush_lock:
+        if tg_id is None:
+            _score_buffer.clear()
+        else:
+            _score_buffer.discard(int(tg_id))
+
+
+def _with_pending_score(row):
+    """Подставляет в строку пользователя (score — 6-я колонка) незаписанные очки из буфера."""
+    if row is None or not len(_score_buffer):
+        return row
+    row = tuple(row)
+    return row[:5] + (_score_buffer.merge_score(row[0], row[5]),) + row[6:]
+
+
+# Уведомления после успешной записи в БД: обновляем кеш и рассылаем событие
+# подписчикам SSE (/api/events). Вызываются из обеих реализаций (SQLite/PostgreSQL).
+
+def _after_level_change(level_key: str, is_active: bool) -> None:
+    _meta_cache.set_level(level_key, is_active)
+    broadcaster.publish({"type": "level", "level_key": level_key, "is_active": bool(is_active)})
+
+
+def _after_stats_reset(reset_token: str | None) -> None:
+    if reset_token is None:
+        return
+    _meta_cache.set_reset_token(reset_token)
+    broadcaster.publish({"type": "stats_reset", "reset_token": str(reset_token)})
+
+
+def _after_user_reset(tg_id: int, token: str | None) -> None:
+    if token is not None:
+        broadcaster.publish({"type": "user_reset", "user_reset_token": str(token)}, uid=int(tg_id))
+
+
+def _after_user_deleted(tg_id: int, token: str | None) -> None:
+    if token is not None:
+        broadcaster.publish({"type": "user_deleted", "user_deleted_token": str(token)}, uid=int(tg_id))
+
+
+def _build_client_sync_state(tg_id: int | None, rows) -> dict:
+    """Собирает результат get_client_sync_state из строк общего запроса.
+
+    Каждая строка: (level_key, is_active, reset_token, user_deleted_token, user_reset_token,
+    telegram_id, first_name, last_name, age, city, score, aptitude_top).
+    Скалярные колонки одинаковы во всех строках (по одной строке на уровень).
+    """
+    levels = {}
+    reset_token = "0"
+    deleted_token = "0"
+    user_reset_token = "0"
+    user = None
+    for row in rows:
+        level_key, is_active, reset_raw, deleted_raw, user_reset_raw, *user_cols = row
+        if level_key is not None:
+            levels[level_key] = bool(is_active)
+        reset_token = str(reset_raw) if reset_raw is not None else "0"
+        deleted_token = str(deleted_raw) if deleted_raw is not None else "0"
+        user_reset_token = str(user_reset_raw) if user_reset_raw is not None else "0"
+        if user_cols[0] is not None:
+            user = _with_pending_score(tuple(user_cols))
+    return {
+        "levels": levels,
+        "reset_token": reset_token,
+        "user_exists": None if tg_id is None else user is not None,
+        "user": user,
+        "user_deleted_token": deleted_token,
+        "user_reset_token": user_reset_token,
+    }
+
+
+def _cached_client_sync_state(tg_id: int | None, user_row) -> dict:
+    """То же, что _build_client_sync_state, но уровни и reset_token берутся из _meta_cache.
+
+    user_row — строка _CLIENT_USER_SQL: (user_deleted_token, user_reset_token, telegram_id, ...).
+    """
+    deleted_raw, user_reset_raw, *user_cols = user_row or (None, None, None)
+    user = tuple(user_cols) if user_cols and user_cols[0] is not None else None
+    user = _with_pending_score(user)
+    return {
+        "levels": dict(_meta_cache.levels or {}),
+        "reset_token": _meta_cache.reset_token or "0",
+        "user_exists": None if tg_id is None else user is not None,
+        "user": user,
+        "user_deleted_token": str(deleted_raw) if deleted_raw is not None else "0",
+        "user_reset_token": str(user_reset_raw) if user_reset_raw is not None else "0",
+    }
+
+
+# Один запрос вместо get_levels + get_stats_reset_token + get_user + get_user_*_token.
+# Параметр (telegram_id) подставляется в три места; для uid=None пользовательские CTE пустые.
+_CLIENT_SYNC_SQL = """
+WITH
+    meta AS (SELECT value FROM app_meta WHERE key = 'stats_reset_token'),
+    del AS (SELECT token FROM user_deletions WHERE telegram_id = {p1}),
+    rst AS (SELECT token FROM user_resets WHERE telegram_id = {p2}),
+    u AS (
+        SELECT telegram_id, first_name, last_name, age, city, score, aptitude_top
+        FROM users WHERE telegram_id = {p3}
+    )
+SELECT
+    l.level_key, l.is_active,
+    (SELECT value FROM meta),
+    (SELECT token FROM del),
+    (SELECT token FROM rst),
+    u.telegram_id, u.first_name, u.last_name, u.age, u.city, u.score, u.aptitude_top
+FROM (SELECT 1 AS one) base
+LEFT JOIN levels l ON 1 = 1
+LEFT JOIN u ON 1 = 1
+ORDER BY l.level_key ASC
+"""
+
+# Пользовательская часть _CLIENT_SYNC_SQL — когда уровни и reset_token уже есть в кеше.
+_CLIENT_USER_SQL = """
+SELECT
+    (SELECT token FROM user_deletions WHERE telegram_id = {p1}),
+    (SELECT token FROM user_resets WHERE telegram_id = {p2}),
+    u.telegram_id, u.first_name, u.last_name, u.age, u.city, u.score, u.aptitude_top
+FROM (SELECT 1 AS one) base
+LEFT JOIN users u ON u.telegram_id = {p3}
+"""
+
 # Поддерживаем ДВА режима:
 # 1) PostgreSQL (рекомендуется) — если задана переменная окружения DATABASE_URL.
 #    Это даёт сохранность данных между полными перезапусками (в т.ч. на хостинге с эфемерной FS).
@@ -77,6 +308,9 @@ _using_postgres = DATABASE_URL.lower().startswith(("postgres://", "postgresql://
 if not _using_postgres:
     import aiosqlite  # type: ignore
 
+    from database.sqlite_readers import ReaderPool
+    from database.sqlite_writer import GroupCommitWriter
+
     def _compute_db_path() -> str:
         """Возвращает стабильный путь к SQLite-БД (fallback)."""
         env_path = os.getenv("DB_PATH")
@@ -120,15 +354,48 @@ if not _using_postgres:
             await _db.execute("PRAGMA foreign_keys=ON;")
         return _db
 
+    # Все записи идут через одного писателя с групповым commit (см. GroupCommitWriter):
+    # пачка до SQLITE_COMMIT_BATCH операций или SQLITE_COMMIT_DELAY_MS миллисекунд
+    # фиксируется одним commit. Функции записи ниже commit сами не делают.
+    _writer = GroupCommitWriter(
+        get_db,
+        max_batch=env_int("SQLITE_COMMIT_BATCH", 64),
+        max_delay=env_float("SQLITE_COMMIT_DELAY_MS", 5.0) / 1000.0,
+    )
+
+    # Пул read-only соединений для SELECT (SQLITE_READERS, минимум 1).
+    # WAL позволяет читать параллельно с записью, а у каждого соединения aiosqlite свой поток.
+    # Читать через соединение писателя нельзя: оно видит записи ещё не зафиксированной пачки,
+    # которые могут откатиться до SAVEPOINT.
+    _readers = ReaderPool(DB_NAME, max(1, env_int("SQLITE_READERS", 4)))
+
+    @contextlib.asynccontextmanager
+    async def _read_conn():
+        """Соединение для чтения из пула читателей: видит только зафиксированные данные."""
+        # get_db() создаёт файл БД и включает WAL — без этого read-only соединение не откроется.
+        await get_db()
+        async with _readers.acquire() as conn:
+            yield conn
+
+    async def _write(op):
+        """Выполняет op(db) в групповой транзакции и возвращает результат после commit."""
+        return await _writer.submit(op)
+
     async def close_db() -> None:
         global _db
+        await _writer.close()
+        await _readers.close()
         if _db is not None:
             await _db.close()
             _db = None
 
-    async def create_table():
-        db = await get_db()
+    # -------------------------
+    # Миграции схемы (SQLite)
+    # -------------------------
+    # Каждая миграция применяется ровно один раз, номер сохраняется в schema_version.
+    # Runtime-функции DDL не выполняют — всё создаётся здесь при старте.
 
+    async def _migration_1_base(db: aiosqlite.Connection) -> None:
         await db.execute(
             '''
             CREATE TABLE IF NOT EXISTS users (
@@ -145,20 +412,17 @@ if not _using_postgres:
             '''
         )
 
-        # Миграция: если база была создана раньше без aptitude_top — добавим колонку.
-        try:
-            async with db.execute("PRAGMA table_info(users)") as cur:
-                cols = [row[1] for row in await cur.fetchall()]
-            if "city" not in cols:
-                await db.execute("ALTER TABLE users ADD COLUMN city TEXT")
-            if "aptitude_top" not in cols:
-                await db.execute("ALTER TABLE users ADD COLUMN aptitude_top TEXT")
-            if "pd_consent" not in cols:
-                await db.execute("ALTER TABLE users ADD COLUMN pd_consent INTEGER DEFAULT 0")
-            if "pd_consent_at" not in cols:
-                await db.execute("ALTER TABLE users ADD COLUMN pd_consent_at TEXT")
-        except Exception:
-            pass
+        # Старые базы могли быть созданы без части колонок — добавим недостающие.
+        async with db.execute("PRAGMA table_info(users)") as cur:
+            cols = [row[1] for row in await cur.fetchall()]
+        if "city" not in cols:
+            await db.execute("ALTER TABLE users ADD COLUMN city TEXT")
+        if "aptitude_top" not in cols:
+            await db.execute("ALTER TABLE users ADD COLUMN aptitude_top TEXT")
+        if "pd_consent" not in cols:
+            await db.execute("ALTER TABLE users ADD COLUMN pd_consent INTEGER DEFAULT 0")
+        if "pd_consent_at" not in cols:
+            await db.execute("ALTER TABLE users ADD COLUMN pd_consent_at TEXT")
 
         await db.execute(
             '''
@@ -169,23 +433,6 @@ if not _using_postgres:
             '''
         )
 
-        default_levels = [
-            "puzzle-2x2",
-            "puzzle-3x3",
-            "puzzle-4x4",
-            "jumper",
-            "factory-2048",
-            "quiz",
-            # Профориентационный тест "что тебе подходит?" (кнопка в меню)
-            "aptitude",
-        ]
-        for key in default_levels:
-            await db.execute(
-                "INSERT OR IGNORE INTO levels (level_key, is_active) VALUES (?, 1)",
-                (key,),
-            )
-
-        
         # Глобальная "метка сброса" (нужна, чтобы WebApp мог понять, что админ сбросил статистику,
         # и очистить localStorage со старыми очками/рекомендациями).
         await db.execute(
@@ -200,7 +447,6 @@ if not _using_postgres:
             "INSERT OR IGNORE INTO app_meta(key, value) VALUES('stats_reset_token', '0')"
         )
 
-
         # Таблица меток удаления пользователей (нужна, чтобы WebApp мог понять,
         # что конкретного пользователя удалили в админке, и очистить localStorage при следующем входе).
         await db.execute(
@@ -212,61 +458,197 @@ if not _using_postgres:
             '''
         )
 
+    async def _migration_2_user_resets(db: aiosqlite.Connection) -> None:
+        # Раньше таблица создавалась лениво в _mark_user_reset.
+        await db.execute(
+            "CREATE TABLE IF NOT EXISTS user_resets (telegram_id INTEGER PRIMARY KEY, token TEXT)"
+        )
+
+    async def _migration_3_users_indexes(db: aiosqlite.Connection) -> None:
+        # Составной индекс (score DESC, telegram_id) покрывает и сортировку рейтинга,
+        # и условия по score (COUNT(*) WHERE score > ?), поэтому отдельный индекс по score не нужен.
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_users_score_tid ON users (score DESC, telegram_id)"
+        )
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_users_city ON users (city)")
+
+    async def _migration_4_max_update_dedup(db: aiosqlite.Connection) -> None:
+        # Ключи уже обработанных MAX Update (защита от повторной доставки webhook).
+        await db.execute(
+            "CREATE TABLE IF NOT EXISTS max_update_dedup (update_key TEXT PRIMARY KEY, seen_at REAL NOT NULL)"
+        )
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_max_update_dedup_seen ON max_update_dedup (seen_at)")
+
+    async def _migration_5_max_fsm_state(db: aiosqlite.Connection) -> None:
+        # Состояние регистрации в MAX-боте (раньше — dict в памяти процесса).
+        await db.execute(
+            "CREATE TABLE IF NOT EXISTS max_fsm_state (max_user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_max_fsm_state_updated ON max_fsm_state (updated_at)")
+
+    async def _migration_6_tg_fsm_state(db: aiosqlite.Connection) -> None:
+        # Состояние FSM aiogram (RegState / AdminState), см. DbFSMStorage.
+        await db.execute(
+            "CREATE TABLE IF NOT EXISTS tg_fsm_state (storage_key TEXT PRIMARY KEY, state TEXT, data TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_tg_fsm_state_updated ON tg_fsm_state (updated_at)")
+
+    async def _migration_7_users_score_not_null(db: aiosqlite.Connection) -> None:
+        # У старых строк score мог остаться NULL: «score < ?» такие строки никогда не обновляет,
+        # а индекс рейтинга считает их нулём. Приводим к 0, чтобы БД и индекс не расходились.
+        await db.execute("UPDATE users SET score = 0 WHERE score IS NULL")
+
+    _MIGRATIONS = [
+        (1, _migration_1_base),
+        (2, _migration_2_user_resets),
+        (3, _migration_3_users_indexes),
+        (4, _migration_4_max_update_dedup),
+        (5, _migration_5_max_fsm_state),
+        (6, _migration_6_tg_fsm_state),
+        (7, _migration_7_users_score_not_null),
+    ]
+
+    async def _apply_migrations(db: aiosqlite.Connection) -> int:
+        """Применяет недостающие миграции по порядку и возвращает итоговую версию схемы."""
+        await db.execute(
+            "CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, applied_at TEXT)"
+        )
         await db.commit()
+        async with db.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version") as cur:
+            row = await cur.fetchone()
+        current = int(row[0] or 0) if row else 0
+
+        for version, migration in _MIGRATIONS:
+            if version <= current:
+                continue
+            # Каждая миграция — отдельная транзакция вместе с записью её номера.
+            await db.execute("BEGIN")
+            try:
+                await migration(db)
+                await db.execute(
+                    "INSERT INTO schema_version (version, applied_at) VALUES (?, ?)",
+                    (version, time.strftime("%Y-%m-%d %H:%M:%S")),
+                )
+                await db.commit()
+            except Exception:
+                await db.rollback()
+                raise
+            current = version
+        return current
+
+    async def create_table():
+        db = await get_db()
+        async with _writer.paused():
+            await _apply_migrations(db)
+
+        default_levels = [
+            "puzzle-2x2",
+            "puzzle-3x3",
+            "puzzle-4x4",
+            "jumper",
+            "factory-2048",
+            "quiz",
+            # Профориентационный тест "что тебе подходит?" (кнопка в меню)
+            "aptitude",
+        ]
+        async def _op(db):
+            await db.executemany(
+                "INSERT OR IGNORE INTO levels (level_key, is_active) VALUES (?, 1)",
+                [(key,) for key in default_levels],
+            )
+
+        await _write(_op)
+
+        # Прогреваем индекс рейтинга. Если не получилось — загрузится лениво в get_user_rank.
+        try:
+            await _load_rank_index()
+        except Exception:
+            pass
+
+    async def _load_rank_index() -> None:
+        """Загружает in-memory индекс рейтинга из БД (один раз на процесс)."""
+        async with _rank_index_lock:
+            if _rank_index.loaded:
+                return
+            _rank_index.begin_load()
+            try:
+                async with _read_conn() as db, db.execute("SELECT telegram_id, COALESCE(score, 0) FROM users") as cur:
+                    rows = await cur.fetchall()
+            except Exception:
+                _rank_index.abort_load()
+                raise
+            _rank_index.load(rows)
 
     async def register_user(tg_id, f_name, l_name, age, city=None, pd_consent: bool = False):
         f_name = _format_person_name(f_name)
         l_name = _format_person_name(l_name)
         city = _format_city_name(city)
-        db = await get_db()
         consent_at = time.strftime("%Y-%m-%d %H:%M:%S") if pd_consent else None
-        await db.execute(
-            '''
-            INSERT OR IGNORE INTO users (telegram_id, first_name, last_name, age, city, pd_consent, pd_consent_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''',
-            (tg_id, f_name, l_name, age, city, 1 if pd_consent else 0, consent_at),
-        )
-        # Если пользователя ранее удаляли — убираем метку удаления.
-        try:
-            await _clear_user_deleted(int(tg_id))
-        except Exception:
-            pass
-        await db.commit()
+
+        async def _op(db):
+            await db.execute(
+                '''
+                INSERT OR IGNORE INTO users (telegram_id, first_name, last_name, age, city, pd_consent, pd_consent_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''',
+                (tg_id, f_name, l_name, age, city, 1 if pd_consent else 0, consent_at),
+            )
+            # Если пользователя ранее удаляли — убираем метку удаления.
+            try:
+                await _clear_user_deleted(db, int(tg_id))
+            except Exception:
+                pass
+
+        await _write(_op)
+        _rank_index.add_user(int(tg_id), 0)
 
     async def update_score(tg_id, new_score):
-        db = await get_db()
-        await db.execute(
-            '''
-            UPDATE users SET score = ? WHERE telegram_id = ? AND score < ?
-            ''',
-            (new_score, tg_id, new_score),
-        )
-        await db.commit()
+        if _score_buffer.enabled:
+            await _buffer_score(int(tg_id), int(new_score))
+            return
+
+        async def _op(db):
+            await db.execute(
+                '''
+                UPDATE users SET score = ? WHERE telegram_id = ? AND score < ?
+                ''',
+                (new_score, tg_id, new_score),
+            )
+
+        await _write(_op)
+        _rank_index.bump_score(int(tg_id), int(new_score))
+
+    async def _write_score_batch(items: list[tuple[int, int]]) -> None:
+        """Пакетная запись из буфера очков: один executemany в одной транзакции."""
+        async def _op(db):
+            await db.executemany(
+                "UPDATE users SET score = ? WHERE telegram_id = ? AND score < ?",
+                [(score, tg_id, score) for tg_id, score in items],
+            )
+
+        await _write(_op)
 
     async def get_top_users():
-        db = await get_db()
-        async with db.execute(
-            "SELECT first_name, last_name, score FROM users ORDER BY score DESC LIMIT 10"
+        await _flush_pending_scores()
+        async with _read_conn() as db, db.execute(
+            "SELECT first_name, last_name, score FROM users ORDER BY score DESC, telegram_id ASC LIMIT 10"
         ) as cursor:
             return await cursor.fetchall()
 
     async def get_user(tg_id: int):
-        db = await get_db()
-        async with db.execute(
+        async with _read_conn() as db, db.execute(
             "SELECT telegram_id, first_name, last_name, age, city, score FROM users WHERE telegram_id = ?",
             (tg_id,),
         ) as cursor:
-            return await cursor.fetchone()
+            return _with_pending_score(await cursor.fetchone())
 
     async def get_user_profile(tg_id: int):
         """Расширенные данные пользователя для webapp (в т.ч. результат профтеста)."""
-        db = await get_db()
-        async with db.execute(
+        async with _read_conn() as db, db.execute(
             "SELECT telegram_id, first_name, last_name, age, city, score, aptitude_top FROM users WHERE telegram_id = ?",
             (tg_id,),
         ) as cursor:
-            return await cursor.fetchone()
+            return _with_pending_score(await cursor.fetchone())
 
     async def get_user_rank(tg_id: int):
         """Возвращает место пользователя в рейтинге по очкам.
@@ -277,122 +659,124 @@ if not _using_postgres:
         Returns:
             tuple(rank:int, total:int) или None, если пользователя нет.
         """
-        db = await get_db()
-
-        # Очки текущего пользователя
-        async with db.execute(
-            "SELECT score FROM users WHERE telegram_id = ?",
-            (int(tg_id),),
-        ) as cur:
-            row = await cur.fetchone()
-        if not row:
-            return None
-        score = int(row[0] or 0)
-
-        # Общее число пользователей
-        async with db.execute("SELECT COUNT(*) FROM users") as cur:
-            total_row = await cur.fetchone()
-        total = int(total_row[0] or 0) if total_row else 0
-
-        # Место: 1 + количество пользователей с бОльшим счётом
-        async with db.execute(
-            "SELECT COUNT(*) FROM users WHERE score > ?",
-            (score,),
-        ) as cur:
-            higher_row = await cur.fetchone()
-        higher = int(higher_row[0] or 0) if higher_row else 0
-
-        return (higher + 1, total)
+        # Быстрый путь: in-memory индекс (O(log n) без запросов к БД).
+        if not _rank_index.loaded:
+            try:
+                await _load_rank_index()
+            except Exception:
+                pass
+        if _rank_index.loaded:
+            return _rank_index.rank(int(tg_id))
 
-    async def get_stats_reset_token() -> str:
-        db = await get_db()
-        try:
+        async with _read_conn() as db:
+            # Очки текущего пользователя
             async with db.execute(
-                "SELECT value FROM app_meta WHERE key = ?",
-                ("stats_reset_token",),
+                "SELECT score FROM users WHERE telegram_id = ?",
+                (int(tg_id),),
             ) as cur:
                 row = await cur.fetchone()
-            return str(row[0]) if row and row[0] is not None else "0"
-        except Exception:
-            return "0"
+            if not row:
+                return None
+            score = int(_score_buffer.merge_score(tg_id, row[0]) or 0)
 
+            # Общее число пользователей
+            async with db.execute("SELECT COUNT(*) FROM users") as cur:
+                total_row = await cur.fetchone()
+            total = int(total_row[0] or 0) if total_row else 0
 
+            # Место: 1 + количество пользователей с бОльшим счётом
+            async with db.execute(
+                "SELECT COUNT(*) FROM users WHERE score > ?",
+                (score,),
+            ) as cur:
+                higher_row = await cur.fetchone()
+            higher = int(higher_row[0] or 0) if higher_row else 0
 
+        return (higher + 1, total)
 
-    async def get_user_deleted_token(tg_id: int) -> str:
-        db = await get_db()
+    async def get_stats_reset_token() -> str:
         try:
-            async with db.execute(
-                "SELECT token FROM user_deletions WHERE telegram_id = ?",
-                (int(tg_id),),
-            ) as cur:
-                row = await cur.fetchone()
-            return str(row[0]) if row and row[0] is not None else "0"
+            return (await get_client_sync_state(None))["reset_token"]
         except Exception:
             return "0"
 
-    async def get_user_reset_token(tg_id: int) -> str:
-        """Метка сброса статистики конкретного пользователя.
+    async def get_client_sync_state(tg_id: int | None) -> dict:
+        """Состояние для синхронизации WebApp одним запросом.
 
-        Нужна, чтобы WebApp мог очистить localStorage только у одного пользователя,
-        не затрагивая остальных (в отличие от глобального stats_reset_token).
+        Возвращает dict: levels, reset_token, user_exists (None, если tg_id не передан),
+        user (кортеж как в get_user_profile или None), user_deleted_token, user_reset_token.
         """
-        db = await get_db()
-        try:
-            async with db.execute(
-                "SELECT token FROM user_resets WHERE telegram_id = ?",
-                (int(tg_id),),
+        uid = int(tg_id) if tg_id is not None else None
+        # Уровни и reset_token свежие в кеше — в БД идём только за пользователем (или не идём вовсе).
+        if _meta_cache.is_fresh():
+            if uid is None:
+                return _cached_client_sync_state(None, None)
+            async with _read_conn() as db, db.execute(
+                _CLIENT_USER_SQL.format(p1="?", p2="?", p3="?"),
+                (uid, uid, uid),
             ) as cur:
                 row = await cur.fetchone()
-            return str(row[0]) if row and row[0] is not None else "0"
-        except Exception:
-            return "0"
+            return _cached_client_sync_state(uid, row)
 
-    async def _mark_user_reset(tg_id: int) -> str:
-        """Записывает метку сброса статистики пользователя и возвращает token."""
-        db = await get_db()
+        seen_version = _meta_cache.version
+        async with _read_conn() as db, db.execute(
+            _CLIENT_SYNC_SQL.format(p1="?", p2="?", p3="?"),
+            (uid, uid, uid),
+        ) as cur:
+            rows = await cur.fetchall()
+        state = _build_client_sync_state(uid, rows)
+        _meta_cache.fill(state["levels"], state["reset_token"], seen_version=seen_version)
+        return state
+
+    async def _set_stats_reset_token(db: aiosqlite.Connection) -> str:
+        """Обновляет глобальную метку сброса (без commit) и возвращает новый token.
+
+        Важно: используем миллисекунды, чтобы токен менялся даже при быстрых кликах/проверках.
+        """
         token = str(int(time.time() * 1000))
-        # Таблица может отсутствовать в старых БД — создаём лениво.
         await db.execute(
-            "CREATE TABLE IF NOT EXISTS user_resets (telegram_id INTEGER PRIMARY KEY, token TEXT)",
+            "INSERT INTO app_meta (key, value) VALUES ('stats_reset_token', ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (token,),
         )
+        return token
+
+    async def _mark_user_reset(db: aiosqlite.Connection, tg_id: int) -> str:
+        """Записывает метку сброса статистики пользователя (без commit) и возвращает token."""
+        token = str(int(time.time() * 1000))
         await db.execute(
             "INSERT INTO user_resets (telegram_id, token) VALUES (?, ?) "
             "ON CONFLICT(telegram_id) DO UPDATE SET token = excluded.token",
             (int(tg_id), token),
         )
-        await db.commit()
         return token
 
-    async def _mark_user_deleted(tg_id: int) -> str:
-        """Записывает метку удаления пользователя и возвращает token."""
-        db = await get_db()
+    async def _mark_user_deleted(db: aiosqlite.Connection, tg_id: int) -> str:
+        """Записывает метку удаления пользователя (без commit) и возвращает token."""
         token = str(int(time.time() * 1000))
         await db.execute(
             "INSERT INTO user_deletions (telegram_id, token) VALUES (?, ?) "
             "ON CONFLICT(telegram_id) DO UPDATE SET token = excluded.token",
             (int(tg_id), token),
         )
-        await db.commit()
         return token
 
-    async def _clear_user_deleted(tg_id: int) -> None:
-        db = await get_db()
+    async def _clear_user_deleted(db: aiosqlite.Connection, tg_id: int) -> None:
         await db.execute("DELETE FROM user_deletions WHERE telegram_id = ?", (int(tg_id),))
-        await db.commit()
 
     async def reset_all_scores():
-        db = await get_db()
-        # Сбрасываем общие очки и результат профтеста (игра "Что тебе больше подходит").
-        # Иначе после сброса статистики в админке у пользователя может оставаться aptitude_top.
-        await db.execute("UPDATE users SET score = 0, aptitude_top = NULL")
-        # обновляем глобальную метку сброса
-        # Важно: используем миллисекунды, чтобы токен менялся даже при быстрых кликах/проверках.
-        await db.execute(
-            "UPDATE app_meta SET value = ? WHERE key = 'stats_reset_token'",
-            (str(int(time.time() * 1000)),),
-        )
-        await db.commit()
+        await _drop_pending_scores()
+
+        async def _op(db):
+            # Сбрасываем общие очки и результат профтеста (игра "Что тебе больше подходит").
+            # Иначе после сброса статистики в админке у пользователя может оставаться aptitude_top.
+            await db.execute("UPDATE users SET score = 0, aptitude_top = NULL")
+            # обновляем глобальную метку сброса
+            return await _set_stats_reset_token(db)
+
+        reset_token = await _write(_op)
+        _rank_index.reset_all()
+        _after_stats_reset(reset_token)
 
     async def reset_user_scores(tg_id: int) -> None:
         """Сбросить статистику только у одного пользователя.
@@ -405,108 +789,228 @@ if not _using_postgres:
         Это делает поведение *максимально* совместимым со старым WebApp,
         который мог слушать только общий reset_token.
         """
-        db = await get_db()
-        await db.execute(
-            "UPDATE users SET score = 0, aptitude_top = NULL WHERE telegram_id = ?",
-            (int(tg_id),),
-        )
-        # На всякий случай обновим глобальную метку сброса (как в reset_all_scores)
-        # чтобы любые клиенты с устаревшей логикой тоже очистили localStorage.
-        try:
+        await _drop_pending_scores(int(tg_id))
+
+        async def _op(db):
             await db.execute(
-                "UPDATE app_meta SET value = ? WHERE key = 'stats_reset_token'",
-                (str(int(time.time() * 1000)),),
+                "UPDATE users SET score = 0, aptitude_top = NULL WHERE telegram_id = ?",
+                (int(tg_id),),
             )
-        except Exception:
-            pass
-        # Отмечаем сброс для WebApp (очистка localStorage только у этого пользователя)
-        try:
-            await _mark_user_reset(int(tg_id))
-        except Exception:
-            pass
-        await db.commit()
+            # На всякий случай обновим глобальную метку сброса (как в reset_all_scores)
+            # чтобы любые клиенты с устаревшей логикой тоже очистили localStorage.
+            reset_token = None
+            try:
+                reset_token = await _set_stats_reset_token(db)
+            except Exception:
+                pass
+            # Отмечаем сброс для WebApp (очистка localStorage только у этого пользователя)
+            user_reset_token = None
+            try:
+                user_reset_token = await _mark_user_reset(db, int(tg_id))
+            except Exception:
+                pass
+            return reset_token, user_reset_token
+
+        reset_token, user_reset_token = await _write(_op)
+        _rank_index.reset_user(int(tg_id))
+        _after_stats_reset(reset_token)
+        _after_user_reset(int(tg_id), user_reset_token)
 
     async def delete_all_users():
-        db = await get_db()
-        await db.execute("DELETE FROM users")
-        # После удаления всех пользователей обновляем глобальную метку сброса —
-        # так WebApp гарантированно очистит localStorage у всех при следующем входе.
-        try:
-            await db.execute("CREATE TABLE IF NOT EXISTS app_meta (key TEXT PRIMARY KEY, value TEXT)")
-            await db.execute(
-                "INSERT OR IGNORE INTO app_meta(key, value) VALUES('stats_reset_token', '0')"
-            )
-            await db.execute(
-                "UPDATE app_meta SET value = ? WHERE key = 'stats_reset_token'",
-                (str(int(time.time() * 1000)),),
-            )
-        except Exception:
-            pass
-        await db.commit()
+        await _drop_pending_scores()
+
+        async def _op(db):
+            await db.execute("DELETE FROM users")
+            # После удаления всех пользователей обновляем глобальную метку сброса —
+            # так WebApp гарантированно очистит localStorage у всех при следующем входе.
+            try:
+                return await _set_stats_reset_token(db)
+            except Exception:
+                return None
+
+        reset_token = await _write(_op)
+        _rank_index.clear()
+        _after_stats_reset(reset_token)
 
     # Admin helpers
     async def get_all_users(limit: int = 200):
-        db = await get_db()
-        async with db.execute(
+        await _flush_pending_scores()
+        async with _read_conn() as db, db.execute(
             "SELECT telegram_id, first_name, last_name, age, city, score FROM users ORDER BY telegram_id ASC LIMIT ?",
             (limit,),
         ) as cursor:
             return await cursor.fetchall()
 
     async def delete_user(tg_id: int) -> None:
-        # Сначала ставим метку удаления (для WebApp), затем удаляем запись.
-        try:
-            await _mark_user_deleted(int(tg_id))
-        except Exception:
-            pass
-        db = await get_db()
-        await db.execute("DELETE FROM users WHERE telegram_id = ?", (int(tg_id),))
-        # ВАЖНО: делаем так же, как при «Сбросить всю статистику» в админке —
-        # чтобы WebApp гарантированно очистил localStorage при следующем входе.
-        # (Telegram/WebView иногда держит страницу в памяти и иначе «оживляет» очки/рекомендации.)
-        try:
-            await db.execute(
-                "UPDATE app_meta SET value = ? WHERE key = 'stats_reset_token'",
-                (str(int(time.time() * 1000)),),
-            )
-        except Exception:
-            pass
-        await db.commit()
+        await _drop_pending_scores(int(tg_id))
+
+        async def _op(db):
+            # Сначала ставим метку удаления (для WebApp), затем удаляем запись.
+            deleted_token = None
+            try:
+                deleted_token = await _mark_user_deleted(db, int(tg_id))
+            except Exception:
+                pass
+            await db.execute("DELETE FROM users WHERE telegram_id = ?", (int(tg_id),))
+            # ВАЖНО: делаем так же, как при «Сбросить всю статистику» в админке —
+            # чтобы WebApp гарантированно очистил localStorage при следующем входе.
+            # (Telegram/WebView иногда держит страницу в памяти и иначе «оживляет» очки/рекомендации.)
+            reset_token = None
+            try:
+                reset_token = await _set_stats_reset_token(db)
+            except Exception:
+                pass
+            return deleted_token, reset_token
+
+        deleted_token, reset_token = await _write(_op)
+        _rank_index.remove_user(int(tg_id))
+        _after_stats_reset(reset_token)
+        _after_user_deleted(int(tg_id), deleted_token)
 
     async def get_levels():
-        db = await get_db()
-        async with db.execute(
-            "SELECT level_key, is_active FROM levels ORDER BY level_key ASC"
-        ) as cursor:
-            rows = await cursor.fetchall()
-        return {k: bool(v) for (k, v) in rows}
+        # Читается через кеш (см. get_client_sync_state).
+        return (await get_client_sync_state(None))["levels"]
 
     async def set_level_active(level_key: str, is_active: bool) -> None:
-        db = await get_db()
-        await db.execute(
-            "INSERT INTO levels (level_key, is_active) VALUES (?, ?) "
-            "ON CONFLICT(level_key) DO UPDATE SET is_active = excluded.is_active",
-            (level_key, 1 if is_active else 0),
-        )
-        await db.commit()
+        async def _op(db):
+            await db.execute(
+                "INSERT INTO levels (level_key, is_active) VALUES (?, ?) "
+                "ON CONFLICT(level_key) DO UPDATE SET is_active = excluded.is_active",
+                (level_key, 1 if is_active else 0),
+            )
+
+        await _write(_op)
+        _after_level_change(level_key, is_active)
 
     async def update_aptitude_top(tg_id: int, aptitude_top: str | None):
-        db = await get_db()
-        await db.execute(
-            "UPDATE users SET aptitude_top = ? WHERE telegram_id = ?",
-            (aptitude_top, tg_id),
-        )
-        await db.commit()
+        async def _op(db):
+            await db.execute(
+                "UPDATE users SET aptitude_top = ? WHERE telegram_id = ?",
+                (aptitude_top, tg_id),
+            )
+
+        await _write(_op)
 
     async def get_top_users_stats(limit: int = 10):
-        db = await get_db()
-        async with db.execute(
+        await _flush_pending_scores()
+        async with _read_conn() as db, db.execute(
             "SELECT telegram_id, first_name, last_name, city, score, aptitude_top "
-            "FROM users ORDER BY score DESC LIMIT ?",
+            "FROM users ORDER BY score DESC, telegram_id ASC LIMIT ?",
             (limit,),
         ) as cursor:
             return await cursor.fetchall()
 
+    async def get_award_recipients(top: int | None = None, city: str | None = None):
+        """Получатели массовой выдачи сертификатов: (telegram_id, first_name, last_name, score).
+
+        top — первые N по очкам, city — только пользователи из города; без фильтров — все.
+        """
+        await _flush_pending_scores()
+        sql = "SELECT telegram_id, first_name, last_name, score FROM users"
+        args: list = []
+        if city:
+            sql += " WHERE city = ?"
+            args.append(_format_city_name(city))
+        sql += " ORDER BY score DESC, telegram_id ASC"
+        if top:
+            sql += " LIMIT ?"
+            args.append(int(top))
+        async with _read_conn() as db, db.execute(sql, args) as cursor:
+            return await cursor.fetchall()
+
+    async def claim_max_update(update_key: str, ttl: float) -> bool:
+        """Отмечает MAX Update как обработанный. False — такой ключ уже видели за последние ttl секунд."""
+        now = time.time()
+
+        async def _op(db):
+            cur = await db.execute(
+                "INSERT INTO max_update_dedup (update_key, seen_at) VALUES (?, ?) "
+                "ON CONFLICT(update_key) DO UPDATE SET seen_at = excluded.seen_at "
+                "WHERE max_update_dedup.seen_at < ?",
+                (str(update_key), now, now - float(ttl)),
+            )
+            return cur.rowcount
+
+        return bool(await _write(_op))
+
+    async def prune_max_updates(ttl: float) -> None:
+        """Удаляет ключи MAX Update старше ttl секунд."""
+        async def _op(db):
+            await db.execute("DELETE FROM max_update_dedup WHERE seen_at < ?", (time.time() - float(ttl),))
+
+        await _write(_op)
+
+    async def get_max_state(max_user_id: int, ttl: float) -> dict | None:
+        """Состояние регистрации MAX-пользователя; записи старше ttl секунд считаются брошенными."""
+        async with _read_conn() as db, db.execute(
+            "SELECT data FROM max_fsm_state WHERE max_user_id = ? AND updated_at >= ?",
+            (int(max_user_id), time.time() - float(ttl)),
+        ) as cursor:
+            row = await cursor.fetchone()
+        return json.loads(row[0]) if row else None
+
+    async def set_max_state(max_user_id: int, data: dict) -> None:
+        payload = json.dumps(data, ensure_ascii=False)
+
+        async def _op(db):
+            await db.execute(
+                "INSERT INTO max_fsm_state (max_user_id, data, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(max_user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                (int(max_user_id), payload, time.time()),
+            )
+
+        await _write(_op)
+
+    async def delete_max_state(max_user_id: int) -> None:
+        async def _op(db):
+            await db.execute("DELETE FROM max_fsm_state WHERE max_user_id = ?", (int(max_user_id),))
+
+        await _write(_op)
+
+    async def prune_max_states(ttl: float) -> None:
+        """Удаляет состояния регистрации, не менявшиеся дольше ttl секунд."""
+        async def _op(db):
+            await db.execute("DELETE FROM max_fsm_state WHERE updated_at < ?", (time.time() - float(ttl),))
+
+        await _write(_op)
+
+    async def get_fsm_record(storage_key: str, ttl: float) -> tuple[str | None, dict] | None:
+        """(state, data) FSM aiogram по ключу; записи старше ttl секунд считаются устаревшими."""
+        async with _read_conn() as db, db.execute(
+            "SELECT state, data FROM tg_fsm_state WHERE storage_key = ? AND updated_at >= ?",
+            (str(storage_key), time.time() - float(ttl)),
+        ) as cursor:
+            row = await cursor.fetchone()
+        return (row[0], json.loads(row[1])) if row else None
+
+    async def save_fsm_records(records: list[tuple[str, str | None, dict]]) -> None:
+        """Записывает пачку (storage_key, state, data) одной транзакцией; пустые записи удаляются."""
+        now = time.time()
+        upserts = [
+            (str(k), st, json.dumps(data, ensure_ascii=False), now) for k, st, data in records if st is not None or data
+        ]
+        deletes = [(str(k),) for k, st, data in records if st is None and not data]
+
+        async def _op(db):
+            if upserts:
+                await db.executemany(
+                    "INSERT INTO tg_fsm_state (storage_key, state, data, updated_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(storage_key) DO UPDATE SET state = excluded.state, data = excluded.data, "
+                    "updated_at = excluded.updated_at",
+                    upserts,
+                )
+            if deletes:
+                await db.executemany("DELETE FROM tg_fsm_state WHERE storage_key = ?", deletes)
+
+        await _write(_op)
+
+    async def prune_fsm_records(ttl: float) -> None:
+        """Удаляет состояния FSM, не менявшиеся дольше ttl секунд (брошенные регистрации)."""
+        async def _op(db):
+            await db.execute("DELETE FROM tg_fsm_state WHERE updated_at < ?", (time.time() - float(ttl),))
+
+        await _write(_op)
+
 
     async def create_database_backup() -> dict:
         """Создаёт резервную копию SQLite-БД и возвращает сведения о файле.
@@ -514,8 +1018,8 @@ if not _using_postgres:
         Используется SQLite backup API, а не обычное копирование файла: так копия
         корректно создаётся даже при включённом WAL и работающем приложении.
         """
+        await _flush_pending_scores()
         db = await get_db()
-        await db.commit()
 
         backup_dir = _backup_dir()
         ts = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
@@ -524,7 +1028,9 @@ if not _using_postgres:
 
         dest = await aiosqlite.connect(str(backup_path))
         try:
-            await db.backup(dest)
+            # Писатель на паузе: копируем только зафиксированные данные, без его открытой транзакции.
+            async with _writer.paused():
+                await db.backup(dest)
             await dest.commit()
         finally:
             await dest.close()
@@ -549,6 +1055,37 @@ else:
     import certifi
 
     _pool: asyncpg.Pool | None = None
+    _pool_lock = asyncio.Lock()
+
+    # Горячие запросы вынесены в константы: тот же текст SQL использует
+    # _init_connection для прогрева кеша prepared statements asyncpg.
+    _PG_GET_USER_SQL = (
+        "SELECT telegram_id, first_name, last_name, age, city, score FROM users WHERE telegram_id = $1"
+    )
+    _PG_GET_USER_PROFILE_SQL = (
+        "SELECT telegram_id, first_name, last_name, age, city, score, aptitude_top FROM users WHERE telegram_id = $1"
+    )
+    _PG_UPDATE_SCORE_SQL = "UPDATE users SET score = $1 WHERE telegram_id = $2 AND score < $1"
+    _PG_USER_SCORE_SQL = "SELECT score FROM users WHERE telegram_id = $1"
+    _PG_COUNT_USERS_SQL = "SELECT COUNT(*) AS cnt FROM users"
+    _PG_COUNT_HIGHER_SQL = "SELECT COUNT(*) AS cnt FROM users WHERE score > $1"
+    _PG_CLIENT_SYNC_SQL = _CLIENT_SYNC_SQL.format(p1="$1::bigint", p2="$1::bigint", p3="$1::bigint")
+    _PG_CLIENT_USER_SQL = _CLIENT_USER_SQL.format(p1="$1::bigint", p2="$1::bigint", p3="$1::bigint")
+
+    # (sql, аргументы для «холостого» выполнения). Только чтения по первичному ключу:
+    # telegram_id = 0 не бывает, так что это пустой index lookup без блокировок.
+    # Записи и COUNT(*) (полные сканы — их и заменяет индекс рейтинга) здесь не место:
+    # прогрев повторяется на каждом новом соединении пула.
+    _PG_HOT_STATEMENTS = [
+        (_PG_GET_USER_SQL, (0,)),
+        (_PG_GET_USER_PROFILE_SQL, (0,)),
+        (_PG_USER_SCORE_SQL, (0,)),
+        (_PG_CLIENT_USER_SQL, (0,)),
+    ]
+
+    # Размер кеша prepared statements на соединение. За pgbouncer в transaction mode
+    # (например, пулер Supabase на 6543) prepared statements не работают — там нужен 0.
+    _PG_STATEMENT_CACHE_SIZE = env_int("PG_STATEMENT_CACHE_SIZE", 100)
 
     def _parse_sslmode(dsn: str) -> str:
         """Возвращает sslmode из DSN (как в libpq) либо пустую строку."""
@@ -585,10 +1122,35 @@ else:
 
         return None
 
+    async def _init_connection(conn) -> None:
+        """Прогревает кеш prepared statements нового соединения горячими запросами.
+
+        asyncpg кеширует подготовленный запрос по тексту SQL, поэтому одно холостое
+        выполнение избавляет первый реальный запрос на этом соединении от Parse/Describe.
+        conn.prepare() тут не подходит: он создаёт отдельный prepared statement в обход
+        этого кеша, и fetch() всё равно подготовил бы запрос заново.
+        Ошибки не критичны (например, таблиц ещё нет до миграций) — запрос подготовится при первом вызове.
+        """
+        if _PG_STATEMENT_CACHE_SIZE <= 0:
+            return
+        for sql, args in _PG_HOT_STATEMENTS:
+            try:
+                await conn.fetch(sql, *args)
+            except Exception as e:
+                logging.getLogger(__name__).debug("PG statement warm-up failed: %s", e)
+
     async def get_db() -> asyncpg.Pool:
         global _pool
-        if _pool is None:
+        if _pool is not None:
+            return _pool
+        # Lock: при старте несколько корутин одновременно приходят сюда,
+        # и без него каждая создала бы свой пул (лишние соединения к пулеру).
+        async with _pool_lock:
+            if _pool is not None:
+                return _pool
             ssl_ctx = _make_ssl_ctx(DATABASE_URL)
+            min_size = max(0, env_int("PG_POOL_MIN_SIZE", 2))
+            max_size = max(1, min_size, env_int("PG_POOL_MAX_SIZE", 10))
 
             # На некоторых хостингах/сетях соединение с пулером Postgres может "зависать" надолго.
             # Чтобы админка/бот не висели бесконечно, ограничиваем время создания пула.
@@ -597,10 +1159,13 @@ else:
                     asyncpg.create_pool(
                         dsn=DATABASE_URL,
                         ssl=ssl_ctx,
-                        min_size=1,
-                        max_size=5,
+                        min_size=min_size,
+                        max_size=max_size,
+                        max_inactive_connection_lifetime=env_float("PG_POOL_MAX_INACTIVE_LIFETIME", 300.0),
+                        statement_cache_size=_PG_STATEMENT_CACHE_SIZE,
+                        init=_init_connection,
                     ),
-                    timeout=12,
+                    timeout=env_float("PG_POOL_CONNECT_TIMEOUT", 12.0),
                 )
             except asyncio.TimeoutError as e:
                 raise RuntimeError("Timeout connecting to PostgreSQL (create_pool)") from e
@@ -612,61 +1177,144 @@ else:
             await _pool.close()
             _pool = None
 
+    # -------------------------
+    # Миграции схемы (PostgreSQL)
+    # -------------------------
+    # Каждая миграция применяется ровно один раз, номер сохраняется в schema_version.
+    # Runtime-функции DDL не выполняют (DDL берёт catalog-локи) — всё создаётся здесь при старте.
+
+    # Ключ advisory-лока: несколько процессов, стартующих одновременно, мигрируют по очереди.
+    _MIGRATIONS_LOCK_KEY = 7_310_001
+
+    async def _migration_1_base(conn) -> None:
+        await conn.execute(
+            '''
+            CREATE TABLE IF NOT EXISTS users (
+                telegram_id BIGINT PRIMARY KEY,
+                first_name TEXT,
+                last_name TEXT,
+                age INTEGER,
+                city TEXT,
+                score INTEGER DEFAULT 0,
+                aptitude_top TEXT,
+                pd_consent BOOLEAN DEFAULT FALSE,
+                pd_consent_at TEXT
+            );
+            '''
+        )
+        # Старые базы могли быть созданы без части колонок.
+        await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS city TEXT")
+        await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS aptitude_top TEXT")
+        await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS pd_consent BOOLEAN DEFAULT FALSE")
+        await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS pd_consent_at TEXT")
+
+        await conn.execute(
+            '''
+            CREATE TABLE IF NOT EXISTS levels (
+                level_key TEXT PRIMARY KEY,
+                is_active BOOLEAN NOT NULL DEFAULT TRUE
+            );
+            '''
+        )
+
+        # Глобальная "метка сброса" (нужна, чтобы WebApp мог понять, что админ сбросил статистику,
+        # и очистить localStorage со старыми очками/рекомендациями).
+        await conn.execute(
+            '''
+            CREATE TABLE IF NOT EXISTS app_meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+            '''
+        )
+        await conn.execute(
+            "INSERT INTO app_meta(key, value) VALUES('stats_reset_token', '0') ON CONFLICT (key) DO NOTHING"
+        )
+
+        # Раньше создавалась лениво при первом чтении метки удаления.
+        await conn.execute(
+            "CREATE TABLE IF NOT EXISTS user_deletions (telegram_id BIGINT PRIMARY KEY, token TEXT);"
+        )
+
+    async def _migration_2_user_resets(conn) -> None:
+        # Раньше таблица создавалась лениво в _mark_user_reset / при чтении метки сброса.
+        await conn.execute(
+            "CREATE TABLE IF NOT EXISTS user_resets (telegram_id BIGINT PRIMARY KEY, token TEXT);"
+        )
+
+    async def _migration_3_users_indexes(conn) -> None:
+        # Составной индекс (score DESC, telegram_id) покрывает и сортировку рейтинга,
+        # и условия по score (COUNT(*) WHERE score > $1), поэтому отдельный индекс по score не нужен.
+        await conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_users_score_tid ON users (score DESC, telegram_id)"
+        )
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_city ON users (city)")
+
+    async def _migration_4_max_update_dedup(conn) -> None:
+        # Ключи уже обработанных MAX Update (защита от повторной доставки webhook).
+        await conn.execute(
+            "CREATE TABLE IF NOT EXISTS max_update_dedup (update_key TEXT PRIMARY KEY, seen_at DOUBLE PRECISION NOT NULL);"
+        )
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_max_update_dedup_seen ON max_update_dedup (seen_at)")
+
+    async def _migration_5_max_fsm_state(conn) -> None:
+        # Состояние регистрации в MAX-боте (раньше — dict в памяти процесса).
+        await conn.execute(
+            "CREATE TABLE IF NOT EXISTS max_fsm_state (max_user_id BIGINT PRIMARY KEY, data TEXT NOT NULL, updated_at DOUBLE PRECISION NOT NULL);"
+        )
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_max_fsm_state_updated ON max_fsm_state (updated_at)")
+
+    async def _migration_6_tg_fsm_state(conn) -> None:
+        # Состояние FSM aiogram (RegState / AdminState), см. DbFSMStorage.
+        await conn.execute(
+            "CREATE TABLE IF NOT EXISTS tg_fsm_state (storage_key TEXT PRIMARY KEY, state TEXT, data TEXT NOT NULL, updated_at DOUBLE PRECISION NOT NULL);"
+        )
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_tg_fsm_state_updated ON tg_fsm_state (updated_at)")
+
+    async def _migration_7_users_score_not_null(conn) -> None:
+        # У старых строк score мог остаться NULL: «score < $1» такие строки никогда не обновляет,
+        # а индекс рейтинга считает их нулём. Приводим к 0, чтобы БД и индекс не расходились.
+        await conn.execute("UPDATE users SET score = 0 WHERE score IS NULL")
+
+    _MIGRATIONS = [
+        (1, _migration_1_base),
+        (2, _migration_2_user_resets),
+        (3, _migration_3_users_indexes),
+        (4, _migration_4_max_update_dedup),
+        (5, _migration_5_max_fsm_state),
+        (6, _migration_6_tg_fsm_state),
+        (7, _migration_7_users_score_not_null),
+    ]
+
+    async def _apply_migrations(conn) -> int:
+        """Применяет недостающие миграции по порядку и возвращает итоговую версию схемы.
+
+        DDL в PostgreSQL транзакционный, поэтому все недостающие миграции применяются
+        в одной транзакции под advisory-локом: либо все, либо ни одной.
+        """
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", _MIGRATIONS_LOCK_KEY)
+            exists = await conn.fetchval("SELECT to_regclass('public.schema_version')::text")
+            if not exists:
+                await conn.execute(
+                    "CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, applied_at TEXT);"
+                )
+            current = int(await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_version"))
+            for version, migration in _MIGRATIONS:
+                if version <= current:
+                    continue
+                await migration(conn)
+                await conn.execute(
+                    "INSERT INTO schema_version (version, applied_at) VALUES ($1, $2)",
+                    version, time.strftime("%Y-%m-%d %H:%M:%S"),
+                )
+                current = version
+        return current
+
     async def create_table():
         pool = await get_db()
         async with pool.acquire() as conn:
-            await conn.execute(
-                '''
-                CREATE TABLE IF NOT EXISTS users (
-                    telegram_id BIGINT PRIMARY KEY,
-                    first_name TEXT,
-                    last_name TEXT,
-                    age INTEGER,
-                    city TEXT,
-                    score INTEGER DEFAULT 0,
-                    aptitude_top TEXT,
-                    pd_consent BOOLEAN DEFAULT FALSE,
-                    pd_consent_at TEXT
-                );
-                '''
-            )
-            # Миграция: старые базы могли быть без city.
-            try:
-                await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS city TEXT")
-            except Exception:
-                pass
-            try:
-                await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS pd_consent BOOLEAN DEFAULT FALSE")
-            except Exception:
-                pass
-            try:
-                await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS pd_consent_at TEXT")
-            except Exception:
-                pass
-
-            await conn.execute(
-                '''
-                CREATE TABLE IF NOT EXISTS levels (
-                    level_key TEXT PRIMARY KEY,
-                    is_active BOOLEAN NOT NULL DEFAULT TRUE
-                );
-                '''
-            )
-
-            
-            # Глобальная "метка сброса" (нужна, чтобы WebApp мог понять, что админ сбросил статистику,
-            # и очистить localStorage со старыми очками/рекомендациями).
-            await conn.execute(
-                '''
-                CREATE TABLE IF NOT EXISTS app_meta (
-                    key TEXT PRIMARY KEY,
-                    value TEXT
-                );
-                '''
-            )
-            await conn.execute(
-                "INSERT INTO app_meta(key, value) VALUES('stats_reset_token', '0') ON CONFLICT (key) DO NOTHING"
-            )
+            await _apply_migrations(conn)
 
             default_levels = [
                 "puzzle-2x2",
@@ -685,6 +1333,27 @@ else:
                     key,
                 )
 
+        # Прогреваем индекс рейтинга. Если не получилось — загрузится лениво в get_user_rank.
+        try:
+            await _load_rank_index()
+        except Exception:
+            pass
+
+    async def _load_rank_index() -> None:
+        """Загружает in-memory индекс рейтинга из БД (один раз на процесс)."""
+        async with _rank_index_lock:
+            if _rank_index.loaded:
+                return
+            _rank_index.begin_load()
+            try:
+                pool = await get_db()
+                async with pool.acquire() as conn:
+                    rows = await conn.fetch("SELECT telegram_id, COALESCE(score, 0) AS score FROM users")
+            except Exception:
+                _rank_index.abort_load()
+                raise
+            _rank_index.load((r["telegram_id"], r["score"]) for r in rows)
+
     async def register_user(tg_id, f_name, l_name, age, city=None, pd_consent: bool = False):
         f_name = _format_person_name(f_name)
         l_name = _format_person_name(l_name)
@@ -705,46 +1374,60 @@ else:
                 await conn.execute("DELETE FROM user_deletions WHERE telegram_id = $1", int(tg_id))
             except Exception:
                 pass
-
+        _rank_index.add_user(int(tg_id), 0)
 
     async def update_score(tg_id, new_score):
+        if _score_buffer.enabled:
+            await _buffer_score(int(tg_id), int(new_score))
+            return
+        pool = await get_db()
+        async with pool.acquire() as conn:
+            await conn.execute(_PG_UPDATE_SCORE_SQL, int(new_score), int(tg_id))
+        _rank_index.bump_score(int(tg_id), int(new_score))
+
+    async def _write_score_batch(items: list[tuple[int, int]]) -> None:
+        """Пакетная запись из буфера очков: один UPDATE ... FROM UNNEST (одна транзакция).
+
+        items отсортированы по telegram_id — несколько процессов блокируют строки
+        в одном порядке и не ловят deadlock.
+        """
         pool = await get_db()
         async with pool.acquire() as conn:
             await conn.execute(
-                "UPDATE users SET score = $1 WHERE telegram_id = $2 AND score < $1",
-                int(new_score), int(tg_id),
+                "UPDATE users AS u SET score = v.score "
+                "FROM UNNEST($1::bigint[], $2::integer[]) AS v(telegram_id, score) "
+                "WHERE u.telegram_id = v.telegram_id AND u.score < v.score",
+                [tg_id for tg_id, _ in items],
+                [score for _, score in items],
             )
 
     async def get_top_users():
+        await _flush_pending_scores()
         pool = await get_db()
         async with pool.acquire() as conn:
             rows = await conn.fetch(
-                "SELECT first_name, last_name, score FROM users ORDER BY score DESC LIMIT 10"
+                "SELECT first_name, last_name, score FROM users ORDER BY score DESC, telegram_id ASC LIMIT 10"
             )
         return [(r["first_name"], r["last_name"], r["score"]) for r in rows]
 
     async def get_user(tg_id: int):
         pool = await get_db()
         async with pool.acquire() as conn:
-            row = await conn.fetchrow(
-                "SELECT telegram_id, first_name, last_name, age, city, score FROM users WHERE telegram_id = $1",
-                int(tg_id),
-            )
+            row = await conn.fetchrow(_PG_GET_USER_SQL, int(tg_id))
         if row is None:
             return None
-        return (row["telegram_id"], row["first_name"], row["last_name"], row["age"], row["city"], row["score"])
+        return _with_pending_score(
+            (row["telegram_id"], row["first_name"], row["last_name"], row["age"], row["city"], row["score"])
+        )
 
     async def get_user_profile(tg_id: int):
         """Расширенные данные пользователя для webapp (в т.ч. результат профтеста)."""
         pool = await get_db()
         async with pool.acquire() as conn:
-            row = await conn.fetchrow(
-                "SELECT telegram_id, first_name, last_name, age, city, score, aptitude_top FROM users WHERE telegram_id = $1",
-                int(tg_id),
-            )
+            row = await conn.fetchrow(_PG_GET_USER_PROFILE_SQL, int(tg_id))
         if row is None:
             return None
-        return (
+        return _with_pending_score((
             row["telegram_id"],
             row["first_name"],
             row["last_name"],
@@ -752,7 +1435,7 @@ else:
             row["city"],
             row["score"],
             row.get("aptitude_top"),
-        )
+        ))
 
     async def get_user_rank(tg_id: int):
         """Возвращает место пользователя в рейтинге по очкам.
@@ -763,93 +1446,76 @@ else:
         Returns:
             tuple(rank:int, total:int) или None, если пользователя нет.
         """
+        # Быстрый путь: in-memory индекс (O(log n) без запросов к БД).
+        if not _rank_index.loaded:
+            try:
+                await _load_rank_index()
+            except Exception:
+                pass
+        if _rank_index.loaded:
+            return _rank_index.rank(int(tg_id))
+
         pool = await get_db()
         async with pool.acquire() as conn:
-            score_row = await conn.fetchrow(
-                "SELECT score FROM users WHERE telegram_id = $1",
-                int(tg_id),
-            )
+            score_row = await conn.fetchrow(_PG_USER_SCORE_SQL, int(tg_id))
             if score_row is None:
                 return None
-            score = int(score_row["score"] or 0)
+            score = int(_score_buffer.merge_score(tg_id, score_row["score"]) or 0)
 
-            total_row = await conn.fetchrow("SELECT COUNT(*) AS cnt FROM users")
+            total_row = await conn.fetchrow(_PG_COUNT_USERS_SQL)
             total = int(total_row["cnt"] or 0) if total_row else 0
 
-            higher_row = await conn.fetchrow(
-                "SELECT COUNT(*) AS cnt FROM users WHERE score > $1",
-                score,
-            )
+            higher_row = await conn.fetchrow(_PG_COUNT_HIGHER_SQL, score)
             higher = int(higher_row["cnt"] or 0) if higher_row else 0
 
         return (higher + 1, total)
 
     async def get_stats_reset_token() -> str:
-        pool = await get_db()
-        async with pool.acquire() as conn:
-            # На старых БД таблицы app_meta может не быть. Делаем функцию устойчивой,
-            # чтобы админка не падала 500-ой.
-            try:
-                row = await conn.fetchrow("SELECT value FROM app_meta WHERE key = 'stats_reset_token'")
-            except Exception:
-                await conn.execute(
-                    "CREATE TABLE IF NOT EXISTS app_meta (key TEXT PRIMARY KEY, value TEXT);"
-                )
-                await conn.execute(
-                    "INSERT INTO app_meta(key, value) VALUES('stats_reset_token', '0') ON CONFLICT (key) DO NOTHING"
-                )
-                row = await conn.fetchrow("SELECT value FROM app_meta WHERE key = 'stats_reset_token'")
-        return str(row["value"]) if row and row["value"] is not None else "0"
-
+        # Не роняем админку 500-ой, если БД недоступна.
+        try:
+            return (await get_client_sync_state(None))["reset_token"]
+        except Exception:
+            return "0"
 
+    async def get_client_sync_state(tg_id: int | None) -> dict:
+        """Состояние для синхронизации WebApp одним запросом (PostgreSQL).
 
-    async def get_user_deleted_token(tg_id: int) -> str:
+        Возвращает dict: levels, reset_token, user_exists (None, если tg_id не передан),
+        user (кортеж как в get_user_profile или None), user_deleted_token, user_reset_token.
+        """
+        uid = int(tg_id) if tg_id is not None else None
+        # Уровни и reset_token свежие в кеше — в БД идём только за пользователем (или не идём вовсе).
+        if _meta_cache.is_fresh():
+            if uid is None:
+                return _cached_client_sync_state(None, None)
+            pool = await get_db()
+            async with pool.acquire() as conn:
+                row = await conn.fetchrow(_PG_CLIENT_USER_SQL, uid)
+            return _cached_client_sync_state(uid, tuple(row.values()) if row else None)
+
+        seen_version = _meta_cache.version
         pool = await get_db()
         async with pool.acquire() as conn:
-            try:
-                row = await conn.fetchrow(
-                    "SELECT token FROM user_deletions WHERE telegram_id = $1",
-                    int(tg_id),
-                )
-            except Exception:
-                # Если таблицы ещё нет (старые БД) — создадим на лету.
-                await conn.execute(
-                    "CREATE TABLE IF NOT EXISTS user_deletions (telegram_id BIGINT PRIMARY KEY, token TEXT);"
-                )
-                row = await conn.fetchrow(
-                    "SELECT token FROM user_deletions WHERE telegram_id = $1",
-                    int(tg_id),
-                )
-        return str(row["token"]) if row and row["token"] is not None else "0"
+            rows = await conn.fetch(_PG_CLIENT_SYNC_SQL, uid)
+        state = _build_client_sync_state(uid, [tuple(r.values()) for r in rows])
+        _meta_cache.fill(state["levels"], state["reset_token"], seen_version=seen_version)
+        return state
 
-    async def get_user_reset_token(tg_id: int) -> str:
-        """Метка сброса статистики конкретного пользователя (PostgreSQL)."""
-        pool = await get_db()
-        async with pool.acquire() as conn:
-            try:
-                row = await conn.fetchrow(
-                    "SELECT token FROM user_resets WHERE telegram_id = $1",
-                    int(tg_id),
-                )
-            except Exception:
-                # Старые БД: таблицы ещё может не быть.
-                await conn.execute(
-                    "CREATE TABLE IF NOT EXISTS user_resets (telegram_id BIGINT PRIMARY KEY, token TEXT);"
-                )
-                row = await conn.fetchrow(
-                    "SELECT token FROM user_resets WHERE telegram_id = $1",
-                    int(tg_id),
-                )
-        return str(row["token"]) if row and row["token"] is not None else "0"
+    async def _set_stats_reset_token(conn) -> str:
+        """Обновляет глобальную метку сброса и возвращает новый token."""
+        token = str(int(time.time() * 1000))
+        await conn.execute(
+            "INSERT INTO app_meta (key, value) VALUES ('stats_reset_token', $1) "
+            "ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value",
+            token,
+        )
+        return token
 
     async def _mark_user_reset(tg_id: int) -> str:
         """Записывает метку сброса статистики пользователя и возвращает token."""
         pool = await get_db()
         token = str(int(time.time() * 1000))
         async with pool.acquire() as conn:
-            await conn.execute(
-                "CREATE TABLE IF NOT EXISTS user_resets (telegram_id BIGINT PRIMARY KEY, token TEXT);"
-            )
             await conn.execute(
                 "INSERT INTO user_resets(telegram_id, token) VALUES($1, $2) "
                 "ON CONFLICT (telegram_id) DO UPDATE SET token = EXCLUDED.token",
@@ -874,20 +1540,13 @@ else:
             await conn.execute("DELETE FROM user_deletions WHERE telegram_id = $1", int(tg_id))
 
     async def reset_all_scores():
+        await _drop_pending_scores()
         pool = await get_db()
         async with pool.acquire() as conn:
             await conn.execute("UPDATE users SET score = 0, aptitude_top = NULL")
-            # Таблица app_meta может отсутствовать (если проект обновляли поверх старой БД)
-            await conn.execute(
-                "CREATE TABLE IF NOT EXISTS app_meta (key TEXT PRIMARY KEY, value TEXT);"
-            )
-            await conn.execute(
-                "INSERT INTO app_meta(key, value) VALUES('stats_reset_token', '0') ON CONFLICT (key) DO NOTHING"
-            )
-            await conn.execute(
-                "UPDATE app_meta SET value = $1 WHERE key = 'stats_reset_token'",
-                str(int(time.time() * 1000)),
-            )
+            reset_token = await _set_stats_reset_token(conn)
+        _rank_index.reset_all()
+        _after_stats_reset(reset_token)
 
     async def reset_user_scores(tg_id: int) -> None:
         """Сбросить статистику только у одного пользователя (PostgreSQL).
@@ -899,6 +1558,7 @@ else:
         Дополнительно обновляем stats_reset_token в app_meta для совместимости
         со старыми клиентами, которые могли слушать только общий reset_token.
         """
+        await _drop_pending_scores(int(tg_id))
         pool = await get_db()
         async with pool.acquire() as conn:
             await conn.execute(
@@ -907,42 +1567,32 @@ else:
             )
             # Совместимость: обновим глобальную метку сброса так же, как в reset_all_scores.
             try:
-                await conn.execute(
-                    "CREATE TABLE IF NOT EXISTS app_meta (key TEXT PRIMARY KEY, value TEXT);"
-                )
-                await conn.execute(
-                    "INSERT INTO app_meta(key, value) VALUES('stats_reset_token', '0') ON CONFLICT (key) DO NOTHING"
-                )
-                await conn.execute(
-                    "UPDATE app_meta SET value = $1 WHERE key = 'stats_reset_token'",
-                    str(int(time.time() * 1000)),
-                )
+                reset_token = await _set_stats_reset_token(conn)
             except Exception:
-                pass
+                reset_token = None
+        _rank_index.reset_user(int(tg_id))
+        _after_stats_reset(reset_token)
         # Отмечаем сброс для WebApp (очистка localStorage только у этого пользователя)
         try:
-            await _mark_user_reset(int(tg_id))
+            _after_user_reset(int(tg_id), await _mark_user_reset(int(tg_id)))
         except Exception:
             pass
 
     async def delete_all_users():
+        await _drop_pending_scores()
         pool = await get_db()
         async with pool.acquire() as conn:
             await conn.execute("DELETE FROM users")
             # Обновляем глобальную метку сброса статистики, чтобы WebApp очистил localStorage у всех
             try:
-                await conn.execute("CREATE TABLE IF NOT EXISTS app_meta (key TEXT PRIMARY KEY, value TEXT);")
-                await conn.execute(
-                    "INSERT INTO app_meta(key, value) VALUES('stats_reset_token', '0') ON CONFLICT (key) DO NOTHING"
-                )
-                await conn.execute(
-                    "UPDATE app_meta SET value = $1 WHERE key = 'stats_reset_token'",
-                    str(int(time.time() * 1000)),
-                )
+                reset_token = await _set_stats_reset_token(conn)
             except Exception:
-                pass
+                reset_token = None
+        _rank_index.clear()
+        _after_stats_reset(reset_token)
 
     async def get_all_users(limit: int = 200):
+        await _flush_pending_scores()
         pool = await get_db()
         async with pool.acquire() as conn:
             rows = await conn.fetch(
@@ -953,9 +1603,11 @@ else:
         return [(r["telegram_id"], r["first_name"], r["last_name"], r["age"], r["city"], r["score"]) for r in rows]
 
     async def delete_user(tg_id: int) -> None:
+        await _drop_pending_scores(int(tg_id))
         # Сначала ставим метку удаления (для WebApp), затем удаляем запись.
+        deleted_token = None
         try:
-            await _mark_user_deleted(int(tg_id))
+            deleted_token = await _mark_user_deleted(int(tg_id))
         except Exception:
             pass
         pool = await get_db()
@@ -964,24 +1616,16 @@ else:
             # ВАЖНО: делаем так же, как при «Сбросить всю статистику» в админке —
             # чтобы WebApp гарантированно очистил localStorage при следующем входе.
             try:
-                await conn.execute(
-                    "CREATE TABLE IF NOT EXISTS app_meta (key TEXT PRIMARY KEY, value TEXT);"
-                )
-                await conn.execute(
-                    "INSERT INTO app_meta(key, value) VALUES('stats_reset_token', '0') ON CONFLICT (key) DO NOTHING"
-                )
-                await conn.execute(
-                    "UPDATE app_meta SET value = $1 WHERE key = 'stats_reset_token'",
-                    str(int(time.time() * 1000)),
-                )
+                reset_token = await _set_stats_reset_token(conn)
             except Exception:
-                pass
+                reset_token = None
+        _rank_index.remove_user(int(tg_id))
+        _after_stats_reset(reset_token)
+        _after_user_deleted(int(tg_id), deleted_token)
 
     async def get_levels():
-        pool = await get_db()
-        async with pool.acquire() as conn:
-            rows = await conn.fetch("SELECT level_key, is_active FROM levels ORDER BY level_key ASC")
-        return {r["level_key"]: bool(r["is_active"]) for r in rows}
+        # Читается через кеш (см. get_client_sync_state).
+        return (await get_client_sync_state(None))["levels"]
 
     async def set_level_active(level_key: str, is_active: bool) -> None:
         pool = await get_db()
@@ -991,6 +1635,7 @@ else:
                 "ON CONFLICT (level_key) DO UPDATE SET is_active = EXCLUDED.is_active",
                 level_key, bool(is_active),
             )
+        _after_level_change(level_key, is_active)
 
     async def update_aptitude_top(tg_id: int, aptitude_top: str | None):
         pool = await get_db()
@@ -1002,6 +1647,7 @@ else:
 
     async def create_database_backup() -> dict:
         """Создаёт SQL-дамп основных таблиц PostgreSQL без внешней утилиты pg_dump."""
+        await _flush_pending_scores()
         backup_dir = _backup_dir()
         ts = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
         filename = f"factory_backup_postgresql_{ts}.sql"
@@ -1064,14 +1710,117 @@ else:
         }
 
     async def get_top_users_stats(limit: int = 10):
+        await _flush_pending_scores()
         pool = await get_db()
         async with pool.acquire() as conn:
             rows = await conn.fetch(
                 "SELECT telegram_id, first_name, last_name, city, score, aptitude_top "
-                "FROM users ORDER BY score DESC LIMIT $1",
+                "FROM users ORDER BY score DESC, telegram_id ASC LIMIT $1",
                 int(limit),
             )
         return [
             (r["telegram_id"], r["first_name"], r["last_name"], r["city"], r["score"], r["aptitude_top"])
             for r in rows
         ]
+
+    async def get_award_recipients(top: int | None = None, city: str | None = None):
+        """Получатели массовой выдачи сертификатов (PostgreSQL): (telegram_id, first_name, last_name, score)."""
+        await _flush_pending_scores()
+        sql = "SELECT telegram_id, first_name, last_name, score FROM users"
+        args: list = []
+        if city:
+            args.append(_format_city_name(city))
+            sql += f" WHERE city = ${len(args)}"
+        sql += " ORDER BY score DESC, telegram_id ASC"
+        if top:
+            args.append(int(top))
+            sql += f" LIMIT ${len(args)}"
+        pool = await get_db()
+        async with pool.acquire() as conn:
+            rows = await conn.fetch(sql, *args)
+        return [(r["telegram_id"], r["first_name"], r["last_name"], r["score"]) for r in rows]
+
+    async def claim_max_update(update_key: str, ttl: float) -> bool:
+        """Отмечает MAX Update как обработанный (PostgreSQL). False — ключ уже видели за последние ttl секунд."""
+        now = time.time()
+        pool = await get_db()
+        async with pool.acquire() as conn:
+            row = await conn.fetchval(
+                "INSERT INTO max_update_dedup (update_key, seen_at) VALUES ($1, $2) "
+                "ON CONFLICT (update_key) DO UPDATE SET seen_at = EXCLUDED.seen_at "
+                "WHERE max_update_dedup.seen_at < $3 RETURNING 1",
+                str(update_key), now, now - float(ttl),
+            )
+        return row is not None
+
+    async def prune_max_updates(ttl: float) -> None:
+        """Удаляет ключи MAX Update старше ttl секунд (PostgreSQL)."""
+        pool = await get_db()
+        async with pool.acquire() as conn:
+            await conn.execute("DELETE FROM max_update_dedup WHERE seen_at < $1", time.time() - float(ttl))
+
+    async def get_max_state(max_user_id: int, ttl: float) -> dict | None:
+        """Состояние регистрации MAX-пользователя (PostgreSQL); записи старше ttl секунд не возвращаются."""
+        pool = await get_db()
+        async with pool.acquire() as conn:
+            raw = await conn.fetchval(
+                "SELECT data FROM max_fsm_state WHERE max_user_id = $1 AND updated_at >= $2",
+                int(max_user_id), time.time() - float(ttl),
+            )
+        return json.loads(raw) if raw else None
+
+    async def set_max_state(max_user_id: int, data: dict) -> None:
+        pool = await get_db()
+        async with pool.acquire() as conn:
+            await conn.execute(
+                "INSERT INTO max_fsm_state (max_user_id, data, updated_at) VALUES ($1, $2, $3) "
+                "ON CONFLICT (max_user_id) DO UPDATE SET data = EXCLUDED.data, updated_at = EXCLUDED.updated_at",
+                int(max_user_id), json.dumps(data, ensure_ascii=False), time.time(),
+            )
+
+    async def delete_max_state(max_user_id: int) -> None:
+        pool = await get_db()
+        async with pool.acquire() as conn:
+            await conn.execute("DELETE FROM max_fsm_state WHERE max_user_id = $1", int(max_user_id))
+
+    async def prune_max_states(ttl: float) -> None:
+        """Удаляет состояния регистрации, не менявшиеся дольше ttl секунд (PostgreSQL)."""
+        pool = await get_db()
+        async with pool.acquire() as conn:
+            await conn.execute("DELETE FROM max_fsm_state WHERE updated_at < $1", time.time() - float(ttl))
+
+    async def get_fsm_record(storage_key: str, ttl: float) -> tuple[str | None, dict] | None:
+        """(state, data) FSM aiogram по ключу (PostgreSQL); записи старше ttl секунд не возвращаются."""
+        pool = await get_db()
+        async with pool.acquire() as conn:
+            row = await conn.fetchrow(
+                "SELECT state, data FROM tg_fsm_state WHERE storage_key = $1 AND updated_at >= $2",
+                str(storage_key), time.time() - float(ttl),
+            )
+        return (row["state"], json.loads(row["data"])) if row else None
+
+    async def save_fsm_records(records: list[tuple[str, str | None, dict]]) -> None:
+        """Записывает пачку (storage_key, state, data) одной транзакцией (PostgreSQL); пустые записи удаляются."""
+        now = time.time()
+        upserts = [
+            (str(k), st, json.dumps(data, ensure_ascii=False), now) for k, st, data in records if st is not None or data
+        ]
+        deletes = [(str(k),) for k, st, data in records if st is None and not data]
+        pool = await get_db()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                if upserts:
+                    await conn.executemany(
+                        "INSERT INTO tg_fsm_state (storage_key, state, data, updated_at) VALUES ($1, $2, $3, $4) "
+                        "ON CONFLICT (storage_key) DO UPDATE SET state = EXCLUDED.state, data = EXCLUDED.data, "
+                        "updated_at = EXCLUDED.updated_at",
+                        upserts,
+                    )
+                if deletes:
+                    await conn.executemany("DELETE FROM tg_fsm_state WHERE storage_key = $1", deletes)
+
+    async def prune_fsm_records(ttl: float) -> None:
+        """Удаляет состояния FSM, не менявшиеся дольше ttl секунд (PostgreSQL)."""
+        pool = await get_db()
+        async with pool.acquire() as conn:
+            await conn.execute("DELETE FROM tg_fsm_state WHERE updated_at < $1", time.time() - float(ttl))
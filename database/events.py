@@ -0,0 +1,68 @@
+import asyncio
+
+from env_utils import env_int
+
+
+class Subscription:
+    """Подписка одного клиента: очередь событий + telegram_id (или None)."""
+
+    def __init__(self, uid: int | None, maxsize: int) -> None:
+        self.uid = uid
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        # Клиент не успевал читать и часть событий потеряна — ему нужно перечитать состояние.
+        self.overflowed = False
+        self.closed = False
+
+    async def get(self):
+        return await self.queue.get()
+
+
+class EventBroadcaster:
+    """In-process рассылка событий админки подписчикам SSE (/api/events).
+
+    Глобальные события (uid=None) получают все подписчики, пользовательские —
+    только подписчики с тем же uid. Рассылка работает в пределах одного процесса:
+    события, произошедшие в другом процессе, клиент подхватит обычным опросом /api/levels.
+    """
+
+    def __init__(self, max_subscribers: int = 2000, queue_size: int = 32) -> None:
+        self.max_subscribers = max_subscribers
+        self.queue_size = queue_size
+        self._subs: set[Subscription] = set()
+
+    def __len__(self) -> int:
+        return len(self._subs)
+
+    def subscribe(self, uid: int | None) -> Subscription | None:
+        """Возвращает подписку или None, если достигнут лимит подписчиков."""
+        if len(self._subs) >= self.max_subscribers:
+            return None
+        sub = Subscription(uid, self.queue_size)
+        self._subs.add(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscription) -> None:
+        self._subs.discard(sub)
+
+    def publish(self, event: dict, uid: int | None = None) -> None:
+        """Отправляет событие: всем (uid=None) или подписчикам конкретного пользователя."""
+        for sub in list(self._subs):
+            if uid is not None and sub.uid != int(uid):
+                continue
+            try:
+                sub.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                sub.overflowed = True
+
+    def close_all(self) -> None:
+        """Завершает все подписки (при остановке сервера)."""
+        for sub in list(self._subs):
+            sub.closed = True
+            try:
+                sub.queue.put_nowait(None)
+            except asyncio.QueueFull:
+                pass
+        self._subs.clear()
+
+
+broadcaster = EventBroadcaster(max_subscribers=env_int("SSE_MAX_CLIENTS", 2000))
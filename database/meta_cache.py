@@ -0,0 +1,73 @@
+import time
+
+
+class MetaCache:
+    """Process-local кеш уровней и глобальной метки сброса статистики.
+
+    Данные меняются только из админки, а читаются на каждый опрос /api/levels.
+    Функции записи в db.py обновляют кеш сразу после записи в БД (write-through),
+    а раз в ttl секунд кеш перечитывается из БД — так несколько процессов
+    со временем сходятся к одному состоянию.
+
+    version монотонно растёт при каждом реальном изменении содержимого.
+    """
+
+    def __init__(self, ttl: float) -> None:
+        self.ttl = float(ttl)
+        self.version = 0
+        self.levels: dict[str, bool] | None = None
+        self.reset_token: str | None = None
+        self._loaded_at = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    def is_fresh(self) -> bool:
+        if not self.enabled or self.levels is None or self.reset_token is None:
+            return False
+        return (time.monotonic() - self._loaded_at) < self.ttl
+
+    def fill(self, levels: dict[str, bool], reset_token: str, *, seen_version: int | None = None) -> None:
+        """Заполняет кеш данными, прочитанными из БД.
+
+        seen_version — версия кеша на момент начала чтения. Если за время запроса
+        кеш успели обновить write-through, прочитанные данные уже устарели — не перетираем.
+        """
+        if seen_version is not None and seen_version != self.version:
+            return
+        levels = dict(levels)
+        reset_token = str(reset_token)
+        if levels != self.levels or reset_token != self.reset_token:
+            self.version += 1
+        self.levels = levels
+        self.reset_token = reset_token
+        self._loaded_at = time.monotonic()
+
+    # Запись при незаполненном кеше всё равно сдвигает version: так чтение из БД,
+    # начатое до записи, не зальёт в кеш устаревшие данные (см. fill).
+
+    def set_level(self, level_key: str, is_active: bool) -> None:
+        if self.levels is None:
+            self.version += 1
+            return
+        if self.levels.get(level_key) is bool(is_active):
+            return
+        self.levels = {**self.levels, level_key: bool(is_active)}
+        self.version += 1
+
+    def set_reset_token(self, token: str | None) -> None:
+        if token is None:
+            return
+        if self.reset_token is None:
+            self.version += 1
+            return
+        if self.reset_token == str(token):
+            return
+        self.reset_token = str(token)
+        self.version += 1
+
+    def invalidate(self) -> None:
+        self.levels = None
+        self.reset_token = None
+        self.version += 1
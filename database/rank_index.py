@@ -0,0 +1,189 @@
+import bisect
+
+
+class ScoreRankIndex:
+    """In-process индекс рейтинга: место пользователя по очкам за O(log n).
+
+    Внутри — дерево Фенвика по сжатым координатам (отсортированный список
+    различных значений score) + словарь telegram_id -> score.
+    Значение, у которого не осталось пользователей, удаляется из _counts, а его
+    позиция в дереве остаётся пустой (ей может снова воспользоваться тот же score);
+    когда пустых позиций больше половины, координаты пересобираются — размер
+    индекса следует за числом живых значений, а не за всеми когда-либо встреченными.
+
+    Семантика совпадает с SQL-вариантом get_user_rank:
+    место = 1 + число пользователей с очками строго больше.
+
+    Индекс живёт в памяти одного процесса. Пока он не загружен (load),
+    все изменения игнорируются, а вызывающий код должен идти в БД.
+    Изменения, пришедшие во время загрузки, откладываются и применяются после неё,
+    чтобы не потерять апдейты, попавшие между SELECT и load().
+    """
+
+    def __init__(self) -> None:
+        self.loaded = False
+        self._loading = False
+        self._pending: list[tuple] = []
+        self._scores: dict[int, int] = {}
+        self._counts: dict[int, int] = {}
+        self._keys: list[int] = []
+        self._pos: dict[int, int] = {}
+        self._tree: list[int] = [0]
+        # Позиции в _keys, у которых не осталось пользователей.
+        self._dead = 0
+
+    # -------------------------
+    # Fenwick tree
+    # -------------------------
+
+    def _rebuild(self) -> None:
+        self._keys = sorted(self._counts.keys())
+        self._pos = {k: i + 1 for i, k in enumerate(self._keys)}
+        n = len(self._keys)
+        tree = [0] * (n + 1)
+        for k, cnt in self._counts.items():
+            tree[self._pos[k]] += cnt
+        # Построение дерева за O(n)
+        for i in range(1, n + 1):
+            j = i + (i & -i)
+            if j <= n:
+                tree[j] += tree[i]
+        self._tree = tree
+        self._dead = 0
+
+    def _add(self, score: int, delta: int) -> None:
+        count = self._counts.get(score, 0) + delta
+        if count:
+            self._counts[score] = count
+        else:
+            self._counts.pop(score, None)
+        i = self._pos.get(score)
+        if i is None:
+            # Новое значение очков — пересобираем координаты (O(D), D = число различных score).
+            self._rebuild()
+            return
+        if count == 0:
+            self._dead += 1
+        elif count == delta:
+            # Пустая позиция снова занята.
+            self._dead -= 1
+        if self._dead * 2 > len(self._keys):
+            self._rebuild()
+            return
+        n = len(self._tree) - 1
+        while i <= n:
+            self._tree[i] += delta
+            i += i & -i
+
+    def _prefix(self, i: int) -> int:
+        s = 0
+        while i > 0:
+            s += self._tree[i]
+            i -= i & -i
+        return s
+
+    # -------------------------
+    # Загрузка
+    # -------------------------
+
+    def begin_load(self) -> None:
+        self._loading = True
+        self._pending = []
+
+    def load(self, rows) -> None:
+        """Заполняет индекс из пар (telegram_id, score) и применяет отложенные изменения."""
+        self._scores = {int(uid): int(score or 0) for (uid, score) in rows}
+        self._counts = {}
+        for score in self._scores.values():
+            self._counts[score] = self._counts.get(score, 0) + 1
+        self._rebuild()
+        self.loaded = True
+        self._loading = False
+        pending, self._pending = self._pending, []
+        for op, args in pending:
+            getattr(self, op)(*args)
+
+    def abort_load(self) -> None:
+        self._loading = False
+        self._pending = []
+
+    def _defer(self, op: str, *args) -> bool:
+        """True, если операцию нужно пропустить (индекс ещё не готов)."""
+        if self.loaded:
+            return False
+        if self._loading:
+            self._pending.append((op, args))
+        return True
+
+    # -------------------------
+    # Изменения (зеркалят запросы в БД)
+    # -------------------------
+
+    def add_user(self, tg_id: int, score: int = 0) -> None:
+        """INSERT ... DO NOTHING: добавляет пользователя, если его ещё нет."""
+        if self._defer("add_user", tg_id, score):
+            return
+        tg_id = int(tg_id)
+        if tg_id in self._scores:
+            return
+        self._scores[tg_id] = int(score or 0)
+        self._add(int(score or 0), 1)
+
+    def bump_score(self, tg_id: int, new_score: int) -> None:
+        """UPDATE ... SET score = new WHERE score < new."""
+        if self._defer("bump_score", tg_id, new_score):
+            return
+        tg_id = int(tg_id)
+        old = self._scores.get(tg_id)
+        new_score = int(new_score)
+        if old is None or old >= new_score:
+            return
+        self._scores[tg_id] = new_score
+        self._add(old, -1)
+        self._add(new_score, 1)
+
+    def reset_user(self, tg_id: int) -> None:
+        if self._defer("reset_user", tg_id):
+            return
+        tg_id = int(tg_id)
+        old = self._scores.get(tg_id)
+        if old is None or old == 0:
+            return
+        self._scores[tg_id] = 0
+        self._add(old, -1)
+        self._add(0, 1)
+
+    def reset_all(self) -> None:
+        if self._defer("reset_all"):
+            return
+        self._scores = {uid: 0 for uid in self._scores}
+        self._counts = {0: len(self._scores)} if self._scores else {}
+        self._rebuild()
+
+    def remove_user(self, tg_id: int) -> None:
+        if self._defer("remove_user", tg_id):
+            return
+        old = self._scores.pop(int(tg_id), None)
+        if old is not None:
+            self._add(old, -1)
+
+    def clear(self) -> None:
+        if self._defer("clear"):
+            return
+        self._scores = {}
+        self._counts = {}
+        self._rebuild()
+
+    # -------------------------
+    # Запросы
+    # -------------------------
+
+    def rank(self, tg_id: int):
+        """Возвращает (rank, total) или None, если пользователя нет в индексе."""
+        score = self._scores.get(int(tg_id))
+        if score is None:
+            return None
+        total = len(self._scores)
+        i = bisect.bisect_right(self._keys, score)
+        higher = total - self._prefix(i)
+        return (higher + 1, total)
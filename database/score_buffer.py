@@ -0,0 +1,59 @@
+class ScoreBuffer:
+    """Write-behind буфер очков: telegram_id -> максимальный ещё не записанный score.
+
+    update_score в БД и так пишет только «score < new», поэтому из нескольких
+    отправок одного пользователя достаточно сохранить максимум — порядок не важен.
+    Буфер живёт в памяти процесса; сброс в БД (flush) выполняет db.py одним
+    пакетным UPDATE в одной транзакции.
+
+    max_size — порог числа пользователей в буфере, после которого flush не ждёт таймера.
+    interval <= 0 выключает буфер: update_score пишет в БД сразу, как раньше.
+    """
+
+    def __init__(self, interval: float, max_size: int) -> None:
+        self.interval = float(interval)
+        self.max_size = max(1, int(max_size))
+        self._pending: dict[int, int] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.interval > 0
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def is_full(self) -> bool:
+        return len(self._pending) >= self.max_size
+
+    def add(self, tg_id: int, score: int) -> None:
+        tg_id = int(tg_id)
+        score = int(score)
+        old = self._pending.get(tg_id)
+        if old is None or score > old:
+            self._pending[tg_id] = score
+
+    def get(self, tg_id: int) -> int | None:
+        return self._pending.get(int(tg_id))
+
+    def merge_score(self, tg_id: int, score):
+        """Очки пользователя с учётом буфера (read-through для get_user и т.п.)."""
+        pending = self._pending.get(int(tg_id))
+        if pending is None:
+            return score
+        return max(int(score or 0), pending)
+
+    def drain(self) -> list[tuple[int, int]]:
+        """Забирает всё накопленное: список (telegram_id, score)."""
+        items, self._pending = list(self._pending.items()), {}
+        return items
+
+    def restore(self, items) -> None:
+        """Возвращает неудачно записанную пачку обратно (с учётом новых отправок)."""
+        for tg_id, score in items:
+            self.add(tg_id, score)
+
+    def discard(self, tg_id: int) -> None:
+        self._pending.pop(int(tg_id), None)
+
+    def clear(self) -> None:
+        self._pending = {}
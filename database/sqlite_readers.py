@@ -0,0 +1,60 @@
+import asyncio
+import contextlib
+from pathlib import Path
+
+import aiosqlite  # type: ignore
+
+
+class ReaderPool:
+    """Пул read-only соединений SQLite для SELECT.
+
+    У каждого соединения aiosqlite свой поток, поэтому чтения из пула идут
+    параллельно друг с другом и не стоят в очереди за записями единственного
+    писателя. В режиме WAL читатель видит последнее зафиксированное состояние.
+
+    Соединения открываются лениво (до size штук) с mode=ro и query_only.
+    """
+
+    def __init__(self, path: str, size: int) -> None:
+        self.path = path
+        self.size = max(1, int(size))
+        self._idle: asyncio.Queue | None = None
+        self._all: list[aiosqlite.Connection] = []
+        self._opening = 0
+
+    async def _open(self) -> aiosqlite.Connection:
+        uri = Path(self.path).resolve().as_uri() + "?mode=ro"
+        conn = await aiosqlite.connect(uri, uri=True)
+        await conn.execute("PRAGMA query_only=ON;")
+        return conn
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+        try:
+            conn = self._idle.get_nowait()
+        except asyncio.QueueEmpty:
+            if len(self._all) + self._opening < self.size:
+                self._opening += 1
+                try:
+                    conn = await self._open()
+                finally:
+                    self._opening -= 1
+                self._all.append(conn)
+            else:
+                conn = await self._idle.get()
+        try:
+            yield conn
+        finally:
+            if conn in self._all:
+                self._idle.put_nowait(conn)
+
+    async def close(self) -> None:
+        conns, self._all = self._all, []
+        self._idle = None
+        for conn in conns:
+            try:
+                await conn.close()
+            except Exception:
+                pass
@@ -0,0 +1,131 @@
+import asyncio
+
+
+_STOP = object()
+
+
+class GroupCommitWriter:
+    """Единственный писатель SQLite с групповым commit.
+
+    Функции записи не делают commit сами: они передают операцию (async-функцию
+    от соединения) в submit(). Фоновая задача забирает операции из очереди,
+    выполняет пачку в одной транзакции и делает один commit на всю пачку —
+    каждые max_batch операций или через max_delay секунд после первой.
+    Вызывающий получает результат операции только после commit.
+
+    Каждая операция выполняется внутри SAVEPOINT: ошибка одной операции
+    откатывает только её, остальные операции пачки фиксируются.
+
+    Все commit на соединении должны идти через писателя: для кода, которому
+    нужно соединение «без чужой транзакции» (миграции, бэкап), есть paused().
+    """
+
+    def __init__(self, get_conn, max_batch: int = 64, max_delay: float = 0.005) -> None:
+        self._get_conn = get_conn
+        self.max_batch = max(1, int(max_batch))
+        self.max_delay = max(0.0, float(max_delay))
+        self._queue: asyncio.Queue | None = None
+        self._task: asyncio.Task | None = None
+        # Держится на время выполнения пачки и внутри paused().
+        self._lock = asyncio.Lock()
+
+    def _ensure_started(self) -> None:
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+
+    async def submit(self, op):
+        """Выполняет op(conn) в ближайшей групповой транзакции и возвращает её результат."""
+        self._ensure_started()
+        fut = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((op, fut))
+        return await fut
+
+    def paused(self):
+        """Контекст, в котором писатель не выполняет пачки (миграции, backup)."""
+        return self._lock
+
+    async def _collect(self) -> tuple[list, bool]:
+        """Набирает пачку; второй элемент — встретился ли сигнал остановки."""
+        batch = []
+        item = await self._queue.get()
+        if item is _STOP:
+            return batch, True
+        batch.append(item)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_delay
+        while len(batch) < self.max_batch:
+            try:
+                item = self._queue.get_nowait()
+            except asyncio.QueueEmpty:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    async def _run(self) -> None:
+        while True:
+            batch, stop = await self._collect()
+            if batch:
+                async with self._lock:
+                    await self._apply(batch)
+            if stop:
+                return
+
+    async def _apply(self, batch: list) -> None:
+        results = []
+        try:
+            conn = await self._get_conn()
+            await conn.execute("BEGIN")
+        except Exception as e:
+            for _op, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+
+        try:
+            for op, fut in batch:
+                await conn.execute("SAVEPOINT group_op")
+                try:
+                    result = await op(conn)
+                except Exception as e:
+                    await conn.execute("ROLLBACK TO SAVEPOINT group_op")
+                    await conn.execute("RELEASE SAVEPOINT group_op")
+                    results.append((fut, False, e))
+                    continue
+                await conn.execute("RELEASE SAVEPOINT group_op")
+                results.append((fut, True, result))
+            await conn.commit()
+        except Exception as e:
+            try:
+                await conn.rollback()
+            except Exception:
+                pass
+            # Пачка не зафиксирована целиком — ошибка у всех, в том числе у ещё не выполненных.
+            for _op, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+
+        for fut, ok, value in results:
+            if fut.done():
+                continue
+            if ok:
+                fut.set_result(value)
+            else:
+                fut.set_exception(value)
+
+    async def close(self) -> None:
+        """Дописывает уже поставленные операции и останавливает фоновую задачу."""
+        task, self._task = self._task, None
+        if task is None or task.done():
+            return
+        self._queue.put_nowait(_STOP)
+        await task
@@ -0,0 +1,17 @@
+import os
+
+
+def env_int(name: str, default: int) -> int:
+    """Целое из переменной окружения; пустое или нечисловое значение — default."""
+    try:
+        return int((os.getenv(name) or "").strip() or default)
+    except Exception:
+        return default
+
+
+def env_float(name: str, default: float) -> float:
+    """Число из переменной окружения; пустое или нечисловое значение — default."""
+    try:
+        return float((os.getenv(name) or "").strip() or default)
+    except Exception:
+        return default
@@ -0,0 +1,151 @@
+import asyncio
+import copy
+import logging
+import time
+from typing import Any, Mapping
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+from ttl_cache import TTLCache
+
+
+def _key_str(key: StorageKey) -> str:
+    return ":".join(
+        str(part) if part is not None else ""
+        for part in (key.bot_id, key.chat_id, key.user_id, key.thread_id, key.business_connection_id, key.destiny)
+    )
+
+
+class DbFSMStorage(BaseStorage):
+    """FSM-хранилище aiogram в общей БД (таблица tg_fsm_state через database.db).
+
+    Изменения state/data сначала попадают в локальный буфер и записываются в БД
+    пачкой раз в flush_interval секунд или при flush_max изменённых ключах —
+    шаги регистрации разных пользователей идут одной транзакцией. Пока изменение
+    не записано (в том числе пока идёт сама запись пачки — _inflight), чтение отдаёт
+    его из буфера; записанные записи кешируются на cache_ttl секунд (короткий TTL —
+    чтобы несколько процессов не расходились надолго).
+
+    Записи, не менявшиеся дольше ttl секунд (брошенные регистрации), при чтении
+    считаются пустыми и раз в ttl удаляются из таблицы.
+    """
+
+    def __init__(
+        self,
+        db,
+        *,
+        ttl: float = 24 * 3600,
+        flush_interval: float = 0.5,
+        flush_max: int = 100,
+        cache_size: int = 10000,
+        cache_ttl: float = 5.0,
+    ) -> None:
+        self.db = db
+        self.ttl = float(ttl)
+        self.flush_interval = max(0.0, float(flush_interval))
+        self.flush_max = max(1, int(flush_max))
+        self._cache = TTLCache(cache_size, cache_ttl) if cache_ttl > 0 else None
+        self._dirty: dict[str, tuple[str | None, dict]] = {}
+        self._inflight: dict[str, tuple[str | None, dict]] = {}
+        self._flush_lock = asyncio.Lock()
+        self._flush_task: asyncio.Task | None = None
+        self._pruned_at = time.monotonic()
+
+    async def _load(self, key: StorageKey) -> tuple[str | None, dict]:
+        skey = _key_str(key)
+        record = self._pending(skey)
+        if record is None and self._cache is not None:
+            record = self._cache.get(skey)
+        if record is None:
+            record = await self.db.get_fsm_record(skey, self.ttl) or (None, {})
+            # Пока читали, запись могли изменить — буфер важнее прочитанного.
+            pending = self._pending(skey)
+            if pending is not None:
+                record = pending
+            elif self._cache is not None:
+                self._cache.set(skey, record)
+        return record
+
+    def _pending(self, skey: str) -> tuple[str | None, dict] | None:
+        """Незаписанное в БД изменение: новое из буфера или из пачки, которая пишется сейчас."""
+        record = self._dirty.get(skey)
+        if record is None:
+            record = self._inflight.get(skey)
+        return record
+
+    async def _store(self, key: StorageKey, state: str | None, data: dict) -> None:
+        self._dirty[_key_str(key)] = (state, data)
+        if len(self._dirty) >= self.flush_max or self.flush_interval <= 0:
+            await self.flush()
+        elif self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        # Крутимся, пока в буфере есть изменения: новые могли прийти во время записи,
+        # а при ошибке БД пачка вернулась в буфер и будет записана на следующем тике.
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.getLogger(__name__).warning("FSM storage flush failed: %s", e)
+            if not self._dirty:
+                return
+
+    async def flush(self) -> int:
+        """Записывает буфер изменений в БД одной транзакцией и возвращает размер пачки."""
+        async with self._flush_lock:
+            batch, self._dirty = self._dirty, {}
+            if batch:
+                # До commit пачка остаётся видна чтению через _inflight.
+                self._inflight = batch
+                try:
+                    await self.db.save_fsm_records([(k, st, data) for k, (st, data) in batch.items()])
+                except BaseException:
+                    # Возвращаем в буфер то, что не успели перезаписать новыми изменениями
+                    # (в том числе при отмене фонового flush во время close()).
+                    self._dirty = {**batch, **self._dirty}
+                    raise
+                finally:
+                    self._inflight = {}
+                if self._cache is not None:
+                    for skey, record in batch.items():
+                        if skey not in self._dirty:
+                            self._cache.set(skey, record)
+            if time.monotonic() - self._pruned_at >= self.ttl:
+                self._pruned_at = time.monotonic()
+                try:
+                    await self.db.prune_fsm_records(self.ttl)
+                except Exception as e:
+                    logging.getLogger(__name__).warning("FSM storage prune failed: %s", e)
+            return len(batch)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        _, data = await self._load(key)
+        await self._store(key, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        state, _ = await self._load(key)
+        return state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        state, _ = await self._load(key)
+        await self._store(key, state, copy.deepcopy(dict(data)))
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        _, data = await self._load(key)
+        return copy.deepcopy(data)
+
+    async def close(self) -> None:
+        task, self._flush_task = self._flush_task, None
+        if task is not None and not task.done():
+            task.cancel()
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+        try:
+            await self.flush()
+        except Exception:
+            logging.getLogger(__name__).exception("FSM storage: не удалось записать буфер при остановке")
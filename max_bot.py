@@ -333,6 +333,43 @@ def _extract_start_token(update: dict) -> str:
     return ""
 
 
+def update_user_id(update: dict) -> int | None:
+    """MAX user_id автора update (для очерёдности обработки по пользователю)."""
+    utype = update.get("update_type")
+    if utype == "message_created":
+        user = ((update.get("message") or {}).get("sender")) or {}
+    elif utype == "message_callback":
+        user = (update.get("callback") or {}).get("user") or update.get("user") or {}
+    else:
+        user = update.get("user") or {}
+    try:
+        return int(user.get("user_id"))
+    except Exception:
+        return None
+
+
+def update_dedup_key(update: dict) -> str | None:
+    """Ключ для отсева повторных доставок одного и того же update.
+
+    Сообщение определяется его mid, нажатие кнопки — callback_id; у остальных
+    событий (bot_started и т.п.) своего id нет — берём пользователя и timestamp.
+    None — ключ построить не из чего, такой update не отсеивается.
+    """
+    utype = str(update.get("update_type") or "")
+    if utype == "message_created":
+        mid = ((update.get("message") or {}).get("body") or {}).get("mid")
+        if mid:
+            return f"{utype}:{mid}"
+    if utype == "message_callback":
+        callback_id = (update.get("callback") or {}).get("callback_id") or update.get("callback_id")
+        if callback_id:
+            return f"{utype}:{callback_id}"
+    timestamp = update.get("timestamp")
+    if timestamp is None:
+        return None
+    return f"{utype}:{update_user_id(update)}:{timestamp}"
+
+
 async def handle_update(app, update: dict) -> None:
     """Единая обработка MAX Update (webhook)."""
     token = (app.get("max_token") or "").strip()
@@ -340,7 +377,8 @@ async def handle_update(app, update: dict) -> None:
         return
 
     session: aiohttp.ClientSession = app["max_session"]
-    state: dict = app["max_state"]
+    # Хранилище шагов регистрации (см. max_state): get() отдаёт копию, изменения сохраняются через set().
+    state = app["max_state"]
 
     utype = update.get("update_type")
 
@@ -368,11 +406,11 @@ async def handle_update(app, update: dict) -> None:
                 text=f"С возвращением, {fname}! Нажми кнопку ниже, чтобы начать испытание.",
                 attachments=kb,
             )
-            state.pop(str(max_user_id), None)
+            await state.delete(int(max_user_id))
             return
 
         if start_token == "privacy_accept":
-            state[str(max_user_id)] = {"step": "waiting_for_fullname", "pd_consent": True}
+            await state.set(int(max_user_id), {"step": "waiting_for_fullname", "pd_consent": True})
             await send_message(
                 session,
                 token,
@@ -405,7 +443,7 @@ async def handle_update(app, update: dict) -> None:
             ),
             attachments=_pd_consent_keyboard(),
         )
-        state[str(max_user_id)] = {"step": "waiting_for_consent"}
+        await state.set(int(max_user_id), {"step": "waiting_for_consent"})
         return
 
     # message_callback
@@ -427,7 +465,7 @@ async def handle_update(app, update: dict) -> None:
             return
 
         if str(payload) == "pd_consent_accept":
-            state[str(max_user_id)] = {"step": "waiting_for_fullname", "pd_consent": True}
+            await state.set(int(max_user_id), {"step": "waiting_for_fullname", "pd_consent": True})
             try:
                 await answer_callback(session, token, callback_id=str(callback_id), message={"text": "Согласие принято"})
             except Exception:
@@ -476,21 +514,21 @@ async def handle_update(app, update: dict) -> None:
             if not ADMIN_PASSWORD:
                 await send_message(session, token, user_id=int(max_user_id), text="Пароль администратора не настроен")
                 return
-            state[str(max_user_id)] = {"step": "waiting_for_admin_password"}
+            await state.set(int(max_user_id), {"step": "waiting_for_admin_password"})
             await send_message(session, token, user_id=int(max_user_id), text="Введите пароль администратора")
             return
 
         # FSM регистрация / админ-пароль
-        st = state.get(str(max_user_id))
+        st = await state.get(int(max_user_id))
 
         if st and st.get("step") == "waiting_for_admin_password":
             if not _is_admin(_max_to_db_id(int(max_user_id))):
-                state.pop(str(max_user_id), None)
+                await state.delete(int(max_user_id))
                 await send_message(session, token, user_id=int(max_user_id), text="Нет доступа")
                 return
 
             if _secure_password_equals(text):
-                state.pop(str(max_user_id), None)
+                await state.delete(int(max_user_id))
                 admin_entry = _admin_entry_url(int(max_user_id))
                 if not admin_entry:
                     await send_message(session, token, user_id=int(max_user_id), text="Админ-панель не настроена (ADMIN_URL/WEBAPP_URL).")
@@ -536,6 +574,7 @@ async def handle_update(app, update: dict) -> None:
             st["first_name"] = _format_person_name(parts[0])
             st["last_name"] = _format_person_name(" ".join(parts[1:]))
             st["step"] = "waiting_for_age"
+            await state.set(int(max_user_id), st)
             await send_message(session, token, user_id=int(max_user_id), text="Сколько вам лет?")
             return
 
@@ -552,6 +591,7 @@ async def handle_update(app, update: dict) -> None:
 
             st["age"] = age
             st["step"] = "waiting_for_city"
+            await state.set(int(max_user_id), st)
             await send_message(session, token, user_id=int(max_user_id), text="Укажите ваш город проживания.")
             return
 
@@ -579,7 +619,7 @@ async def handle_update(app, update: dict) -> None:
                 city,
                 pd_consent=bool(st.get("pd_consent")),
             )
-            state.pop(str(max_user_id), None)
+            await state.delete(int(max_user_id))
 
             kb = _inline_keyboard([
                 [_factory_open_app_button()]
@@ -0,0 +1,64 @@
+import logging
+import time
+
+from ttl_cache import TTLCache
+
+
+class UpdateDeduplicator:
+    """Отсев повторных доставок MAX Update.
+
+    Первый уровень — TTLCache в памяти процесса: webhook проверяет ключ за O(1)
+    и отвечает 200, не ставя дубль в очередь. Ключ запоминается только после того,
+    как update принят в очередь (отказ по переполнению MAX должен повторить).
+
+    Второй уровень (claim/prune — функции БД, опционально) нужен, когда процессов
+    несколько и повтор может прийти в соседний: воркер перед обработкой «занимает»
+    ключ в общей таблице. Ошибка БД не блокирует обработку — лучше редкий дубль,
+    чем потерянный update.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, claim=None, prune=None) -> None:
+        self.ttl = float(ttl)
+        self._seen = TTLCache(maxsize, ttl)
+        self._claim = claim
+        self._prune = prune
+        self._pruned_at = time.monotonic()
+        self.duplicates = 0
+        self.db_duplicates = 0
+        self.db_errors = 0
+
+    def is_duplicate(self, key: str | None) -> bool:
+        if key is None or key not in self._seen:
+            return False
+        self.duplicates += 1
+        return True
+
+    def remember(self, key: str | None) -> None:
+        if key is not None:
+            self._seen.set(key, True)
+
+    async def claim(self, key: str | None) -> bool:
+        """True — update нужно обработать; False — его уже обработал другой процесс."""
+        if key is None or self._claim is None:
+            return True
+        try:
+            if time.monotonic() - self._pruned_at >= self.ttl and self._prune is not None:
+                self._pruned_at = time.monotonic()
+                await self._prune(self.ttl)
+            if await self._claim(key, self.ttl):
+                return True
+        except Exception as e:
+            self.db_errors += 1
+            logging.getLogger(__name__).warning("MAX update dedup DB error: %s", e)
+            return True
+        self.db_duplicates += 1
+        return False
+
+    def metrics(self) -> dict:
+        return {
+            "cached_keys": len(self._seen),
+            "duplicates": self.duplicates,
+            "db_enabled": self._claim is not None,
+            "db_duplicates": self.db_duplicates,
+            "db_errors": self.db_errors,
+        }
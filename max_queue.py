@@ -0,0 +1,137 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+
+class MaxUpdateQueue:
+    """Очередь входящих MAX Update: webhook только кладёт в неё update и сразу отвечает 200.
+
+    Обработку ведут workers корутин. Update одного пользователя (key) выполняются строго
+    по очереди — шаги регистрации не перемешиваются, — а разные пользователи идут параллельно.
+    В очереди ключей (_ready) каждый пользователь стоит не больше одного раза: пока его
+    update обрабатывается, новые копятся в его deque; после каждого update ключ уходит
+    в конец очереди, чтобы один активный пользователь не занимал воркер надолго.
+
+    Глубина ограничена maxsize: при переполнении submit() возвращает False (webhook
+    отвечает 503, и MAX доставит update позже), отказ учитывается в метриках.
+    """
+
+    def __init__(self, handler, workers: int = 4, maxsize: int = 1000) -> None:
+        self.handler = handler
+        self.workers = max(1, int(workers))
+        self.maxsize = max(1, int(maxsize))
+        self._pending: dict = {}
+        self._ready: asyncio.Queue | None = None
+        self._tasks: list[asyncio.Task] = []
+        self._depth = 0
+        self._idle: asyncio.Event | None = None
+        self.enqueued = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.max_depth = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._handle_total = 0.0
+        self._handle_max = 0.0
+
+    @property
+    def depth(self) -> int:
+        return self._depth
+
+    def start(self) -> None:
+        if self._tasks:
+            return
+        self._ready = asyncio.Queue()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def submit(self, update: dict, key=None) -> bool:
+        """Ставит update в очередь пользователя key. False — очередь заполнена (или не запущена)."""
+        if self._ready is None or self._depth >= self.maxsize:
+            self.rejected += 1
+            return False
+        if key is None:
+            # Без пользователя порядок не важен: отдельный ключ на каждый update.
+            key = object()
+        items = self._pending.get(key)
+        if items is None:
+            items = self._pending[key] = deque()
+            self._ready.put_nowait(key)
+        items.append((update, time.monotonic()))
+        self._depth += 1
+        self.enqueued += 1
+        self.max_depth = max(self.max_depth, self._depth)
+        self._idle.clear()
+        return True
+
+    async def _worker(self) -> None:
+        log = logging.getLogger(__name__)
+        while True:
+            key = await self._ready.get()
+            items = self._pending.get(key)
+            if not items:
+                self._pending.pop(key, None)
+                continue
+            update, queued_at = items.popleft()
+            started = time.monotonic()
+            wait = started - queued_at
+            self._wait_total += wait
+            self._wait_max = max(self._wait_max, wait)
+            try:
+                await self.handler(update)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed += 1
+                log.exception("MAX update handler error: %s", e)
+            else:
+                self.processed += 1
+            finally:
+                spent = time.monotonic() - started
+                self._handle_total += spent
+                self._handle_max = max(self._handle_max, spent)
+                self._depth -= 1
+                if items:
+                    self._ready.put_nowait(key)
+                else:
+                    self._pending.pop(key, None)
+                if self._depth == 0:
+                    self._idle.set()
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """Дожидается обработки уже принятых update (не дольше timeout) и останавливает воркеры."""
+        if not self._tasks:
+            return
+        if self._depth:
+            try:
+                await asyncio.wait_for(self._idle.wait(), timeout=max(0.0, float(timeout)))
+            except asyncio.TimeoutError:
+                logging.getLogger(__name__).warning("MAX queue stopped with %s unprocessed updates", self._depth)
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._ready = None
+        self._pending.clear()
+        self._depth = 0
+
+    def metrics(self) -> dict:
+        done = self.processed + self.failed
+        return {
+            "workers": self.workers,
+            "depth": self._depth,
+            "max_depth": self.max_depth,
+            "maxsize": self.maxsize,
+            "users_pending": len(self._pending),
+            "enqueued": self.enqueued,
+            "processed": self.processed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "wait_avg_ms": round(self._wait_total / done * 1000, 1) if done else 0.0,
+            "wait_max_ms": round(self._wait_max * 1000, 1),
+            "handle_avg_ms": round(self._handle_total / done * 1000, 1) if done else 0.0,
+            "handle_max_ms": round(self._handle_max * 1000, 1),
+        }
@@ -0,0 +1,98 @@
+import copy
+import logging
+import time
+
+from ttl_cache import TTLCache
+
+
+class MemoryStateStore:
+    """Состояние регистрации MAX-пользователей в памяти процесса (LRU + TTL).
+
+    Брошенные на середине регистрации записи исчезают через ttl секунд,
+    число записей ограничено maxsize. Подходит для одного процесса: после
+    перезапуска состояние теряется.
+    """
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        self._cache = TTLCache(maxsize, ttl)
+
+    async def get(self, max_user_id: int) -> dict | None:
+        data = self._cache.get(int(max_user_id))
+        # Отдаём копию: изменения попадают в хранилище только через set().
+        return copy.deepcopy(data) if data is not None else None
+
+    async def set(self, max_user_id: int, data: dict) -> None:
+        self._cache.set(int(max_user_id), copy.deepcopy(data))
+
+    async def delete(self, max_user_id: int) -> None:
+        self._cache.pop(int(max_user_id))
+
+    async def close(self) -> None:
+        self._cache.clear()
+
+
+class DbStateStore:
+    """Состояние регистрации MAX-пользователей в БД (таблица max_fsm_state), общее для процессов.
+
+    db — объект с функциями get_max_state / set_max_state / delete_max_state / prune_max_states
+    (модуль database.db). Запись идёт в БД сразу (write-through), чтение — через локальный
+    TTLCache на cache_ttl секунд: шаги одного пользователя обычно попадают в один процесс,
+    а короткий TTL ограничивает время, на которое соседний процесс может увидеть устаревший шаг.
+    Записи старше ttl секунд считаются брошенными и раз в ttl удаляются из таблицы.
+    """
+
+    def __init__(self, db, ttl: float, cache_size: int = 10000, cache_ttl: float = 5.0) -> None:
+        self.db = db
+        self.ttl = float(ttl)
+        self._cache = TTLCache(cache_size, cache_ttl) if cache_ttl > 0 else None
+        self._pruned_at = time.monotonic()
+
+    async def _maybe_prune(self) -> None:
+        if time.monotonic() - self._pruned_at < self.ttl:
+            return
+        self._pruned_at = time.monotonic()
+        try:
+            await self.db.prune_max_states(self.ttl)
+        except Exception as e:
+            logging.getLogger(__name__).warning("MAX state prune failed: %s", e)
+
+    async def get(self, max_user_id: int) -> dict | None:
+        key = int(max_user_id)
+        if self._cache is not None:
+            # В кеше храним и «состояния нет» (пустой dict), чтобы не ходить в БД на каждое сообщение.
+            data = self._cache.get(key)
+            if data is not None:
+                return copy.deepcopy(data) or None
+        data = await self.db.get_max_state(key, self.ttl)
+        if self._cache is not None:
+            self._cache.set(key, data or {})
+        return copy.deepcopy(data) if data else None
+
+    async def set(self, max_user_id: int, data: dict) -> None:
+        key = int(max_user_id)
+        await self.db.set_max_state(key, data)
+        if self._cache is not None:
+            self._cache.set(key, copy.deepcopy(data))
+        await self._maybe_prune()
+
+    async def delete(self, max_user_id: int) -> None:
+        key = int(max_user_id)
+        await self.db.delete_max_state(key)
+        if self._cache is not None:
+            self._cache.set(key, {})
+
+    async def close(self) -> None:
+        if self._cache is not None:
+            self._cache.clear()
+
+
+def create_state_store(kind: str, *, ttl: float, maxsize: int = 10000, cache_ttl: float = 5.0):
+    """Хранилище по имени: "memory" или "db" (по умолчанию)."""
+    kind = (kind or "db").strip().lower()
+    if kind == "memory":
+        return MemoryStateStore(maxsize, ttl)
+    if kind != "db":
+        raise ValueError(f"Unknown MAX state store: {kind}")
+    from database import db
+
+    return DbStateStore(db, ttl, cache_size=maxsize, cache_ttl=cache_ttl)
@@ -0,0 +1,369 @@
+import asyncio
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+
+from aiohttp import web
+from PIL import Image
+
+from env_utils import env_int
+
+try:
+    import brotli  # type: ignore
+except Exception:  # brotli — необязательная зависимость: без неё отдаём только gzip
+    brotli = None
+
+
+# В старых версиях Python mimetypes не знает webp — без этого картинки уходят как octet-stream
+# (FileResponse берёт Content-Type из заголовков, которые передаём ниже).
+mimetypes.add_type("image/webp", ".webp")
+
+# Текстовые файлы сжимаем заранее и держим в памяти (всего несколько сотен КБ).
+# Картинки и звуки уже сжаты — их отдаёт FileResponse (с поддержкой Range для аудио).
+COMPRESSIBLE_EXTS = {".html", ".js", ".css", ".json", ".svg", ".txt", ".map", ".webmanifest"}
+MIN_COMPRESS_SIZE = 512
+
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE = "no-cache"
+
+# Уменьшенные варианты крупных картинок: ширины и уровни качества (q=low|high или Save-Data: on).
+IMAGE_VARIANT_EXTS = {".webp", ".png", ".jpg", ".jpeg"}
+IMAGE_QUALITY_TIERS = {"high": 82, "low": 55}
+# Client hints, по которым выбирается ширина, если её не передали в ?w=
+CLIENT_HINTS = "Sec-CH-DPR, Sec-CH-Viewport-Width, Sec-CH-Width, DPR, Viewport-Width, Width"
+IMAGE_VARY = CLIENT_HINTS + ", Save-Data"
+
+
+def _variant_widths() -> tuple[int, ...]:
+    raw = os.getenv("STATIC_IMAGE_WIDTHS") or "360,720,1080"
+    widths = set()
+    for part in raw.split(","):
+        try:
+            width = int(part.strip())
+        except ValueError:
+            continue
+        if width > 0:
+            widths.add(width)
+    return tuple(sorted(widths))
+
+
+def _hint_float(request: web.Request, *names: str) -> float | None:
+    for name in names:
+        raw = request.headers.get(name)
+        if raw:
+            try:
+                value = float(raw.strip().strip('"'))
+            except ValueError:
+                continue
+            if value > 0:
+                return value
+    return None
+
+
+# src="..." / href="..." в HTML (в т.ч. внутри document.write('<script src="admin.js">'))
+_HTML_REF_RE = re.compile(r"""(\b(?:src|href)=)(["'])([^"'?#:]+)\2""")
+
+
+class StaticAsset:
+    """Файл webapp/: хеш содержимого, а для текстовых — тело и сжатые варианты в памяти."""
+
+    def __init__(self, rel_path: str, fs_path: str) -> None:
+        self.rel_path = rel_path
+        self.fs_path = fs_path
+        stat = os.stat(fs_path)
+        self.mtime_ns = stat.st_mtime_ns
+        self.size = stat.st_size
+        self.content_type = mimetypes.guess_type(rel_path)[0] or "application/octet-stream"
+        ext = os.path.splitext(rel_path)[1].lower()
+        self.compressible = ext in COMPRESSIBLE_EXTS
+        self.is_html = ext == ".html"
+        self.body: bytes | None = None
+        self.encoded: dict[str, bytes] = {}
+        with open(fs_path, "rb") as f:
+            data = f.read()
+        if self.compressible:
+            self.body = data
+        self.hash = hashlib.sha256(data).hexdigest()[:16]
+        # Ширина исходника — только для крупных растровых картинок, которым нужны варианты.
+        self.image_width: int | None = None
+        if ext in IMAGE_VARIANT_EXTS and self.size >= env_int("STATIC_IMAGE_VARIANT_MIN_KB", 64) * 1024:
+            try:
+                with Image.open(fs_path) as img:
+                    self.image_width = img.size[0]
+            except Exception:
+                pass
+
+    def set_body(self, data: bytes) -> None:
+        """Меняет тело (HTML после подстановки версий) и пересчитывает хеш и сжатые варианты."""
+        self.body = data
+        self.hash = hashlib.sha256(data).hexdigest()[:16]
+        self.encoded = {}
+        if len(data) < MIN_COMPRESS_SIZE:
+            return
+        gz = gzip.compress(data, compresslevel=9, mtime=0)
+        if len(gz) < len(data):
+            self.encoded["gzip"] = gz
+        if brotli is not None:
+            try:
+                br = brotli.compress(data, quality=11)
+                if len(br) < len(gz):
+                    self.encoded["br"] = br
+            except Exception:
+                pass
+
+    def is_fresh(self) -> bool:
+        """Файл на диске не менялся с момента сборки (иначе отдаём его напрямую с диска)."""
+        try:
+            stat = os.stat(self.fs_path)
+        except OSError:
+            return False
+        return stat.st_mtime_ns == self.mtime_ns and stat.st_size == self.size
+
+
+def _accepted_encodings(header: str) -> set[str]:
+    accepted = set()
+    for part in (header or "").split(","):
+        name, _, params = part.strip().partition(";")
+        name = name.strip().lower()
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        if name:
+            accepted.add(name)
+    return accepted
+
+
+class StaticAssets:
+    """Раздача webapp/ с предсжатием, хешами содержимого и версионированными URL.
+
+    build() (при старте сервера) обходит каталог, считает хеш каждого файла (манифест
+    путь -> хеш), сжимает текстовые файлы (gzip, и brotli — если модуль установлен)
+    и проставляет в HTML ссылкам на локальные файлы ?v=<хеш>.
+
+    Запрос с актуальным ?v= получает Cache-Control: immutable на год; остальные,
+    в т.ч. сами HTML-страницы, — no-cache с сильным ETag (повторная проверка стоит 304).
+
+    Крупные картинки отдаются уменьшенными вариантами (STATIC_IMAGE_WIDTHS) по ?w= или
+    client hints; варианты кешируются на диске в variants_dir (см. _pick_variant).
+    """
+
+    def __init__(self, root: str, variants_dir: str | None = None) -> None:
+        self.root = os.path.realpath(root)
+        self.assets: dict[str, StaticAsset] = {}
+        self.variants_dir = variants_dir or os.path.join(os.path.dirname(self.root), ".cache", "image_variants")
+        self.variant_widths = _variant_widths()
+        self._variant_tasks: dict[str, asyncio.Future] = {}
+
+    @property
+    def manifest(self) -> dict[str, str]:
+        return {path: asset.hash for path, asset in self.assets.items()}
+
+    def build(self) -> None:
+        assets: dict[str, StaticAsset] = {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
+            for name in sorted(filenames):
+                if name.startswith("."):
+                    continue
+                fs_path = os.path.join(dirpath, name)
+                rel_path = os.path.relpath(fs_path, self.root).replace(os.sep, "/")
+                try:
+                    assets[rel_path] = StaticAsset(rel_path, fs_path)
+                except OSError as e:
+                    logging.getLogger(__name__).warning("Static asset %s skipped: %s", rel_path, e)
+
+        # Сначала все не-HTML файлы (их хеши уже посчитаны), затем HTML со ссылками на них.
+        for asset in assets.values():
+            if asset.compressible and not asset.is_html:
+                asset.set_body(asset.body)
+        for asset in assets.values():
+            if asset.is_html:
+                asset.set_body(self._version_refs(asset, assets))
+        self.assets = assets
+
+        text = [a for a in assets.values() if a.compressible]
+        logging.getLogger(__name__).info(
+            "Static assets: %s files, %s text (%s KB -> %s KB gzip)",
+            len(assets),
+            len(text),
+            sum(len(a.body) for a in text) // 1024,
+            sum(len(a.encoded.get("gzip", a.body)) for a in text) // 1024,
+        )
+
+    def _version_refs(self, asset: StaticAsset, assets: dict[str, StaticAsset]) -> bytes:
+        base_dir = os.path.dirname(asset.rel_path)
+
+        def _sub(m: re.Match) -> str:
+            ref = m.group(3)
+            target = assets.get(os.path.normpath(os.path.join(base_dir, ref)).replace(os.sep, "/"))
+            if target is None or target.is_html:
+                return m.group(0)
+            return f"{m.group(1)}{m.group(2)}{ref}?v={target.hash}{m.group(2)}"
+
+        return _HTML_REF_RE.sub(_sub, asset.body.decode("utf-8")).encode("utf-8")
+
+    # -------------------------
+    # Варианты картинок
+    # -------------------------
+
+    def _variant_path(self, asset: StaticAsset, width: int, tier: str) -> str:
+        # Ключ — хеш исходника: после замены картинки старые варианты просто перестают использоваться.
+        ext = os.path.splitext(asset.rel_path)[1].lower()
+        return os.path.join(self.variants_dir, f"{asset.hash}_{width}_{tier}{ext}")
+
+    def _make_variant(self, asset: StaticAsset, width: int, tier: str, out_path: str) -> None:
+        with Image.open(asset.fs_path) as src:
+            src.load()
+            img = src
+            if width < src.size[0]:
+                height = max(1, round(src.size[1] * width / src.size[0]))
+                img = src.resize((width, height), Image.LANCZOS)
+            ext = os.path.splitext(out_path)[1].lower()
+            quality = IMAGE_QUALITY_TIERS[tier]
+            os.makedirs(self.variants_dir, exist_ok=True)
+            tmp_path = f"{out_path}.{os.getpid()}.tmp"
+            if ext == ".webp":
+                img.save(tmp_path, format="WEBP", quality=quality, method=4)
+            elif ext == ".png":
+                # PNG без потерь: уровень качества влияет только на размер через ширину.
+                img.save(tmp_path, format="PNG", optimize=True)
+            else:
+                img.convert("RGB").save(tmp_path, format="JPEG", quality=quality, optimize=True, progressive=True)
+        os.replace(tmp_path, out_path)
+
+    async def image_variant(self, asset: StaticAsset, width: int, tier: str) -> str:
+        """Путь к варианту на диске; создаётся при первом запросе (один раз на ключ, в потоке)."""
+        out_path = self._variant_path(asset, width, tier)
+        if os.path.exists(out_path):
+            return out_path
+        task = self._variant_tasks.get(out_path)
+        if task is None:
+            task = asyncio.ensure_future(asyncio.to_thread(self._make_variant, asset, width, tier, out_path))
+            self._variant_tasks[out_path] = task
+            task.add_done_callback(lambda _t: self._variant_tasks.pop(out_path, None))
+        await asyncio.shield(task)
+        return out_path
+
+    async def warm_variants(self) -> None:
+        """Заранее создаёт варианты всех крупных картинок (фоном при старте), чтобы первый запрос не ждал."""
+        for asset in list(self.assets.values()):
+            if not asset.image_width:
+                continue
+            for width in self.variant_widths:
+                if width >= asset.image_width:
+                    break
+                # Низкое качество (Save-Data) запрашивают редко — его создаём по первому запросу.
+                try:
+                    await self.image_variant(asset, width, "high")
+                except Exception as e:
+                    logging.getLogger(__name__).warning("Image variant %s@%s failed: %s", asset.rel_path, width, e)
+
+    def _pick_variant(self, request: web.Request, asset: StaticAsset) -> tuple[int, str] | None:
+        """(ширина, уровень качества) для запроса или None — отдать исходник.
+
+        Ширина — из ?w=, иначе из client hints (Width, или Viewport-Width * DPR): берём
+        наименьший вариант не уже нужного. Если нужно не меньше исходника — исходник.
+        """
+        tier = str(request.query.get("q") or "").lower()
+        if tier not in IMAGE_QUALITY_TIERS:
+            tier = "low" if request.headers.get("Save-Data", "").strip().lower() == "on" else "high"
+
+        wanted = None
+        try:
+            wanted = int(request.query.get("w") or 0) or None
+        except ValueError:
+            wanted = None
+        if wanted is None:
+            wanted = _hint_float(request, "Sec-CH-Width", "Width")
+            if wanted is None:
+                viewport = _hint_float(request, "Sec-CH-Viewport-Width", "Viewport-Width")
+                if viewport is not None:
+                    wanted = viewport * (_hint_float(request, "Sec-CH-DPR", "DPR") or 1.0)
+
+        width = asset.image_width
+        if wanted is not None:
+            width = next((w for w in self.variant_widths if w >= wanted), asset.image_width)
+        if width >= asset.image_width:
+            if tier == "high":
+                return None
+            width = asset.image_width
+        return int(width), tier
+
+    def _resolve(self, path: str) -> tuple[str, str] | None:
+        """(относительный путь, путь на диске) или None, если путь выходит за пределы каталога."""
+        rel = os.path.normpath(path.lstrip("/") or ".").replace(os.sep, "/")
+        if rel.startswith("..") or os.path.isabs(rel):
+            return None
+        fs_path = os.path.join(self.root, rel)
+        if os.path.isdir(fs_path):
+            rel = "index.html" if rel == "." else f"{rel}/index.html"
+            fs_path = os.path.join(self.root, rel)
+        if not os.path.realpath(fs_path).startswith(self.root + os.sep):
+            return None
+        return rel, fs_path
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        resolved = self._resolve(request.match_info.get("path", ""))
+        if resolved is None:
+            raise web.HTTPNotFound()
+        rel, fs_path = resolved
+
+        asset = self.assets.get(rel)
+        if asset is None or not asset.is_fresh():
+            # Файл появился/изменился после старта — отдаём с диска без долгого кеширования.
+            if not os.path.isfile(fs_path):
+                raise web.HTTPNotFound()
+            content_type = mimetypes.guess_type(fs_path)[0] or "application/octet-stream"
+            return web.FileResponse(fs_path, headers={"Cache-Control": REVALIDATE_CACHE, "Content-Type": content_type})
+
+        versioned = request.query.get("v") == asset.hash
+        cache_control = IMMUTABLE_CACHE if versioned and not asset.is_html else REVALIDATE_CACHE
+
+        if asset.image_width:
+            picked = self._pick_variant(request, asset)
+            headers = {"Cache-Control": cache_control, "Content-Type": asset.content_type, "Vary": IMAGE_VARY}
+            if picked is not None:
+                try:
+                    variant_path = await self.image_variant(asset, *picked)
+                except Exception as e:
+                    logging.getLogger(__name__).warning("Image variant %s failed: %s", asset.rel_path, e)
+                else:
+                    return web.FileResponse(variant_path, headers=headers)
+            return web.FileResponse(fs_path, headers=headers)
+
+        if asset.body is None:
+            return web.FileResponse(fs_path, headers={"Cache-Control": cache_control, "Content-Type": asset.content_type})
+
+        encoding = None
+        accepted = _accepted_encodings(request.headers.get("Accept-Encoding", ""))
+        for name in ("br", "gzip"):
+            if name in asset.encoded and name in accepted:
+                encoding = name
+                break
+
+        # Сильный ETag: у каждого представления (сжатого/несжатого) свой.
+        etag = f'"{asset.hash}-{encoding}"' if encoding else f'"{asset.hash}"'
+        headers = {
+            "Cache-Control": cache_control,
+            "ETag": etag,
+            "Vary": "Accept-Encoding",
+        }
+        if asset.is_html:
+            # Просим браузер присылать client hints для подбора ширины картинок (Chromium/WebView).
+            headers["Accept-CH"] = CLIENT_HINTS
+        if_none_match = request.headers.get("If-None-Match", "")
+        if etag in [t.strip() for t in if_none_match.split(",")] or if_none_match.strip() == "*":
+            return web.Response(status=304, headers=headers)
+
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        body = asset.encoded[encoding] if encoding else asset.body
+        charset = "utf-8" if asset.content_type.startswith("text/") or asset.content_type in {"application/javascript", "application/json"} else None
+        return web.Response(body=body, content_type=asset.content_type, charset=charset, headers=headers)
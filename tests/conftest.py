@@ -0,0 +1,13 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+
+@pytest.fixture
+def run():
+    """Выполняет корутину в отдельном event loop (pytest-asyncio в зависимостях нет)."""
+    return asyncio.run
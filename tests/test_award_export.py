@@ -0,0 +1,70 @@
+import io
+import re
+import zipfile
+
+from PIL import Image
+
+from award_export import PdfStreamWriter, ZipStreamWriter, safe_filename
+from cert_render import render_text_pages
+
+
+def _jpeg(w: int, h: int) -> bytes:
+    buf = io.BytesIO()
+    Image.new("RGB", (w, h), (200, 30, 30)).save(buf, "JPEG")
+    return buf.getvalue()
+
+
+def test_safe_filename_keeps_cyrillic_and_strips_separators():
+    assert safe_filename("Иван Иванов") == "Иван_Иванов"
+    assert safe_filename("../../etc/passwd") == "etc_passwd"
+    assert safe_filename("", default="cert") == "cert"
+    assert len(safe_filename("я" * 200)) == 80
+
+
+def test_zip_stream_is_valid_archive():
+    writer = ZipStreamWriter()
+    chunks = [writer.start()]
+    files = {f"cert_{i}.png": bytes([i]) * (1000 + i) for i in range(5)}
+    for name, data in files.items():
+        chunk = writer.add(name, data)
+        assert chunk  # каждый файл отдаётся сразу, а не в конце
+        chunks.append(chunk)
+    chunks.append(writer.finish())
+
+    with zipfile.ZipFile(io.BytesIO(b"".join(chunks))) as zf:
+        assert zf.testzip() is None
+        assert sorted(zf.namelist()) == sorted(files)
+        for name, data in files.items():
+            assert zf.read(name) == data
+
+
+def test_pdf_stream_has_pages_and_correct_xref():
+    writer = PdfStreamWriter(dpi=150)
+    pages = [(_jpeg(300, 200), 300, 200), (_jpeg(150, 300), 150, 300)]
+    pdf = writer.start() + b"".join(writer.add(*p) for p in pages) + writer.finish()
+
+    assert pdf.startswith(b"%PDF-1.4")
+    assert pdf.rstrip().endswith(b"%%EOF")
+    assert b"/Count 2" in pdf
+    # 300 px при 150 dpi = 144 pt
+    assert b"/MediaBox [0 0 144.00 96.00]" in pdf
+
+    startxref = int(re.search(rb"startxref\n(\d+)\n", pdf).group(1))
+    assert pdf[startxref:].startswith(b"xref\n")
+    entries = re.findall(rb"(\d{10}) 00000 n \n", pdf[startxref:])
+    assert entries
+    for num, offset in enumerate(entries, start=1):
+        assert pdf[int(offset):].startswith(b"%d 0 obj\n" % num)
+
+
+def test_error_pages_list_every_failed_recipient():
+    lines = [f"{i} Участник {i}: render failed" for i in range(120)]
+    pages = render_text_pages("Не удалось сформировать 120 из 120 сертификатов", lines, (400, 600))
+    assert len(pages) > 1
+    for page in pages:
+        with Image.open(io.BytesIO(page)) as img:
+            assert img.format == "JPEG" and img.size == (400, 600)
+
+    writer = PdfStreamWriter()
+    pdf = writer.start() + b"".join(writer.add(p, 400, 600) for p in pages) + writer.finish()
+    assert b"/Count %d" % len(pages) in pdf
@@ -0,0 +1,64 @@
+import json
+
+import pytest
+from PIL import Image
+
+import cert_render
+from cert_render import CertTemplate, TemplateError, TemplateRegistry
+
+
+FIELDS = [
+    {"text": "{event_name}", "font": "bold", "y": 0.1, "anchor": "ma", "size": 0.05},
+    {"text": "{full_name}", "font": "bold", "anchor": "ma", "size": 0.05},
+    {"text": "Очки: {score}", "anchor": "ma", "size": 0.03},
+    {"text": "{event_date}", "y": 0.9, "anchor": "ma", "size": 0.03},
+]
+
+
+def _sidecar(tmp_path, **overrides):
+    Image.new("RGB", (400, 600), "white").save(tmp_path / "tpl.png")
+    raw = {"key": "t", "image": "tpl.png", "fields": FIELDS, "groups": [{"fields": [1, 2], "between": [0, 3]}]}
+    raw.update(overrides)
+    path = tmp_path / "tpl.json"
+    path.write_text(json.dumps(raw), encoding="utf-8")
+    return str(path)
+
+
+def _ink_rows(img):
+    box = img.convert("L").point(lambda v: 255 if v < 128 else 0).getbbox()
+    return box[1], box[3]
+
+
+def test_group_is_centred_between_bounds(tmp_path, monkeypatch):
+    registry = TemplateRegistry(str(tmp_path))
+    _sidecar(tmp_path, fields=FIELDS[1:3], groups=[{"fields": [0, 1], "between": [0, 1]}])
+    assert registry.load()  # between и fields пересекаются
+
+    _sidecar(tmp_path)
+    assert registry.load() == []
+    monkeypatch.setattr(cert_render, "cert_templates", registry)
+
+    def _block(event_name):
+        img = cert_render._draw_award("t", "Иван", event_name, "", score=1)
+        # Только полоса между мероприятием и датой.
+        return _ink_rows(img.crop((0, 120, 400, 530)))
+
+    top, bottom = _block("Турнир")
+    assert abs((top + bottom) / 2 - 205) <= 20
+    # Длинное название уменьшается до min_size и освобождает место — блок поднимается.
+    assert _block("Очень длинное название городского мероприятия")[0] <= top
+
+
+@pytest.mark.parametrize(
+    "overrides",
+    [
+        {"groups": [{"fields": [1], "between": [0, 3]}]},  # у поля 2 нет ни y, ни группы
+        {"groups": [{"fields": [1, 2], "between": [0]}]},
+        {"groups": [{"fields": [1, 2], "between": [0, 3], "offset": 1.5}]},
+        {"fields": [dict(FIELDS[0], anchor="mm")] + FIELDS[1:]},
+        {"fields": FIELDS[:1] + [dict(FIELDS[1], y=0.5)] + FIELDS[2:]},
+    ],
+)
+def test_bad_groups_are_rejected(tmp_path, overrides):
+    with pytest.raises(TemplateError):
+        CertTemplate(_sidecar(tmp_path, **overrides))
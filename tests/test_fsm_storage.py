@@ -0,0 +1,130 @@
+import asyncio
+
+from aiogram.fsm.storage.base import StorageKey
+
+from fsm_storage import DbFSMStorage
+
+
+class FakeDb:
+    """Подмена database.db: записи в dict, запись пачки можно «затормозить» событием."""
+
+    def __init__(self) -> None:
+        self.rows: dict = {}
+        self.saves: list = []
+        self.save_started = asyncio.Event()
+        self.release = None
+
+    async def get_fsm_record(self, storage_key, ttl):
+        return self.rows.get(storage_key)
+
+    async def save_fsm_records(self, records):
+        self.save_started.set()
+        if self.release is not None:
+            await self.release.wait()
+        self.saves.append(list(records))
+        for key, state, data in records:
+            if state is None and not data:
+                self.rows.pop(key, None)
+            else:
+                self.rows[key] = (state, dict(data))
+
+    async def prune_fsm_records(self, ttl):
+        pass
+
+
+KEY = StorageKey(bot_id=1, chat_id=10, user_id=10)
+
+
+def test_changes_are_batched_and_readable_before_flush(run):
+    async def scenario():
+        db = FakeDb()
+        storage = DbFSMStorage(db, flush_interval=60, flush_max=100)
+        for i in range(5):
+            key = StorageKey(bot_id=1, chat_id=i, user_id=i)
+            await storage.set_state(key, "RegState:waiting_for_age")
+            await storage.update_data(key, {"first_name": f"user{i}"})
+        assert db.saves == []
+        assert await storage.get_state(StorageKey(bot_id=1, chat_id=3, user_id=3)) == "RegState:waiting_for_age"
+        assert await storage.flush() == 5
+        assert len(db.saves) == 1 and len(db.saves[0]) == 5
+        await storage.close()
+
+    run(scenario())
+
+
+def test_flush_max_triggers_write(run):
+    async def scenario():
+        db = FakeDb()
+        storage = DbFSMStorage(db, flush_interval=60, flush_max=2)
+        await storage.set_state(StorageKey(bot_id=1, chat_id=1, user_id=1), "A:a")
+        assert db.saves == []
+        await storage.set_state(StorageKey(bot_id=1, chat_id=2, user_id=2), "A:a")
+        assert len(db.saves) == 1
+        await storage.close()
+
+    run(scenario())
+
+
+def test_load_sees_batch_while_save_in_progress(run):
+    async def scenario():
+        db = FakeDb()
+        db.rows["1:10:10:::default"] = ("RegState:waiting_for_fullname", {})
+        storage = DbFSMStorage(db, flush_interval=60, cache_ttl=5)
+        assert await storage.get_state(KEY) == "RegState:waiting_for_fullname"
+
+        await storage.set_state(KEY, "RegState:waiting_for_age")
+        await storage.update_data(KEY, {"first_name": "Иван"})
+
+        db.release = asyncio.Event()
+        flush_task = asyncio.create_task(storage.flush())
+        await db.save_started.wait()
+
+        # Запись пачки ещё идёт: чтение не должно видеть старое состояние из кеша/БД.
+        assert await storage.get_state(KEY) == "RegState:waiting_for_age"
+        await storage.set_state(KEY, "RegState:waiting_for_city")
+        assert await storage.get_data(KEY) == {"first_name": "Иван"}
+
+        db.release.set()
+        await flush_task
+        await storage.flush()
+        assert db.rows["1:10:10:::default"] == ("RegState:waiting_for_city", {"first_name": "Иван"})
+        await storage.close()
+
+    run(scenario())
+
+
+def test_failed_save_keeps_changes_buffered(run):
+    async def scenario():
+        db = FakeDb()
+
+        async def failing(records):
+            raise RuntimeError("db down")
+
+        storage = DbFSMStorage(db, flush_interval=60)
+        await storage.set_state(KEY, "A:a")
+        db.save_fsm_records = failing
+        try:
+            await storage.flush()
+        except RuntimeError:
+            pass
+        assert await storage.get_state(KEY) == "A:a"
+        del db.save_fsm_records
+        await storage.close()
+        assert db.rows["1:10:10:::default"] == ("A:a", {})
+
+    run(scenario())
+
+
+def test_clear_deletes_record(run):
+    async def scenario():
+        db = FakeDb()
+        storage = DbFSMStorage(db, flush_interval=0)
+        await storage.set_state(KEY, "A:a")
+        await storage.set_data(KEY, {"x": 1})
+        assert "1:10:10:::default" in db.rows
+        await storage.set_state(KEY, None)
+        await storage.set_data(KEY, {})
+        assert "1:10:10:::default" not in db.rows
+        await storage.close()
+
+    run(scenario())
@@ -0,0 +1,63 @@
+from max_bot import update_dedup_key
+from max_dedup import UpdateDeduplicator
+from ttl_cache import TTLCache
+
+
+def test_dedup_keys_from_update_ids():
+    msg = {"update_type": "message_created", "timestamp": 1, "message": {"sender": {"user_id": 5}, "body": {"mid": "mid.1"}}}
+    assert update_dedup_key(msg) == "message_created:mid.1"
+    cb = {"update_type": "message_callback", "callback": {"callback_id": "cb1", "user": {"user_id": 5}}}
+    assert update_dedup_key(cb) == "message_callback:cb1"
+    started = {"update_type": "bot_started", "timestamp": 42, "user": {"user_id": 7}}
+    assert update_dedup_key(started) == "bot_started:7:42"
+    assert update_dedup_key({"update_type": "bot_started", "user": {"user_id": 7}}) is None
+
+
+def test_memory_dedup_only_after_remember():
+    dedup = UpdateDeduplicator(maxsize=10, ttl=60)
+    assert not dedup.is_duplicate("k")
+    # Не запомнили (например, очередь отказала 503) — повтор должен пройти.
+    assert not dedup.is_duplicate("k")
+    dedup.remember("k")
+    assert dedup.is_duplicate("k")
+    assert not dedup.is_duplicate(None)
+    assert dedup.metrics()["duplicates"] == 1
+
+
+def test_db_claim_and_fail_open(run):
+    async def scenario():
+        claimed = set()
+
+        async def claim(key, ttl):
+            if key in claimed:
+                return False
+            claimed.add(key)
+            return True
+
+        dedup = UpdateDeduplicator(maxsize=10, ttl=60, claim=claim)
+        assert await dedup.claim("k") is True
+        assert await dedup.claim("k") is False
+        assert dedup.metrics()["db_duplicates"] == 1
+
+        async def broken(key, ttl):
+            raise RuntimeError("db down")
+
+        dedup = UpdateDeduplicator(maxsize=10, ttl=60, claim=broken)
+        assert await dedup.claim("k") is True
+        assert dedup.metrics()["db_errors"] == 1
+
+    run(scenario())
+
+
+def test_ttl_cache_lru_and_expiry(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("ttl_cache.time.monotonic", lambda: now[0])
+    cache = TTLCache(maxsize=2, ttl=10)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1  # «a» становится свежее «b»
+    cache.set("c", 3)
+    assert "b" not in cache and cache.get("a") == 1 and cache.get("c") == 3
+    now[0] += 11
+    assert cache.get("a") is None
+    assert len(cache) <= 2
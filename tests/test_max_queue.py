@@ -0,0 +1,98 @@
+import asyncio
+
+from max_queue import MaxUpdateQueue
+
+
+def test_per_user_order_and_parallel_users(run):
+    async def scenario():
+        log = []
+        active = {"now": 0, "max": 0}
+
+        async def handler(update):
+            active["now"] += 1
+            active["max"] = max(active["max"], active["now"])
+            await asyncio.sleep(0.01)
+            log.append((update["user"], update["n"]))
+            active["now"] -= 1
+
+        queue = MaxUpdateQueue(handler, workers=4, maxsize=100)
+        queue.start()
+        for n in range(5):
+            for user in ("a", "b", "c"):
+                assert queue.submit({"user": user, "n": n}, key=user)
+        await queue.stop()
+
+        for user in ("a", "b", "c"):
+            assert [n for u, n in log if u == user] == list(range(5))
+        assert active["max"] > 1
+        assert queue.metrics()["processed"] == 15
+
+    run(scenario())
+
+
+def test_one_user_is_never_processed_concurrently(run):
+    async def scenario():
+        running = set()
+        overlaps = []
+
+        async def handler(update):
+            if update["user"] in running:
+                overlaps.append(update)
+            running.add(update["user"])
+            await asyncio.sleep(0.005)
+            running.discard(update["user"])
+
+        queue = MaxUpdateQueue(handler, workers=8, maxsize=100)
+        queue.start()
+        for n in range(20):
+            queue.submit({"user": 1, "n": n}, key=1)
+        await queue.stop()
+        assert overlaps == []
+
+    run(scenario())
+
+
+def test_bounded_depth_rejects_and_counts(run):
+    async def scenario():
+        release = asyncio.Event()
+
+        async def handler(update):
+            await release.wait()
+
+        queue = MaxUpdateQueue(handler, workers=1, maxsize=3)
+        queue.start()
+        accepted = [queue.submit({"n": n}, key=n) for n in range(5)]
+        assert accepted == [True, True, True, False, False]
+        metrics = queue.metrics()
+        assert metrics["rejected"] == 2
+        assert metrics["depth"] == 3
+        release.set()
+        await queue.stop()
+        assert queue.metrics()["processed"] == 3
+
+    run(scenario())
+
+
+def test_handler_errors_do_not_stop_the_queue(run):
+    async def scenario():
+        done = []
+
+        async def handler(update):
+            if update.get("fail"):
+                raise RuntimeError("boom")
+            done.append(update["n"])
+
+        queue = MaxUpdateQueue(handler, workers=1, maxsize=10)
+        queue.start()
+        queue.submit({"fail": True}, key=1)
+        queue.submit({"n": 1}, key=1)
+        await queue.stop()
+        assert done == [1]
+        assert queue.metrics()["failed"] == 1
+
+    run(scenario())
+
+
+def test_submit_before_start_is_rejected():
+    queue = MaxUpdateQueue(lambda u: None, workers=1, maxsize=10)
+    assert queue.submit({}, key=1) is False
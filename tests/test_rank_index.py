@@ -0,0 +1,108 @@
+import random
+
+from database.rank_index import ScoreRankIndex
+
+
+def brute_rank(scores: dict, tg_id: int):
+    """Та же семантика, что у SQL-варианта get_user_rank: 1 + число пользователей с очками строго больше."""
+    if tg_id not in scores:
+        return None
+    score = scores[tg_id]
+    return (1 + sum(1 for s in scores.values() if s > score), len(scores))
+
+
+def loaded(rows) -> ScoreRankIndex:
+    index = ScoreRankIndex()
+    index.begin_load()
+    index.load(rows)
+    return index
+
+
+def test_rank_matches_sql_semantics_with_ties():
+    index = loaded([(1, 10), (2, 30), (3, 30), (4, 0), (5, 20)])
+    assert index.rank(2) == (1, 5)
+    assert index.rank(3) == (1, 5)
+    assert index.rank(5) == (3, 5)
+    assert index.rank(1) == (4, 5)
+    assert index.rank(4) == (5, 5)
+    assert index.rank(99) is None
+
+
+def test_not_loaded_index_ignores_changes():
+    index = ScoreRankIndex()
+    index.add_user(1, 5)
+    assert not index.loaded
+    assert index.rank(1) is None
+
+
+def test_changes_during_load_are_applied_after_it():
+    index = ScoreRankIndex()
+    index.begin_load()
+    index.add_user(3, 0)
+    index.bump_score(1, 50)
+    index.load([(1, 10), (2, 20)])
+    assert index.rank(1) == (1, 3)
+    assert index.rank(3) == (3, 3)
+
+
+def test_bump_only_increases():
+    index = loaded([(1, 10), (2, 20)])
+    index.bump_score(2, 5)
+    assert index.rank(2) == (1, 2)
+    index.bump_score(1, 25)
+    assert index.rank(1) == (1, 2)
+
+
+def test_random_operations_match_brute_force():
+    rnd = random.Random(42)
+    scores = {uid: rnd.randint(0, 50) for uid in range(1, 200)}
+    index = loaded(list(scores.items()))
+    for _ in range(2000):
+        op = rnd.random()
+        uid = rnd.randint(1, 260)
+        if op < 0.4:
+            new = rnd.randint(0, 120)
+            index.bump_score(uid, new)
+            if uid in scores and scores[uid] < new:
+                scores[uid] = new
+        elif op < 0.6:
+            index.add_user(uid, 0)
+            scores.setdefault(uid, 0)
+        elif op < 0.7:
+            index.reset_user(uid)
+            if uid in scores:
+                scores[uid] = 0
+        elif op < 0.8:
+            index.remove_user(uid)
+            scores.pop(uid, None)
+        elif op < 0.805:
+            index.reset_all()
+            scores = {k: 0 for k in scores}
+        probe = rnd.randint(1, 260)
+        assert index.rank(probe) == brute_rank(scores, probe)
+
+
+def test_load_accepts_coalesced_rows():
+    # db.py загружает COALESCE(score, 0); NULL-очки (если всё же придут) — это 0.
+    index = loaded([(1, None), (2, 0), (3, 5)])
+    assert index.rank(1) == (2, 3)
+    assert index.rank(2) == (2, 3)
+
+
+def test_index_size_follows_live_scores():
+    index = loaded([(uid, 0) for uid in range(10)])
+    # Каждый пользователь проходит через сотни разных значений очков.
+    for step in range(1, 500):
+        for uid in range(10):
+            index.bump_score(uid, step * 10 + uid)
+    assert len(index._counts) == 10
+    assert len(index._keys) <= 2 * 10 + 1
+    assert index.rank(9) == (1, 10)
+    assert index.rank(0) == (10, 10)
+
+    # Возврат к уже встречавшемуся значению занимает пустую позицию без пересборки.
+    index.reset_user(3)
+    index.bump_score(3, 4980)
+    scores = {uid: 4990 + uid for uid in range(10)}
+    scores[3] = 4980
+    assert all(index.rank(uid) == brute_rank(scores, uid) for uid in scores)
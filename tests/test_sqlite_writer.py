@@ -0,0 +1,127 @@
+import asyncio
+
+import aiosqlite
+
+from database.sqlite_readers import ReaderPool
+from database.sqlite_writer import GroupCommitWriter
+
+
+async def _open(path):
+    conn = await aiosqlite.connect(str(path))
+    await conn.execute("PRAGMA journal_mode=WAL;")
+    await conn.execute("CREATE TABLE t (id INTEGER PRIMARY KEY, v TEXT)")
+    await conn.commit()
+    return conn
+
+
+class CountingConn:
+    """Обёртка над соединением, считающая commit."""
+
+    def __init__(self, conn) -> None:
+        self.conn = conn
+        self.commits = 0
+
+    def execute(self, *args):
+        return self.conn.execute(*args)
+
+    async def commit(self):
+        self.commits += 1
+        await self.conn.commit()
+
+    async def rollback(self):
+        await self.conn.rollback()
+
+
+def _insert(i):
+    async def op(db):
+        await db.execute("INSERT INTO t (id, v) VALUES (?, ?)", (i, f"v{i}"))
+        return i
+
+    return op
+
+
+async def _rows(path):
+    async with aiosqlite.connect(str(path)) as conn, conn.execute("SELECT id FROM t ORDER BY id") as cur:
+        return [r[0] for r in await cur.fetchall()]
+
+
+def test_concurrent_writes_share_one_commit(tmp_path, run):
+    async def scenario():
+        path = tmp_path / "w.db"
+        conn = CountingConn(await _open(path))
+
+        async def get_conn():
+            return conn
+
+        writer = GroupCommitWriter(get_conn, max_batch=64, max_delay=0.05)
+        results = await asyncio.gather(*(writer.submit(_insert(i)) for i in range(10)))
+        assert results == list(range(10))
+        assert conn.commits == 1
+        assert await _rows(path) == list(range(10))
+        await writer.close()
+        await conn.conn.close()
+
+    run(scenario())
+
+
+def test_failed_op_rolls_back_only_itself(tmp_path, run):
+    async def scenario():
+        path = tmp_path / "w.db"
+        conn = await _open(path)
+
+        async def get_conn():
+            return conn
+
+        async def bad(db):
+            await db.execute("INSERT INTO t (id, v) VALUES (100, 'partial')")
+            raise ValueError("boom")
+
+        writer = GroupCommitWriter(get_conn, max_batch=64, max_delay=0.05)
+        results = await asyncio.gather(
+            writer.submit(_insert(1)), writer.submit(bad), writer.submit(_insert(2)), return_exceptions=True
+        )
+        assert results[0] == 1 and results[2] == 2
+        assert isinstance(results[1], ValueError)
+        assert await _rows(path) == [1, 2]
+        await writer.close()
+        await conn.close()
+
+    run(scenario())
+
+
+def test_max_batch_splits_commits(tmp_path, run):
+    async def scenario():
+        path = tmp_path / "w.db"
+        conn = CountingConn(await _open(path))
+
+        async def get_conn():
+            return conn
+
+        writer = GroupCommitWriter(get_conn, max_batch=3, max_delay=0.05)
+        await asyncio.gather(*(writer.submit(_insert(i)) for i in range(7)))
+        assert conn.commits == 3
+        await writer.close()
+        await conn.conn.close()
+
+    run(scenario())
+
+
+def test_reader_pool_always_has_a_connection(tmp_path, run):
+    async def scenario():
+        path = tmp_path / "w.db"
+        conn = await _open(path)
+        await conn.execute("INSERT INTO t (id, v) VALUES (1, 'a')")
+        await conn.commit()
+
+        pool = ReaderPool(str(path), 0)
+        assert pool.size == 1
+        # Незафиксированная запись писателя не видна читателю.
+        await conn.execute("BEGIN")
+        await conn.execute("INSERT INTO t (id, v) VALUES (2, 'b')")
+        async with pool.acquire() as reader, reader.execute("SELECT id FROM t") as cur:
+            assert [r[0] for r in await cur.fetchall()] == [1]
+        await conn.rollback()
+        await pool.close()
+        await conn.close()
+
+    run(scenario())
@@ -0,0 +1,102 @@
+import asyncio
+import hashlib
+import hmac
+import logging
+from typing import Any
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+
+def default_secret_token(bot_token: str) -> str:
+    """Секрет webhook по умолчанию — производный от токена бота (Telegram допускает [A-Za-z0-9_-])."""
+    return hmac.new(b"tg-webhook", bot_token.encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    """Webhook-обработчик aiogram с ограниченной параллельностью.
+
+    Как и SimpleRequestHandler, отвечает Telegram сразу, а update обрабатывает в фоне,
+    но одновременно выполняется не больше concurrency update. Принятых и ещё
+    не обработанных может быть не больше max_pending — сверх этого отвечаем 503,
+    и Telegram повторит доставку позже.
+
+    Bot общий с web-приложением (app["bot"]): его сессию закрывает само приложение,
+    поэтому close() только дожидается уже принятых update.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, *, concurrency: int, max_pending: int, secret_token: str, **data: Any) -> None:
+        super().__init__(dispatcher=dispatcher, bot=bot, handle_in_background=True, secret_token=secret_token, **data)
+        self._sem = asyncio.Semaphore(max(1, int(concurrency)))
+        self.max_pending = max(1, int(max_pending))
+        self.rejected = 0
+
+    async def _background_feed_update(self, bot: Bot, update: dict[str, Any]) -> None:
+        async with self._sem:
+            try:
+                await super()._background_feed_update(bot, update)
+            except Exception as e:
+                logging.getLogger(__name__).exception("Telegram update handler error: %s", e)
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        if len(self._background_feed_update_tasks) >= self.max_pending:
+            self.rejected += 1
+            logging.getLogger(__name__).warning("Telegram update rejected: %s updates pending", self.max_pending)
+            return web.json_response({"ok": False, "error": "busy"}, status=503, headers={"Retry-After": "5"})
+        return await super()._handle_request_background(bot, request)
+
+    async def close(self, timeout: float = 10.0) -> None:
+        tasks = list(self._background_feed_update_tasks)
+        if not tasks:
+            return
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logging.getLogger(__name__).warning("Telegram webhook stopped with %s unprocessed updates", len(pending))
+
+
+def setup_telegram_webhook(
+    app: web.Application,
+    dispatcher: Dispatcher,
+    *,
+    url: str,
+    path: str,
+    secret_token: str,
+    concurrency: int,
+    max_pending: int,
+    max_connections: int = 40,
+    set_webhook: bool = True,
+) -> BoundedRequestHandler:
+    """Регистрирует webhook Telegram на app: маршрут path, события startup/shutdown диспетчера
+    и (если set_webhook) setWebhook с url при старте приложения."""
+    bot: Bot = app["bot"]
+    handler = BoundedRequestHandler(
+        dispatcher,
+        bot,
+        concurrency=concurrency,
+        max_pending=max_pending,
+        secret_token=secret_token,
+    )
+    # Порядок on_shutdown: сначала дорабатываем принятые update, потом shutdown диспетчера (закрывает FSM-хранилище).
+    handler.register(app, path=path)
+    setup_application(app, dispatcher, bot=bot)
+
+    async def _set_webhook(app_: web.Application):
+        if not set_webhook:
+            return
+        try:
+            await bot.set_webhook(
+                url=url,
+                secret_token=secret_token,
+                allowed_updates=dispatcher.resolve_used_update_types(),
+                max_connections=max(1, min(100, int(max_connections))),
+            )
+            logging.getLogger(__name__).info("Telegram webhook set: %s", url)
+        except Exception as e:
+            logging.getLogger(__name__).exception("Telegram setWebhook failed: %s", e)
+
+    app.on_startup.append(_set_webhook)
+    app["tg_webhook"] = handler
+    return handler
@@ -0,0 +1,54 @@
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """LRU-словарь с ограничением по числу записей и времени жизни (в памяти процесса).
+
+    Запись живёт ttl секунд с момента set(); при переполнении вытесняется давно
+    не использованная. Просроченные записи удаляются при обращении к ним и с начала
+    LRU-порядка при каждой вставке, поэтому все операции — O(1) в среднем.
+    """
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        self.maxsize = max(1, int(maxsize))
+        self.ttl = float(ttl)
+        self._data: OrderedDict = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key) -> bool:
+        return self._lookup(key) is not None
+
+    def _lookup(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        if item[1] <= time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return item
+
+    def get(self, key, default=None):
+        item = self._lookup(key)
+        return default if item is None else item[0]
+
+    def set(self, key, value, ttl: float | None = None) -> None:
+        now = time.monotonic()
+        self._data[key] = (value, now + (self.ttl if ttl is None else float(ttl)))
+        self._data.move_to_end(key)
+        # Сначала выбрасываем просроченные из «старого» конца, затем лишние по размеру.
+        while self._data:
+            oldest_key, (_, expires_at) = next(iter(self._data.items()))
+            if expires_at > now and len(self._data) <= self.maxsize:
+                break
+            del self._data[oldest_key]
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[0]
+
+    def clear(self) -> None:
+        self._data.clear()
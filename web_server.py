@@ -5,41 +5,46 @@ import json
 import logging
 import os
 import time
+from collections import deque
 from datetime import datetime
-from io import BytesIO
 from urllib.parse import parse_qsl
 
 from aiohttp import web
 import aiohttp
 from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.types import BufferedInputFile
-from PIL import Image, ImageDraw, ImageFont
 
 from database.db import (
-    get_levels,
     set_level_active,
     get_top_users,
     get_all_users,
     get_user,
-    get_user_profile,
     delete_user,
     delete_all_users,
     reset_all_scores,
     reset_user_scores,
     get_stats_reset_token,
-    get_user_deleted_token,
-    get_user_reset_token,
+    get_client_sync_state,
     update_score,
     update_aptitude_top,
     create_database_backup,
+    get_award_recipients,
+    claim_max_update,
+    prune_max_updates,
 )
+from database.events import broadcaster
+from static_assets import StaticAssets
+from award_export import PdfStreamWriter, ZipStreamWriter, safe_filename
+from award_jobs import AwardJobManager, RateLimiter
+from max_dedup import UpdateDeduplicator
+from max_queue import MaxUpdateQueue
+from max_state import create_state_store
+from cert_render import RenderBusy, TemplateError, cert_templates, output_settings, render_award_preview, render_pool, render_text_pages
 
 
 WEBAPP_DIR = os.path.join(os.path.dirname(__file__), "webapp")
 
-# Шаблоны грамот/дипломов (вариант A: PNG + наложение текста)
-CERT_TEMPLATES_DIR = os.path.join(WEBAPP_DIR, "assets", "cert_templates")
-
 
 # -------------------------
 # MAX bot webhook integration
@@ -51,6 +56,8 @@ async def handle_max_webhook(request: web.Request) -> web.Response:
 
     Если MAX не настроен (нет MAX_BOT_TOKEN) — просто возвращаем 200 OK.
     Если задан MAX_WEBHOOK_SECRET — проверяем заголовок X-Max-Bot-Api-Secret.
+    Update не обрабатывается здесь: он ставится в очередь app["max_queue"], и ответ уходит сразу,
+    не дожидаясь БД и запросов к MAX API. Если очередь заполнена — 503, MAX повторит доставку.
     """
 
     token = (request.app.get("max_token") or "").strip()
@@ -68,153 +75,25 @@ async def handle_max_webhook(request: web.Request) -> web.Response:
     except Exception:
         return web.Response(status=400, text="bad json")
 
-    try:
-        from max_bot import handle_update
-        await handle_update(request.app, update)
-    except Exception as e:
-        logging.getLogger(__name__).exception("MAX webhook handler error: %s", e)
-        # Важно вернуть 200, чтобы MAX не делал ретраи из-за наших внутренних исключений.
-        return web.json_response({"ok": True})
+    if not isinstance(update, dict):
+        return web.Response(status=400, text="bad update")
 
-    return web.json_response({"ok": True})
+    from max_bot import update_dedup_key, update_user_id
 
+    # Повторная доставка уже принятого update: отвечаем 200 и ничего не делаем.
+    dedup: UpdateDeduplicator = request.app["max_dedup"]
+    dedup_key = update_dedup_key(update)
+    if dedup.is_duplicate(dedup_key):
+        return web.json_response({"ok": True, "duplicate": True})
 
-def _resolve_font_paths(font_key: str):
-    """Возвращает (regular_path, bold_path) с безопасным фолбэком.
-
-    В админке доступен выбор нескольких шрифтов. Здесь оставляем только те,
-    которые гарантированно умеют кириллицу и часто присутствуют в Linux-окружении.
-    Если конкретного шрифта нет в системе — используем DejaVu Sans как фолбэк.
-    """
-
-    base = "/usr/share/fonts/truetype"
-
-    # В проекте оставляем только DejaVu Sans / DejaVu Serif.
-    # Все остальные ключи безопасно фолбэкаются в DejaVu Sans.
-    font_map = {
-        "dejavu_sans": (
-            f"{base}/dejavu/DejaVuSans.ttf",
-            f"{base}/dejavu/DejaVuSans-Bold.ttf",
-        ),
-        "dejavu_serif": (
-            f"{base}/dejavu/DejaVuSerif.ttf",
-            f"{base}/dejavu/DejaVuSerif-Bold.ttf",
-        ),
-        # Совместимость со старым ключом
-        "sans": (
-            f"{base}/dejavu/DejaVuSans.ttf",
-            f"{base}/dejavu/DejaVuSans-Bold.ttf",
-        ),
-        "serif": (
-            f"{base}/dejavu/DejaVuSerif.ttf",
-            f"{base}/dejavu/DejaVuSerif-Bold.ttf",
-        ),
-    }
+    queue: MaxUpdateQueue = request.app["max_queue"]
+    if not queue.submit(update, key=update_user_id(update)):
+        logging.getLogger(__name__).warning("MAX update rejected: queue is full (%s)", queue.depth)
+        return web.json_response({"ok": False, "error": "busy"}, status=503, headers={"Retry-After": "5"})
+    dedup.remember(dedup_key)
 
-    key = str(font_key or "dejavu_sans").lower()
-    regular, bold = font_map.get(key, font_map["dejavu_sans"])
-
-    # если bold отсутствует — используем regular
-    if not os.path.exists(regular):
-        regular, bold = font_map["dejavu_sans"]
-    if not os.path.exists(bold):
-        bold = regular
-
-    return (regular, bold)
-
-
-def _fit_font(draw: ImageDraw.ImageDraw, text: str, font_path: str, max_width: int, start_size: int, min_size: int = 18):
-    size = start_size
-    while size >= min_size:
-        font = ImageFont.truetype(font_path, size)
-        bbox = draw.textbbox((0, 0), text, font=font)
-        w = bbox[2] - bbox[0]
-        if w <= max_width:
-            return font
-        size -= 2
-    return ImageFont.truetype(font_path, min_size)
-
-
-def _render_award_png(template_filename: str, full_name: str, event_name: str, event_date: str, score: int | None = None, font_key: str = "sans") -> bytes:
-    template_path = os.path.join(CERT_TEMPLATES_DIR, template_filename)
-    if not os.path.exists(template_path):
-        base_name, _ = os.path.splitext(template_filename)
-        for ext in (".png", ".webp", ".jpg", ".jpeg"):
-            candidate = os.path.join(CERT_TEMPLATES_DIR, base_name + ext)
-            if os.path.exists(candidate):
-                template_path = candidate
-                break
-    img = Image.open(template_path).convert("RGBA")
-    w, h = img.size
-    draw = ImageDraw.Draw(img)
-
-    regular_font_path, bold_font_path = _resolve_font_paths(font_key)
-
-    # Блоки текста (относительно размера шаблона)
-    # Требования:
-    # 1) название мероприятия — чуть крупнее и на 10px ниже
-    # 2) ФИО и очки — по центру свободной области сертификата
-    # 3) дата — в самом низу, над цветными полосками
-    max_text_width = int(w * 0.78)
-    gap = max(10, int(h * 0.02))
-
-    # Для дипломов (1/2/3 место) по ТЗ опускаем блоки ниже на 100px,
-    # сертификат оставляем без изменений.
-    offset_y = 100 if template_filename in {"1mesto.png", "2mesto.png", "3mesto.png"} else 0
-
-    # Дата — в самом низу, над цветными полосками
-    date_text = f"Дата: {event_date}".strip()
-    date_font = _fit_font(draw, date_text, regular_font_path, max_text_width, start_size=int(h * 0.03), min_size=18)
-    date_bbox = draw.textbbox((0, 0), date_text, font=date_font)
-    date_w = date_bbox[2] - date_bbox[0]
-    date_h = date_bbox[3] - date_bbox[1]
-    date_bottom_margin = max(36, int(h * 0.055))
-    date_y = h - date_bottom_margin - date_h - 7
-
-    # Мероприятие — чуть крупнее и ниже на 10px
-    event_text = (event_name or "").strip()
-    event_font = _fit_font(draw, event_text, bold_font_path, max_text_width, start_size=int(h * 0.055), min_size=28)
-    event_bbox = draw.textbbox((0, 0), event_text, font=event_font)
-    event_w = event_bbox[2] - event_bbox[0]
-    event_h = event_bbox[3] - event_bbox[1]
-    event_y = int(h * 0.30) + 10 + offset_y
-    draw.text(((w - event_w) / 2, event_y), event_text, font=event_font, fill=(20, 30, 45, 255))
-
-    # Имя участника
-    name_font = _fit_font(draw, full_name, bold_font_path, max_text_width, start_size=int(h * 0.05), min_size=28)
-    name_bbox = draw.textbbox((0, 0), full_name, font=name_font)
-    name_w = name_bbox[2] - name_bbox[0]
-    name_h = name_bbox[3] - name_bbox[1]
-
-    # Очки участника
-    try:
-        score_val = int(score) if score is not None else 0
-    except Exception:
-        score_val = 0
-    score_text = f"Очки: {score_val}"
-    score_font = _fit_font(draw, score_text, regular_font_path, max_text_width, start_size=int(h * 0.035), min_size=18)
-    score_bbox = draw.textbbox((0, 0), score_text, font=score_font)
-    score_w = score_bbox[2] - score_bbox[0]
-    score_h = score_bbox[3] - score_bbox[1]
-
-    # Центрируем блок "имя + очки" в свободной области между мероприятием и датой
-    group_top = event_y + event_h + gap
-    group_bottom = date_y - gap
-    group_h = name_h + gap + score_h
-    if group_bottom > group_top + group_h:
-        name_y = int(group_top + (group_bottom - group_top - group_h) / 2) - 7
-    else:
-        name_y = group_top - 7
-    score_y = name_y + name_h + gap
-
-    draw.text(((w - name_w) / 2, name_y), full_name, font=name_font, fill=(20, 30, 45, 255))
-    draw.text(((w - score_w) / 2, score_y), score_text, font=score_font, fill=(25, 45, 70, 255))
-    draw.text(((w - date_w) / 2, date_y), date_text, font=date_font, fill=(25, 45, 70, 255))
-
-
-    out = BytesIO()
-    img.convert("RGB").save(out, format="PNG", optimize=True)
-    return out.getvalue()
+    # Ошибки обработки логирует очередь; MAX всегда получает 200, чтобы не было ретраев из-за наших исключений.
+    return web.json_response({"ok": True})
 
 
 def _verify_telegram_webapp_init_data(init_data: str, bot_token: str) -> dict | None:
@@ -377,10 +256,16 @@ async def _max_upload_file(app: web.Application, content: bytes, filename: str,
     return uploaded
 
 
-async def _send_document_to_max(app: web.Application, *, content: bytes, filename: str, caption: str, max_user_id: int | None = None, chat_id: int | str | None = None, content_type: str = "application/octet-stream") -> None:
+async def _send_document_to_max(app: web.Application, *, content: bytes, filename: str, caption: str, max_user_id: int | None = None, chat_id: int | str | None = None, content_type: str = "application/octet-stream", uploaded: dict | None = None) -> dict:
+    """Отправляет файл в MAX и возвращает payload загрузки.
+
+    Если передан uploaded (payload с token от прошлой загрузки того же файла),
+    повторной загрузки не делаем — так копия в админ-чат не гоняет файл второй раз.
+    """
     from max_bot import send_message
 
-    uploaded = await _max_upload_file(app, content, filename, content_type=content_type)
+    if uploaded is None:
+        uploaded = await _max_upload_file(app, content, filename, content_type=content_type)
     token = app.get("max_token") or ""
     session: aiohttp.ClientSession = app["max_session"]
 
@@ -397,7 +282,7 @@ async def _send_document_to_max(app: web.Application, *, content: bytes, filenam
                 await send_message(session, token, chat_id=str(chat_id), text=caption, attachments=attachments)
             else:
                 raise ValueError("_send_document_to_max requires max_user_id or chat_id")
-            return
+            return uploaded
         except Exception as e:
             last_error = e
             msg = str(e)
@@ -407,12 +292,12 @@ async def _send_document_to_max(app: web.Application, *, content: bytes, filenam
         raise last_error
 
 
-async def _send_document_to_max_user(app: web.Application, *, max_user_id: int, content: bytes, filename: str, caption: str, content_type: str = "image/png") -> None:
-    await _send_document_to_max(app, max_user_id=max_user_id, content=content, filename=filename, caption=caption, content_type=content_type)
+async def _send_document_to_max_user(app: web.Application, *, max_user_id: int, content: bytes, filename: str, caption: str, content_type: str = "image/png", uploaded: dict | None = None) -> dict:
+    return await _send_document_to_max(app, max_user_id=max_user_id, content=content, filename=filename, caption=caption, content_type=content_type, uploaded=uploaded)
 
 
-async def _send_document_to_max_chat(app: web.Application, *, chat_id: int | str, content: bytes, filename: str, caption: str, content_type: str = "image/png") -> None:
-    await _send_document_to_max(app, chat_id=chat_id, content=content, filename=filename, caption=caption, content_type=content_type)
+async def _send_document_to_max_chat(app: web.Application, *, chat_id: int | str, content: bytes, filename: str, caption: str, content_type: str = "image/png", uploaded: dict | None = None) -> dict:
+    return await _send_document_to_max(app, chat_id=chat_id, content=content, filename=filename, caption=caption, content_type=content_type, uploaded=uploaded)
 
 
 def _verify_admin_token(raw_token: str) -> int | None:
@@ -568,10 +453,57 @@ async def cors_middleware(request: web.Request, handler):
     # Важно: WebApp шлёт initData в кастомном заголовке.
     # Если его не разрешить в CORS, браузер/WebView блокирует запросы (особенно /api/me),
     # и локальный localStorage потом «оживляет» старые очки/рекомендации после админского сброса.
-    resp.headers["Access-Control-Allow-Headers"] = "Content-Type, X-Telegram-InitData, X-Max-InitData, X-Admin-Token"
+    resp.headers["Access-Control-Allow-Headers"] = "Content-Type, X-Telegram-InitData, X-Max-InitData, X-Admin-Token, If-None-Match"
+    # ETag нужен WebApp для ревалидации /api/levels и /api/me (см. _conditional_json_response).
+    resp.headers["Access-Control-Expose-Headers"] = "ETag"
+    return resp
+
+
+def _make_etag(*parts) -> str:
+    """Сильный ETag по содержимому ответа.
+
+    Считаем по данным, а не по process-local версии кеша: за балансировщиком
+    у разных процессов версии не совпадают, а содержимое — совпадает.
+    """
+    digest = hashlib.blake2b(repr(parts).encode("utf-8"), digest_size=12).hexdigest()
+    return f'"{digest}"'
+
+
+def _etag_matches(request: web.Request, etag: str) -> bool:
+    # Помимо стандартного If-None-Match принимаем ?etag=...: кросс-доменный WebApp
+    # шлёт /api/levels без кастомных заголовков, чтобы не было CORS-preflight.
+    raw = request.headers.get("If-None-Match") or request.query.get("etag") or ""
+    if not raw:
+        return False
+    bare = etag.strip('"')
+    for tag in raw.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == "*" or tag.strip('"') == bare:
+            return True
+    return False
+
+
+def _conditional_json_response(request: web.Request, payload: dict, etag: str) -> web.Response:
+    """JSON-ответ с ETag; если клиент прислал тот же ETag — 304 без тела и без сериализации."""
+    if _etag_matches(request, etag):
+        resp = web.Response(status=304)
+    else:
+        resp = web.json_response(payload)
+    resp.headers["ETag"] = etag
     return resp
 
 
+def _set_no_store_headers(resp: web.StreamResponse) -> None:
+    # Внешний браузер/MAX WebView может кешировать ответ и показывать
+    # старый статус уровней даже после успешного переключения в админке.
+    # Ревалидация идёт только через ETag, который WebApp присылает сам.
+    resp.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, max-age=0"
+    resp.headers["Pragma"] = "no-cache"
+    resp.headers["Expires"] = "0"
+
+
 async def handle_levels(request: web.Request) -> web.Response:
     # ВАЖНО: сброс статистики в WebApp должен работать так же надёжно,
     # как и отключение уровней. /api/levels вызывается без кастомных заголовков
@@ -580,46 +512,115 @@ async def handle_levels(request: web.Request) -> web.Response:
     # Также сюда же (по uid в query) добавляем признак существования пользователя и метку удаления:
     # при удалении пользователя в админке WebApp должен очистить localStorage при следующем входе
     # так же надёжно, как и подхватываются отключённые уровни.
-    levels = await get_levels()
-    reset_token = await get_stats_reset_token()
-
+    #
+    # Всё это читается одним запросом (get_client_sync_state): эндпоинт опрашивается
+    # каждые пару секунд каждым открытым клиентом.
+    uid = None
     uid_raw = request.query.get("uid")
-    user_exists = None
+    if uid_raw:
+        try:
+            uid = int(uid_raw)
+        except Exception:
+            uid = None
+
+    try:
+        sync = await get_client_sync_state(uid)
+    except Exception:
+        if uid is None:
+            raise
+        # Ошибка БД или uid вне диапазона BIGINT: отдаём уровни без пользовательской части
+        # (user_exists=None — «неизвестно», WebApp ничего не очищает), а не 500 на опросе.
+        logging.getLogger(__name__).warning("Client sync state failed for uid=%s", uid_raw, exc_info=True)
+        sync = await get_client_sync_state(None)
+    user_exists = sync["user_exists"]
     user_deleted_token = "0"
     user_reset_token = "0"
+    if user_exists is False:
+        user_deleted_token = sync["user_deleted_token"]
+    elif user_exists:
+        user_reset_token = sync["user_reset_token"]
+
+    payload = {
+        "ok": True,
+        "levels": sync["levels"],
+        "reset_token": sync["reset_token"],
+        "user_exists": user_exists,
+        "user_deleted_token": str(user_deleted_token or "0"),
+        "user_reset_token": str(user_reset_token or "0"),
+    }
+    etag = _make_etag(
+        tuple(sorted(payload["levels"].items())),
+        payload["reset_token"],
+        user_exists,
+        payload["user_deleted_token"],
+        payload["user_reset_token"],
+    )
+    resp = _conditional_json_response(request, payload, etag)
+    _set_no_store_headers(resp)
+    return resp
+
+
+
+# Как часто слать keep-alive комментарий в SSE: прокси/балансировщики закрывают «тихие» соединения.
+SSE_KEEPALIVE_SECONDS = 20
+
+
+async def handle_events(request: web.Request) -> web.StreamResponse:
+    """SSE-канал событий админки для WebApp (/api/events?uid=...).
+
+    Клиент получает глобальные события (отключение уровня, сброс статистики)
+    и события своего пользователя (сброс/удаление). Это лишь сигнал «перечитай состояние»:
+    опрос /api/levels остаётся запасным вариантом (и для событий из других процессов).
+    """
+    uid = None
+    uid_raw = request.query.get("uid")
     if uid_raw:
         try:
             uid = int(uid_raw)
-            user = await get_user(uid)
-            user_exists = bool(user)
-            if not user_exists:
-                user_deleted_token = await get_user_deleted_token(uid)
-            else:
-                user_reset_token = await get_user_reset_token(uid)
         except Exception:
-            user_exists = None
-            user_deleted_token = "0"
-            user_reset_token = "0"
-
-    resp = web.json_response(
-        {
-            "ok": True,
-            "levels": levels,
-            "reset_token": reset_token,
-            "user_exists": user_exists,
-            "user_deleted_token": str(user_deleted_token or "0"),
-            "user_reset_token": str(user_reset_token or "0"),
+            uid = None
+
+    sub = broadcaster.subscribe(uid)
+    if sub is None:
+        # Лимит подписчиков: EventSource не переподключается после 503, клиент остаётся на опросе.
+        resp = web.Response(status=503, text="too many subscribers")
+        resp.headers["Access-Control-Allow-Origin"] = "*"
+        return resp
+
+    resp = web.StreamResponse(
+        headers={
+            "Content-Type": "text/event-stream",
+            "Cache-Control": "no-store",
+            "X-Accel-Buffering": "no",
+            # cors_middleware выставляет заголовки уже после prepare(), для потока — поздно.
+            "Access-Control-Allow-Origin": "*",
         }
     )
-    # Внешний браузер/MAX WebView может кешировать ответ /api/levels и показывать
-    # старый статус уровней даже после успешного переключения в админке.
-    resp.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, max-age=0"
-    resp.headers["Pragma"] = "no-cache"
-    resp.headers["Expires"] = "0"
+    try:
+        await resp.prepare(request)
+        await resp.write(b"retry: 5000\n\n")
+        while not sub.closed:
+            try:
+                event = await asyncio.wait_for(sub.get(), timeout=SSE_KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                await resp.write(b": ping\n\n")
+                continue
+            if event is None:
+                break
+            if sub.overflowed:
+                # Часть событий потеряна — просим клиента перечитать состояние целиком.
+                sub.overflowed = False
+                event = {"type": "resync"}
+            data = json.dumps(event, ensure_ascii=False)
+            await resp.write(f"event: {event['type']}\ndata: {data}\n\n".encode("utf-8"))
+    except ConnectionResetError:
+        # Клиент закрыл вкладку. Отмену (остановка сервера) не глотаем — finally всё равно отпишет.
+        pass
+    finally:
+        broadcaster.unsubscribe(sub)
     return resp
 
 
-
 async def handle_me(request: web.Request) -> web.Response:
     """Возвращает состояние пользователя для WebApp.
 
@@ -627,9 +628,6 @@ async def handle_me(request: web.Request) -> web.Response:
     локальная статистика (localStorage) не «оживляла» старые результаты
     после повторной регистрации.
     """
-    # Сначала получаем текущий reset_token (он нужен даже если пользователя ещё нет в БД)
-    reset_token = await get_stats_reset_token()
-
     init_data = request.headers.get("X-Telegram-InitData", "")
     token = os.getenv("BOT_TOKEN", "")
     parsed = _verify_telegram_webapp_init_data(init_data, token)
@@ -638,6 +636,8 @@ async def handle_me(request: web.Request) -> web.Response:
 
     user_raw = parsed.get("user")
     if not user_raw:
+        # reset_token нужен даже если пользователя ещё нет в БД
+        reset_token = (await get_client_sync_state(None))["reset_token"]
         return web.json_response(
             {
                 "ok": True,
@@ -656,14 +656,26 @@ async def handle_me(request: web.Request) -> web.Response:
     except Exception:
         return web.json_response({"ok": False, "error": "bad_user"}, status=400)
 
-    # Метка удаления пользователя (если админ удалил его в панели) — нужна, чтобы очистить localStorage в WebApp.
-    user_deleted_token = await get_user_deleted_token(tg_id)
-    # Метка сброса статистики пользователя (если админ очистил только его).
-    user_reset_token = await get_user_reset_token(tg_id)
-
-    row = await get_user_profile(tg_id)
+    # Одним запросом: reset_token, профиль, метка удаления пользователя (если админ удалил его в панели)
+    # и метка сброса статистики пользователя (если админ очистил только его) —
+    # всё это нужно, чтобы очистить localStorage в WebApp.
+    try:
+        sync = await get_client_sync_state(tg_id)
+    except Exception:
+        # Без данных пользователя отвечать «exists: false» нельзя — WebApp очистит локальные результаты.
+        # Отдаём ошибку: клиент пропускает неуспешный ответ и повторит синхронизацию позже.
+        logging.getLogger(__name__).warning("Client sync state failed for tg_id=%s", tg_id, exc_info=True)
+        return web.json_response({"ok": False, "error": "unavailable"}, status=503)
+    reset_token = sync["reset_token"]
+    user_deleted_token = sync["user_deleted_token"]
+    user_reset_token = sync["user_reset_token"]
+
+    row = sync["user"]
+    # ETag по всем полям ответа: WebApp присылает его обратно и получает 304, если ничего не изменилось.
+    etag = _make_etag(reset_token, user_deleted_token, user_reset_token, row)
     if not row:
-        return web.json_response(
+        return _conditional_json_response(
+            request,
             {
                 "ok": True,
                 "exists": False,
@@ -672,11 +684,13 @@ async def handle_me(request: web.Request) -> web.Response:
                 "reset_token": reset_token,
                 "user_deleted_token": user_deleted_token,
                 "user_reset_token": user_reset_token,
-            }
+            },
+            etag,
         )
 
     telegram_id, first_name, last_name, age, city, score, aptitude_top = row
-    return web.json_response(
+    return _conditional_json_response(
+        request,
         {
             "ok": True,
             "reset_token": reset_token,
@@ -693,7 +707,8 @@ async def handle_me(request: web.Request) -> web.Response:
                 "score": score,
                 "aptitude_top": aptitude_top,
             },
-        }
+        },
+        etag,
     )
 
 async def handle_max_save_stats(request: web.Request) -> web.Response:
@@ -1042,6 +1057,146 @@ async def admin_create_backup(request: web.Request) -> web.Response:
     )
 
 
+def _award_caption(template_key: str, event_name: str, event_date: str, score) -> str:
+    try:
+        caption = cert_templates.get(template_key).title
+    except TemplateError:
+        caption = "Сертификат"
+    return f"{caption}\n{event_name} — {event_date}\nОчки: {score if score is not None else 0}"
+
+
+async def admin_award_templates(request: web.Request) -> web.Response:
+    """Список шаблонов сертификатов/дипломов для выбора в админке."""
+    await _require_admin(request)
+    return web.json_response(
+        {
+            "ok": True,
+            "templates": [{"key": tpl.key, "title": tpl.title} for tpl in cert_templates.items()],
+        }
+    )
+
+
+async def _deliver_award(app: web.Application, *, tg_id: int, full_name: str, content: bytes, filename: str, caption: str, content_type: str = "image/png", copy_to_admins: bool = True) -> None:
+    """Отправляет готовый сертификат пользователю (Telegram или MAX) и, при copy_to_admins, копии в админ-каналы.
+
+    Частота отправки ограничена отдельно для каждой платформы (AWARD_TG_RATE / AWARD_MAX_RATE).
+    Файл загружается на платформу один раз: копии отправляются по Telegram file_id / MAX upload token.
+    """
+    max_uploaded = None
+    if int(tg_id) < 0:
+        # MAX-пользователи в общей БД хранятся как отрицательные ID.
+        # Telegram Bot API не умеет отправлять документы таким пользователям,
+        # поэтому отправляем файл через MAX Bot API.
+        await app["award_max_limiter"].acquire()
+        max_uploaded = await _send_document_to_max_user(
+            app,
+            max_user_id=_max_user_id_from_db_id(int(tg_id)),
+            content=content,
+            filename=filename,
+            caption=caption,
+            content_type=content_type,
+        )
+    else:
+        bot: Bot = app["bot"]
+        await app["award_tg_limiter"].acquire()
+        file = BufferedInputFile(content, filename=filename)
+        sent = await bot.send_document(chat_id=tg_id, document=file, caption=caption)
+
+        # Дублируем админу в закрытый канал (если задано)
+        admin_channel_id_raw = (os.getenv("ADMIN_CHANNEL_ID") or "").strip()
+        if copy_to_admins and admin_channel_id_raw:
+            try:
+                admin_channel_id = int(admin_channel_id_raw)
+                admin_caption = (
+                    f"🗂 Копия: {caption}\n"
+                    f"Пользователь: {full_name}\n"
+                    f"Telegram ID: {tg_id}"
+                )
+                # Файл уже на серверах Telegram — копию отправляем по file_id, без повторной загрузки.
+                # (BufferedInputFile нельзя надёжно переиспользовать — если file_id нет, создаём новый объект.)
+                document = getattr(getattr(sent, "document", None), "file_id", None)
+                if not document:
+                    document = BufferedInputFile(content, filename=filename)
+                await app["award_tg_limiter"].acquire()
+                await bot.send_document(chat_id=admin_channel_id, document=document, caption=admin_caption)
+            except Exception:
+                # Не блокируем отправку пользователю, если канал недоступен/не настроен
+                pass
+
+    max_admin_chat_id = (os.getenv("MAX_ADMIN_LOG_CHAT_ID") or "").strip()
+    if copy_to_admins and max_admin_chat_id:
+        try:
+            max_admin_caption = (
+                f"🗂 Копия: {caption}\n"
+                f"Пользователь: {full_name}\n"
+                f"ID: {tg_id}\n"
+                f"Платформа: {'MAX' if int(tg_id) < 0 else 'Telegram'}"
+            )
+            await app["award_max_limiter"].acquire()
+            await _send_document_to_max_chat(
+                app,
+                chat_id=max_admin_chat_id,
+                content=content,
+                filename=filename,
+                caption=max_admin_caption,
+                content_type=content_type,
+                uploaded=max_uploaded,
+            )
+        except Exception:
+            pass
+
+
+async def admin_award_preview(request: web.Request) -> web.Response:
+    """Превью сертификата в низком разрешении (JPEG/WebP) — админка запрашивает его по мере ввода.
+
+    Рендер идёт в потоке на уменьшенной копии шаблона (единицы–десятки мс) и не занимает
+    очередь пула рендеринга; одновременных превью не больше AWARD_PREVIEW_CONCURRENCY.
+    """
+    await _require_admin(request)
+    payload = await request.json()
+
+    template_key = str(payload.get("template_key") or "participation")
+    if template_key not in cert_templates:
+        raise web.HTTPBadRequest(text="Unknown certificate template")
+
+    full_name = "Иванов Иван"
+    score = 0
+    try:
+        tg_id = int(payload.get("telegram_id") or 0)
+    except (TypeError, ValueError):
+        tg_id = 0
+    if tg_id:
+        user = await get_user(tg_id)
+        if user:
+            _, first_name, last_name, _, _city, score = user
+            full_name = f"{first_name or ''} {last_name or ''}".strip() or str(tg_id)
+
+    event_name = str(payload.get("event_name") or "").strip()[:300] or "Название мероприятия"
+    event_date = str(payload.get("event_date") or "").strip()[:100] or datetime.now().strftime("%d.%m.%Y")
+    font_key = str(payload.get("font_key") or "sans").strip()
+    fmt = "webp" if str(payload.get("format") or "").lower() == "webp" else "jpeg"
+    try:
+        width = int(payload.get("width") or 360)
+    except (TypeError, ValueError):
+        width = 360
+    # Ширину округляем до шага 120px: уменьшенные копии шаблона кешируются по ширине.
+    width = min(720, max(120, (width + 119) // 120 * 120))
+
+    async with request.app["award_preview_sem"]:
+        preview = await asyncio.to_thread(
+            render_award_preview,
+            template_key,
+            full_name,
+            event_name,
+            event_date,
+            score=score,
+            font_key=font_key,
+            width=width,
+            fmt=fmt,
+        )
+    return web.Response(body=preview.data, content_type=preview.content_type, headers={"Cache-Control": "no-store"})
+
+
 async def admin_send_award(request: web.Request) -> web.Response:
     admin_id = await _require_admin(request)
     payload = await request.json()
@@ -1066,79 +1221,36 @@ async def admin_send_award(request: web.Request) -> web.Response:
     _, first_name, last_name, _, _city, score = user
     full_name = f"{first_name or ''} {last_name or ''}".strip() or str(tg_id)
 
-    template_map = {
-        "participation": "sertificat.png",
-    }
-    if template_key not in template_map:
-        raise web.HTTPBadRequest(text="Only participation certificate is allowed")
-
-    png_bytes = _render_award_png(
-        template_filename=template_map[template_key],
-        full_name=full_name,
-        event_name=event_name,
-        event_date=event_date,
-        score=score,
-        font_key=font_key,
-    )
+    if template_key not in cert_templates:
+        raise web.HTTPBadRequest(text="Unknown certificate template")
 
-    filename = f"award_{template_key}_{abs(tg_id)}.png"
-    caption = (
-        "Сертификат за участие" if template_key == "participation" else f"Диплом за {template_key} место"
-    )
-    caption = f"{caption}\n{event_name} — {event_date}\nОчки: {score if score is not None else 0}"
+    # Рендер — в пуле процессов (см. cert_render.RenderPool), event loop не блокируется.
+    # Формат файла (PNG/JPEG/WebP/PDF) задаётся настройками шаблона; повторная отправка берётся из кеша.
+    try:
+        rendered = await render_pool.render(
+            template_key=template_key,
+            full_name=full_name,
+            event_name=event_name,
+            event_date=event_date,
+            score=score,
+            font_key=font_key,
+        )
+    except RenderBusy:
+        raise web.HTTPServiceUnavailable(text="Render queue is full, try again later", headers={"Retry-After": "5"})
+
+    filename = f"award_{template_key}_{abs(tg_id)}{rendered.ext}"
+    caption = _award_caption(template_key, event_name, event_date, score)
 
     try:
-        if int(tg_id) < 0:
-            # MAX-пользователи в общей БД хранятся как отрицательные ID.
-            # Telegram Bot API не умеет отправлять документы таким пользователям,
-            # поэтому отправляем файл через MAX Bot API.
-            await _send_document_to_max_user(
-                request.app,
-                max_user_id=_max_user_id_from_db_id(int(tg_id)),
-                content=png_bytes,
-                filename=filename,
-                caption=caption,
-            )
-        else:
-            bot: Bot = request.app["bot"]
-            file = BufferedInputFile(png_bytes, filename=filename)
-            await bot.send_document(chat_id=tg_id, document=file, caption=caption)
-
-            # Дублируем админу в закрытый канал (если задано)
-            admin_channel_id_raw = (os.getenv("ADMIN_CHANNEL_ID") or "").strip()
-            if admin_channel_id_raw:
-                try:
-                    admin_channel_id = int(admin_channel_id_raw)
-                    admin_caption = (
-                        f"🗂 Копия: {caption}\n"
-                        f"Пользователь: {full_name}\n"
-                        f"Telegram ID: {tg_id}"
-                    )
-                    # BufferedInputFile нельзя надёжно переиспользовать — создаём новый объект из тех же bytes
-                    file2 = BufferedInputFile(png_bytes, filename=filename)
-                    await bot.send_document(chat_id=admin_channel_id, document=file2, caption=admin_caption)
-                except Exception:
-                    # Не блокируем отправку пользователю, если канал недоступен/не настроен
-                    pass
-
-        max_admin_chat_id = (os.getenv("MAX_ADMIN_LOG_CHAT_ID") or "").strip()
-        if max_admin_chat_id:
-            try:
-                max_admin_caption = (
-                    f"🗂 Копия: {caption}\n"
-                    f"Пользователь: {full_name}\n"
-                    f"ID: {tg_id}\n"
-                    f"Платформа: {'MAX' if int(tg_id) < 0 else 'Telegram'}"
-                )
-                await _send_document_to_max_chat(
-                    request.app,
-                    chat_id=max_admin_chat_id,
-                    content=png_bytes,
-                    filename=filename,
-                    caption=max_admin_caption,
-                )
-            except Exception:
-                pass
+        await _deliver_award(
+            request.app,
+            tg_id=tg_id,
+            full_name=full_name,
+            content=rendered.data,
+            filename=filename,
+            caption=caption,
+            content_type=rendered.content_type,
+        )
     except Exception as e:
         # например, пользователь не писал боту/заблокировал или MAX upload/message завершились ошибкой
         raise web.HTTPBadRequest(text=f"Send failed: {e}")
@@ -1154,7 +1266,299 @@ async def admin_send_award(request: web.Request) -> web.Response:
     return web.json_response({"ok": True, "sent_to": tg_id})
 
 
-def create_app() -> web.Application:
+# -------------------------
+# Массовая выдача сертификатов
+# -------------------------
+
+async def _render_award_waiting(params: dict, full_name: str, score, **extra):
+    """Рендер для массовых операций: при занятой очереди ждём, а не падаем."""
+    while True:
+        try:
+            return await render_pool.render(
+                template_key=params["template_key"],
+                full_name=full_name,
+                event_name=params["event_name"],
+                event_date=params["event_date"],
+                score=score,
+                font_key=params["font_key"],
+                **extra,
+            )
+        except RenderBusy:
+            # Очередь рендера занята (в т.ч. одиночными отправками из админки).
+            await asyncio.sleep(0.5)
+
+
+async def _process_award_recipient(app: web.Application, job, recipient) -> None:
+    """Рендер и отправка одного сертификата из задачи массовой выдачи."""
+    tg_id, full_name, score = recipient
+    params = job.params
+    rendered = await _render_award_waiting(params, full_name, score)
+
+    filename = f"award_{params['template_key']}_{abs(int(tg_id))}{rendered.ext}"
+    caption = _award_caption(params["template_key"], params["event_name"], params["event_date"], score)
+    for attempt in range(3):
+        try:
+            # Копии в админ-каналы при массовой выдаче не шлём: вместо сотен копий — одна сводка в конце.
+            await _deliver_award(
+                app,
+                tg_id=int(tg_id),
+                full_name=full_name,
+                content=rendered.data,
+                filename=filename,
+                caption=caption,
+                content_type=rendered.content_type,
+                copy_to_admins=False,
+            )
+            return
+        except TelegramRetryAfter as e:
+            if attempt == 2:
+                raise
+            await asyncio.sleep(float(e.retry_after) + 0.5)
+
+
+async def _on_award_job_finish(app: web.Application, job) -> None:
+    progress = job.progress()
+    actor = await _format_actor(job.admin_id)
+    ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    status = {"done": "завершена", "cancelled": "остановлена"}.get(job.status, job.status)
+    await _send_admin_log(
+        app,
+        f"🏅 Массовая выдача сертификатов {status}\n"
+        f"Мероприятие: {job.params['event_name']} — {job.params['event_date']}\n"
+        f"Отправлено: {progress['sent']} из {progress['total']}, ошибок: {progress['failed']}\n"
+        f"Админ: {actor}\nВремя: {ts}",
+    )
+
+
+def _start_award_job(app: web.Application, job) -> None:
+    app["award_jobs"].start(
+        job,
+        lambda job_, recipient: _process_award_recipient(app, job_, recipient),
+        on_finish=lambda job_: _on_award_job_finish(app, job_),
+    )
+
+
+async def _award_params_and_recipients(payload) -> tuple[dict, list]:
+    """Параметры массовой операции и получатели по фильтру: mode=top (первые top по очкам) | city | all.
+
+    payload — JSON-тело или query-параметры запроса.
+    """
+    mode = str(payload.get("mode") or "top").strip()
+    template_key = str(payload.get("template_key") or "participation")
+    event_name = str(payload.get("event_name") or "").strip()
+    event_date = str(payload.get("event_date") or "").strip()
+    font_key = str(payload.get("font_key") or "sans").strip()
+
+    if not event_name:
+        raise web.HTTPBadRequest(text="event_name required")
+    if not event_date:
+        raise web.HTTPBadRequest(text="event_date required")
+    if template_key not in cert_templates:
+        raise web.HTTPBadRequest(text="Unknown certificate template")
+
+    top = None
+    city = None
+    if mode == "top":
+        try:
+            top = int(payload.get("top") or 0)
+        except Exception:
+            top = 0
+        if top <= 0:
+            raise web.HTTPBadRequest(text="top must be a positive number")
+    elif mode == "city":
+        city = str(payload.get("city") or "").strip()
+        if not city:
+            raise web.HTTPBadRequest(text="city required")
+    elif mode != "all":
+        raise web.HTTPBadRequest(text="mode must be top, city or all")
+
+    rows = await get_award_recipients(top=top, city=city)
+    recipients = [
+        (int(tid), f"{first_name or ''} {last_name or ''}".strip() or str(tid), score)
+        for (tid, first_name, last_name, score) in rows
+    ]
+    if not recipients:
+        raise web.HTTPBadRequest(text="No users match the filter")
+
+    params = {
+        "mode": mode,
+        "top": top,
+        "city": city,
+        "template_key": template_key,
+        "event_name": event_name,
+        "event_date": event_date,
+        "font_key": font_key,
+    }
+    return params, recipients
+
+
+async def admin_award_job_create(request: web.Request) -> web.Response:
+    """Запуск массовой выдачи по фильтру (см. _award_params_and_recipients)."""
+    admin_id = await _require_admin(request)
+    payload = await request.json()
+    params, recipients = await _award_params_and_recipients(payload)
+
+    job = request.app["award_jobs"].create(params, recipients, admin_id)
+    _start_award_job(request.app, job)
+
+    actor = await _format_actor(admin_id)
+    ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    await _send_admin_log(
+        request.app,
+        f"🏅 Массовая выдача сертификатов запущена\nПолучателей: {len(recipients)}\nАдмин: {actor}\nВремя: {ts}",
+    )
+    return web.json_response({"ok": True, "job": job.progress()})
+
+
+async def admin_award_job_status(request: web.Request) -> web.Response:
+    """Прогресс задачи (?job_id=...) или список последних задач."""
+    await _require_admin(request)
+    jobs: AwardJobManager = request.app["award_jobs"]
+    job_id = (request.query.get("job_id") or "").strip()
+    if not job_id:
+        return web.json_response({"ok": True, "jobs": [j.progress() for j in jobs.recent()]})
+    job = jobs.get(job_id)
+    if job is None:
+        raise web.HTTPNotFound(text="Job not found")
+    return web.json_response({"ok": True, "job": job.progress()})
+
+
+async def _award_job_from_payload(request: web.Request):
+    payload = await request.json()
+    job = request.app["award_jobs"].get(str(payload.get("job_id") or ""))
+    if job is None:
+        raise web.HTTPNotFound(text="Job not found")
+    return job
+
+
+async def admin_award_job_cancel(request: web.Request) -> web.Response:
+    await _require_admin(request)
+    job = await _award_job_from_payload(request)
+    request.app["award_jobs"].cancel(job)
+    return web.json_response({"ok": True, "job": job.progress()})
+
+
+async def admin_award_job_resume(request: web.Request) -> web.Response:
+    """Продолжить остановленную задачу: отправить неотправленным и получившим ошибку."""
+    await _require_admin(request)
+    job = await _award_job_from_payload(request)
+    _start_award_job(request.app, job)
+    return web.json_response({"ok": True, "job": job.progress()})
+
+
+async def admin_award_export(request: web.Request) -> web.StreamResponse:
+    """Выгрузка сертификатов для печати: ZIP (по файлу на участника) или один многостраничный PDF.
+
+    Фильтр и параметры — в query, как у массовой выдачи (mode/top/city, event_name, ...), плюс format=zip|pdf.
+    Сертификаты рендерятся в пуле по порядку, не больше AWARD_EXPORT_WINDOW впереди записи,
+    и сразу пишутся в ответ — память не зависит от числа участников. Участники, чьи сертификаты
+    отрисовать не удалось, перечислены в errors.txt (ZIP) или на последних страницах (PDF).
+    """
+    admin_id = await _require_admin(request)
+    export_format = (request.query.get("format") or "zip").strip().lower()
+    if export_format not in {"zip", "pdf"}:
+        raise web.HTTPBadRequest(text="format must be zip or pdf")
+    params, recipients = await _award_params_and_recipients(request.query)
+
+    template_key = params["template_key"]
+    if export_format == "pdf":
+        # Страницы PDF — JPEG: вставляются в PDF как есть, без перекодирования.
+        output = {"format": "jpeg", "quality": int(os.getenv("CERT_JPEG_QUALITY", "92"))}
+        writer = PdfStreamWriter()
+        content_type = "application/pdf"
+    else:
+        output = output_settings(template_key)
+        writer = ZipStreamWriter()
+        content_type = "application/zip"
+    width_px, height_px = cert_templates.get(template_key).size
+
+    filename = f"awards_{template_key}_{datetime.now().strftime('%Y%m%d_%H%M')}.{export_format}"
+    response = web.StreamResponse(
+        headers={
+            "Content-Type": content_type,
+            "Content-Disposition": f'attachment; filename="{filename}"',
+            "Cache-Control": "no-store",
+        }
+    )
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+
+    async def _render(recipient):
+        _tg_id, full_name, score = recipient
+        return await _render_award_waiting(params, full_name, score, output=output, use_cache=False)
+
+    window = max(1, int(os.getenv("AWARD_EXPORT_WINDOW", str(render_pool.workers + 1))))
+    pending: deque = deque()
+    queue = iter(enumerate(recipients, start=1))
+
+    def _fill() -> None:
+        while len(pending) < window:
+            item = next(queue, None)
+            if item is None:
+                return
+            pending.append((item, asyncio.create_task(_render(item[1]))))
+
+    errors = []
+    written = 0
+    try:
+        await response.write(writer.start())
+        _fill()
+        while pending:
+            (index, (tg_id, full_name, _score)), task = pending.popleft()
+            try:
+                rendered = await task
+            except Exception as e:
+                errors.append(f"{tg_id} {full_name}: {e}")
+                _fill()
+                continue
+            _fill()
+            if export_format == "pdf":
+                chunk = writer.add(rendered.data, width_px, height_px)
+            else:
+                chunk = writer.add(f"{index:04d}_{safe_filename(full_name)}_{abs(int(tg_id))}{rendered.ext}", rendered.data)
+            await response.write(chunk)
+            written += 1
+        if errors and export_format == "zip":
+            await response.write(writer.add("errors.txt", "\n".join(errors).encode("utf-8")))
+        elif errors:
+            # В PDF список ошибок — последними страницами: без них пропавшие страницы
+            # (или пустой документ, если не удалось ничего) видны только в логе.
+            title = (
+                "Ни один сертификат не удалось сформировать"
+                if written == 0
+                else f"Не удалось сформировать {len(errors)} из {len(recipients)} сертификатов"
+            )
+            pages = await asyncio.to_thread(render_text_pages, title, errors, (width_px, height_px))
+            for page in pages:
+                await response.write(writer.add(page, width_px, height_px))
+        await response.write(writer.finish())
+        await response.write_eof()
+    finally:
+        # Клиент мог оборвать загрузку — не рендерим остаток впустую.
+        for _item, task in pending:
+            task.cancel()
+
+    actor = await _format_actor(admin_id)
+    ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    await _send_admin_log(
+        request.app,
+        f"🖨 Выгрузка сертификатов ({export_format.upper()})\n"
+        f"Мероприятие: {params['event_name']} — {params['event_date']}\n"
+        f"Файлов: {written} из {len(recipients)}, ошибок: {len(errors)}\n"
+        f"Админ: {actor}\nВремя: {ts}",
+    )
+    return response
+
+
+async def admin_max_queue(request: web.Request) -> web.Response:
+    """Метрики очереди MAX webhook (глубина, отказы при переполнении, время ожидания и обработки) и отсева дублей."""
+    await _require_admin(request)
+    queue: MaxUpdateQueue = request.app["max_queue"]
+    dedup: UpdateDeduplicator = request.app["max_dedup"]
+    return web.json_response({"ok": True, "queue": queue.metrics(), "dedup": dedup.metrics()})
+
+
+def create_app(dispatcher=None) -> web.Application:
     app = web.Application(middlewares=[cors_middleware])
 
     # Bot instance для отправки грамот из админ-панели
@@ -1173,7 +1577,14 @@ def create_app() -> web.Application:
     # Токен MAX бота (для webhook / отправки сообщений)
     app["max_token"] = (os.getenv("MAX_BOT_TOKEN") or "").strip()
     app["max_secret"] = (os.getenv("MAX_WEBHOOK_SECRET") or "").strip()
-    app["max_state"] = {}  # простой in-memory FSM для регистрации
+    # Шаги регистрации MAX: MAX_STATE_STORE=db (по умолчанию, общее для процессов и переживает
+    # перезапуск) или memory. Брошенные регистрации истекают через MAX_STATE_TTL секунд.
+    app["max_state"] = create_state_store(
+        os.getenv("MAX_STATE_STORE", "db"),
+        ttl=float(os.getenv("MAX_STATE_TTL", str(24 * 3600))),
+        maxsize=int(os.getenv("MAX_STATE_CACHE_SIZE", "10000")),
+        cache_ttl=float(os.getenv("MAX_STATE_CACHE_TTL", "5")),
+    )
     app["max_session"] = aiohttp.ClientSession()  # общий session для MAX API
 
     async def _close_max(app_: web.Application):
@@ -1181,12 +1592,80 @@ def create_app() -> web.Application:
             await app_["max_session"].close()
         except Exception:
             pass
+        await app_["max_state"].close()
 
     app.on_cleanup.append(_close_max)
 
+    # Очередь MAX Update: webhook отвечает сразу, воркеры обрабатывают update по порядку для каждого пользователя.
+    # Отсев повторных доставок: в памяти (MAX_DEDUP_TTL секунд, до MAX_DEDUP_SIZE ключей)
+    # и, при MAX_DEDUP_DB=1, в общей таблице БД — для нескольких процессов.
+    app["max_dedup"] = UpdateDeduplicator(
+        maxsize=int(os.getenv("MAX_DEDUP_SIZE", "10000")),
+        ttl=float(os.getenv("MAX_DEDUP_TTL", "600")),
+        claim=claim_max_update if _parse_boolish(os.getenv("MAX_DEDUP_DB")) else None,
+        prune=prune_max_updates,
+    )
+
+    async def _handle_max_update(update: dict):
+        from max_bot import handle_update, update_dedup_key
+        if not await app["max_dedup"].claim(update_dedup_key(update)):
+            return
+        await handle_update(app, update)
+
+    app["max_queue"] = MaxUpdateQueue(
+        _handle_max_update,
+        workers=int(os.getenv("MAX_WEBHOOK_WORKERS", "8")),
+        maxsize=int(os.getenv("MAX_QUEUE_SIZE", "1000")),
+    )
+
+    async def _start_max_queue(app_: web.Application):
+        app_["max_queue"].start()
+
+    # Останавливаем в on_shutdown: принятые update дорабатываются, пока max_session ещё открыт.
+    async def _stop_max_queue(app_: web.Application):
+        await app_["max_queue"].stop(timeout=float(os.getenv("MAX_QUEUE_DRAIN_TIMEOUT", "10")))
+
+    app.on_startup.append(_start_max_queue)
+    app.on_shutdown.append(_stop_max_queue)
+
+    # SSE-подписчики держат соединения бесконечно — завершаем их до остановки сервера.
+    async def _close_events(app_: web.Application):
+        broadcaster.close_all()
+
+    app.on_shutdown.append(_close_events)
+
+    # Пул рендеринга сертификатов: проверяем шаблоны и прогреваем воркеры в фоне при старте, гасим при остановке.
+    async def _start_render_pool(app_: web.Application):
+        for error in cert_templates.load():
+            logging.getLogger(__name__).error("Certificate template skipped: %s", error)
+        if not cert_templates.items():
+            logging.getLogger(__name__).error("No certificate templates loaded from %s", cert_templates.directory)
+        app_["render_warm_task"] = asyncio.create_task(render_pool.warm())
+
+    async def _stop_render_pool(app_: web.Application):
+        task = app_.get("render_warm_task")
+        if task is not None:
+            task.cancel()
+        render_pool.shutdown()
+
+    app.on_startup.append(_start_render_pool)
+    app.on_cleanup.append(_stop_render_pool)
+
+    # Массовая выдача сертификатов: задачи в памяти процесса, частота отправки — по платформам.
+    app["award_jobs"] = AwardJobManager(concurrency=int(os.getenv("AWARD_JOB_CONCURRENCY", str(render_pool.workers))))
+    app["award_tg_limiter"] = RateLimiter(float(os.getenv("AWARD_TG_RATE", "20")))
+    app["award_max_limiter"] = RateLimiter(float(os.getenv("AWARD_MAX_RATE", "5")))
+    app["award_preview_sem"] = asyncio.Semaphore(max(1, int(os.getenv("AWARD_PREVIEW_CONCURRENCY", "2"))))
+
+    async def _stop_award_jobs(app_: web.Application):
+        await app_["award_jobs"].shutdown()
+
+    app.on_shutdown.append(_stop_award_jobs)
+
     # API
     app.router.add_get("/api/levels", handle_levels)
     app.router.add_get("/api/me", handle_me)
+    app.router.add_get("/api/events", handle_events)
     app.router.add_post("/api/max/save_stats", handle_max_save_stats)
 
     app.router.add_get("/api/admin/stats", admin_get_stats)
@@ -1196,22 +1675,64 @@ def create_app() -> web.Application:
     app.router.add_post("/api/admin/delete_all_users", admin_delete_all_users)
     app.router.add_get("/api/admin/set_level", admin_set_level)
     app.router.add_post("/api/admin/set_level", admin_set_level)
+    app.router.add_get("/api/admin/award_templates", admin_award_templates)
+    app.router.add_post("/api/admin/award_preview", admin_award_preview)
     app.router.add_post("/api/admin/send_award", admin_send_award)
+    app.router.add_post("/api/admin/award_job", admin_award_job_create)
+    app.router.add_get("/api/admin/award_job", admin_award_job_status)
+    app.router.add_post("/api/admin/award_job/cancel", admin_award_job_cancel)
+    app.router.add_post("/api/admin/award_job/resume", admin_award_job_resume)
+    app.router.add_get("/api/admin/award_export", admin_award_export)
     app.router.add_post("/api/admin/create_backup", admin_create_backup)
+    app.router.add_get("/api/admin/max_queue", admin_max_queue)
 
     # MAX webhook
     app.router.add_post("/max/webhook", handle_max_webhook)
 
-    # Static webapp
-    app.router.add_static("/", WEBAPP_DIR, show_index=True)
+    # Telegram webhook (вместо polling): включается TG_WEBHOOK_URL, если bot.py передал dispatcher.
+    # Update обрабатываются тем же app["bot"], не больше TG_WEBHOOK_CONCURRENCY одновременно.
+    tg_webhook_url = (os.getenv("TG_WEBHOOK_URL") or "").strip()
+    if dispatcher is not None and tg_webhook_url:
+        from tg_webhook import default_secret_token, setup_telegram_webhook
+
+        setup_telegram_webhook(
+            app,
+            dispatcher,
+            url=tg_webhook_url,
+            path=(os.getenv("TG_WEBHOOK_PATH") or "/tg/webhook").strip(),
+            secret_token=(os.getenv("TG_WEBHOOK_SECRET") or "").strip() or default_secret_token(token),
+            concurrency=int(os.getenv("TG_WEBHOOK_CONCURRENCY", "16")),
+            max_pending=int(os.getenv("TG_WEBHOOK_MAX_PENDING", "1000")),
+            max_connections=int(os.getenv("TG_WEBHOOK_MAX_CONNECTIONS", "40")),
+            set_webhook=_parse_boolish(os.getenv("TG_WEBHOOK_SET", "1")),
+        )
+
+    # Static webapp: предсжатые текстовые файлы, версионированные URL (?v=<хеш>) и ETag,
+    # уменьшенные варианты крупных картинок. Манифест и сжатые варианты собираются при старте,
+    # варианты картинок — фоном (и по первому запросу).
+    static_assets = StaticAssets(WEBAPP_DIR, variants_dir=(os.getenv("STATIC_VARIANTS_DIR") or "").strip() or None)
+    app["static_assets"] = static_assets
+
+    async def _build_static(app_: web.Application):
+        await asyncio.to_thread(static_assets.build)
+        app_["static_variants_task"] = asyncio.create_task(static_assets.warm_variants())
+
+    async def _stop_static(app_: web.Application):
+        task = app_.get("static_variants_task")
+        if task is not None:
+            task.cancel()
+
+    app.on_startup.append(_build_static)
+    app.on_cleanup.append(_stop_static)
+    app.router.add_get("/{path:.*}", static_assets.handle)
     return app
 
 
-async def run_web_server() -> None:
+async def run_web_server(dispatcher=None) -> None:
     host = os.getenv("WEB_HOST", "0.0.0.0")
     port = int(os.getenv("WEB_PORT", os.getenv("PORT", "8080")))
 
-    app = create_app()
+    app = create_app(dispatcher)
     runner = web.AppRunner(app)
     await runner.setup()
     site = web.TCPSite(runner, host=host, port=port)
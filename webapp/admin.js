@@ -133,6 +133,7 @@ async function init() {
       sample.style.fontFamily = chosen.css;
       sample.textContent = "Пример: Абвгд Ёжик 123";
     }
+    scheduleAwardPreview();
   }
 
   function setupAwardFontPicker() {
@@ -271,7 +272,7 @@ async function init() {
   }
 
   async function api(path, opts = {}) {
-    const { timeoutMs: _timeoutMs, ...fetchOpts } = opts;
+    const { timeoutMs: _timeoutMs, asBlob, ...fetchOpts } = opts;
     const headers = Object.assign({}, fetchOpts.headers || {});
 
     if (hasAdminToken) {
@@ -323,6 +324,7 @@ async function init() {
       throw new Error(`${res.status} ${t || res.statusText}`);
     }
 
+    if (asBlob) return await res.blob();
     const ct = res.headers.get("content-type") || "";
     if (!ct.includes("application/json")) return await res.text().catch(() => "");
     return res.json();
@@ -449,6 +451,7 @@ function renderAwardsListFromCache() {
         selectedAwardId = Number(u.telegram_id);
         if ($awardsSelected) $awardsSelected.textContent = `${userTitle(u)} (ID: ${selectedAwardId})`;
         renderAwardsListFromCache();
+        scheduleAwardPreview();
       },
     });
 
@@ -757,6 +760,83 @@ function renderAwardsListFromCache() {
     }
   });
 
+  // --- Превью сертификата (рендер на сервере в низком разрешении, по мере ввода) ---
+  let awardPreviewTimer = null;
+  let awardPreviewSeq = 0;
+  let awardPreviewUrl = null;
+
+  function scheduleAwardPreview(delayMs = 400) {
+    if (!screens.awards?.classList.contains("active")) return;
+    if (awardPreviewTimer) clearTimeout(awardPreviewTimer);
+    awardPreviewTimer = setTimeout(loadAwardPreview, delayMs);
+  }
+
+  async function loadAwardPreview() {
+    awardPreviewTimer = null;
+    const $wrap = byId("award-preview-wrap");
+    if (!$wrap) return;
+    const seq = ++awardPreviewSeq;
+    try {
+      const blob = await api("/api/admin/award_preview", {
+        method: "POST",
+        asBlob: true,
+        body: JSON.stringify({
+          telegram_id: selectedAwardId || null,
+          template_key: String(byId("award-template")?.value || "participation"),
+          event_name: String((byId("award-event")?.value || "").trim()),
+          event_date: isoToRu(String((byId("award-date")?.value || "").trim())),
+          font_key: String(byId("award-font")?.value || AWARD_FONTS[0].key),
+          width: Math.min(720, Math.round(240 * (window.devicePixelRatio || 1))),
+        }),
+      });
+      // Пока шёл запрос, пользователь мог изменить поля — старый ответ не показываем.
+      if (seq !== awardPreviewSeq) return;
+      let $img = byId("award-preview-img");
+      if (!$img) {
+        $wrap.innerHTML = "";
+        $img = document.createElement("img");
+        $img.id = "award-preview-img";
+        $img.alt = "Превью сертификата";
+        $img.style.width = "240px";
+        $img.style.maxWidth = "100%";
+        $img.style.borderRadius = "10px";
+        $wrap.appendChild($img);
+      }
+      if (awardPreviewUrl) URL.revokeObjectURL(awardPreviewUrl);
+      awardPreviewUrl = URL.createObjectURL(blob);
+      $img.src = awardPreviewUrl;
+    } catch (e) {
+      // Превью — вспомогательное: ошибку не показываем alert'ом, попробуем при следующем изменении.
+    }
+  }
+
+  byId("award-event")?.addEventListener("input", () => scheduleAwardPreview());
+  byId("award-date")?.addEventListener("change", () => scheduleAwardPreview());
+  byId("award-template")?.addEventListener("change", () => scheduleAwardPreview(0));
+  byId("award-preview-load")?.addEventListener("click", () => scheduleAwardPreview(0));
+
+  async function loadAwardTemplates() {
+    const $select = byId("award-template");
+    if (!$select || $select.dataset.loaded === "1") return;
+    try {
+      const data = await api("/api/admin/award_templates");
+      const templates = Array.isArray(data.templates) ? data.templates : [];
+      if (!templates.length) return;
+      const current = $select.value;
+      $select.innerHTML = "";
+      templates.forEach((t) => {
+        const opt = document.createElement("option");
+        opt.value = String(t.key);
+        opt.textContent = String(t.title || t.key);
+        $select.appendChild(opt);
+      });
+      if (templates.some((t) => String(t.key) === current)) $select.value = current;
+      $select.dataset.loaded = "1";
+    } catch (e) {
+      // Оставляем шаблон по умолчанию из разметки.
+    }
+  }
+
   byId("go-awards").addEventListener("click", async () => {
     try {
       if (!(await checkAccess())) return;
@@ -764,6 +844,7 @@ function renderAwardsListFromCache() {
       const $date = byId("award-date");
       if ($date && !$date.value) $date.value = todayISO();
       setupAwardFontPicker();
+      loadAwardTemplates().then(() => scheduleAwardPreview(0));
       await loadAwardsUsers();
     } catch (e) {
       alert(e.message);
@@ -907,6 +988,7 @@ function renderAwardsListFromCache() {
 
     selectedAwardId = null;
     renderAwardsListFromCache();
+    scheduleAwardPreview(0);
   });
   byId("btn-award-send").addEventListener("click", async () => {
     const tgId = Number(selectedAwardId);
@@ -956,6 +1038,163 @@ function renderAwardsListFromCache() {
     }
   });
 
+  // --- Массовая выдача сертификатов ---
+  let awardBulkJobId = null;
+  let awardBulkTimer = null;
+
+  function renderAwardBulkProgress(job) {
+    const $progress = byId("award-bulk-progress");
+    const running = job?.status === "running";
+    byId("btn-award-bulk-start").disabled = running;
+    byId("btn-award-bulk-cancel").disabled = !running;
+    byId("btn-award-bulk-resume").disabled = !job || running || (job.sent >= job.total);
+    if (!$progress) return;
+    if (!job) {
+      $progress.textContent = "Нет активной выдачи";
+      return;
+    }
+    const statusText = { running: "идёт", done: "завершена", cancelled: "остановлена", pending: "в очереди" }[job.status] || job.status;
+    let text = `Выдача ${statusText}: отправлено ${job.sent} из ${job.total}`;
+    if (job.failed) text += `, ошибок: ${job.failed}`;
+    if (job.errors?.length) text += ` (например: ${job.errors[0].telegram_id} — ${job.errors[0].error})`;
+    $progress.textContent = text;
+  }
+
+  async function pollAwardBulkJob() {
+    if (awardBulkTimer) {
+      clearTimeout(awardBulkTimer);
+      awardBulkTimer = null;
+    }
+    if (!awardBulkJobId) return;
+    try {
+      const data = await api(`/api/admin/award_job?job_id=${encodeURIComponent(awardBulkJobId)}`);
+      renderAwardBulkProgress(data.job);
+      if (data.job?.status !== "running") return;
+    } catch (e) {
+      // Сеть/WebView: просто попробуем ещё раз на следующем тике.
+    }
+    awardBulkTimer = setTimeout(pollAwardBulkJob, 2000);
+  }
+
+  async function restoreAwardBulkJob() {
+    // После перезагрузки админки показываем последнюю задачу (прогресс хранится на сервере).
+    try {
+      const data = await api("/api/admin/award_job");
+      const job = (data.jobs || [])[0];
+      if (!job) return;
+      awardBulkJobId = job.job_id;
+      renderAwardBulkProgress(job);
+      if (job.status === "running") pollAwardBulkJob();
+    } catch (e) {}
+  }
+
+  byId("award-bulk-mode")?.addEventListener("change", () => {
+    const mode = byId("award-bulk-mode").value;
+    byId("award-bulk-top").style.display = mode === "top" ? "" : "none";
+    byId("award-bulk-city").style.display = mode === "city" ? "" : "none";
+  });
+
+  // Фильтр и параметры массовой операции (выдача/выгрузка); null — если что-то не заполнено.
+  function awardBulkParams() {
+    const mode = String(byId("award-bulk-mode").value || "top");
+    const eventName = String((byId("award-event").value || "").trim());
+    const eventDate = isoToRu(String((byId("award-date").value || "").trim()));
+    const body = {
+      mode,
+      top: Number(byId("award-bulk-top").value || 0),
+      city: String((byId("award-bulk-city").value || "").trim()),
+      template_key: String(byId("award-template").value || "participation"),
+      event_name: eventName,
+      event_date: eventDate,
+      font_key: String(byId("award-font")?.value || AWARD_FONTS[0].key),
+    };
+    if (!eventName) {
+      alert("Укажи название мероприятия");
+      return null;
+    }
+    if (!eventDate) {
+      alert("Укажи дату");
+      return null;
+    }
+    if (mode === "top" && !(body.top > 0)) {
+      alert("Укажи N");
+      return null;
+    }
+    if (mode === "city" && !body.city) {
+      alert("Укажи город");
+      return null;
+    }
+    return body;
+  }
+
+  byId("btn-award-bulk-start")?.addEventListener("click", async () => {
+    const body = awardBulkParams();
+    if (!body) return;
+    if (!confirm("Сформировать и отправить сертификаты всем пользователям по фильтру?")) return;
+
+    try {
+      const data = await api("/api/admin/award_job", { method: "POST", body: JSON.stringify(body) });
+      awardBulkJobId = data.job.job_id;
+      renderAwardBulkProgress(data.job);
+      pollAwardBulkJob();
+    } catch (e) {
+      alert("Ошибка: " + e.message);
+    }
+  });
+
+  // Выгрузка для печати: файл отдаётся потоком, поэтому скачиваем по ссылке (авторизация — в query).
+  function downloadAwardExport(format) {
+    const body = awardBulkParams();
+    if (!body) return;
+    const params = new URLSearchParams({ ...body, format });
+    if (hasAdminToken) {
+      params.set("admin_token", ADMIN_TOKEN);
+    } else {
+      const initData = getInitData();
+      if (!initData) {
+        alert("Bad initData: открой админку через /admin → кнопку.");
+        return;
+      }
+      params.set("initData", initData);
+    }
+    const url = new URL(`/api/admin/award_export?${params.toString()}`, window.location.href).toString();
+    const fileName = `awards.${format}`;
+    try {
+      if (typeof tg?.downloadFile === "function") {
+        tg.downloadFile({ url, file_name: fileName });
+        return;
+      }
+    } catch (_) {}
+    window.open(url, "_blank");
+  }
+
+  byId("btn-award-export-zip")?.addEventListener("click", () => downloadAwardExport("zip"));
+  byId("btn-award-export-pdf")?.addEventListener("click", () => downloadAwardExport("pdf"));
+
+  byId("btn-award-bulk-cancel")?.addEventListener("click", async () => {
+    if (!awardBulkJobId) return;
+    try {
+      const data = await api("/api/admin/award_job/cancel", { method: "POST", body: JSON.stringify({ job_id: awardBulkJobId }) });
+      renderAwardBulkProgress(data.job);
+      pollAwardBulkJob();
+    } catch (e) {
+      alert("Ошибка: " + e.message);
+    }
+  });
+
+  byId("btn-award-bulk-resume")?.addEventListener("click", async () => {
+    if (!awardBulkJobId) return;
+    try {
+      const data = await api("/api/admin/award_job/resume", { method: "POST", body: JSON.stringify({ job_id: awardBulkJobId }) });
+      renderAwardBulkProgress(data.job);
+      pollAwardBulkJob();
+    } catch (e) {
+      alert("Ошибка: " + e.message);
+    }
+  });
+
+  byId("go-awards")?.addEventListener("click", () => { restoreAwardBulkJob(); });
+
   // --- USERS VIEW page actions ---
   byId("back-from-users-view")?.addEventListener("click", () => showScreen("home"));
   byId("btn-refresh-users-view")?.addEventListener("click", () => loadUsersView().catch((e) => alert(e.message)));
@@ -28,8 +28,16 @@ function supportsWebP() {
     }
 }
 const USE_WEBP = supportsWebP();
+// Спрайты рисуются на канвасе размером ~60–100px (с DPR до 2), поэтому исходники 1024px
+// не нужны: сервер отдаёт уменьшенный вариант по ?w= (см. static_assets.py).
+// Остальные картинки сервер подбирает сам по client hints.
+const ASSET_WIDTHS = {
+    'hero': 360, 'platform': 360, 'spring': 360, 'propeller': 360, 'jetpack': 360, 'part': 360,
+    'bolt': 360, 'nut': 360, 'gear': 360, 'chip': 360, 'board': 360, 'case': 360, 'sensor': 360, 'device': 360,
+};
 function assetPath(name, fallbackExt) {
-    return `assets/${name}.${USE_WEBP ? 'webp' : fallbackExt}`;
+    const url = `assets/${name}.${USE_WEBP ? 'webp' : fallbackExt}`;
+    return ASSET_WIDTHS[name] ? `${url}?w=${ASSET_WIDTHS[name]}` : url;
 }
 
 // ==========================================
@@ -997,6 +1005,26 @@ function apiUrl(path) {
     return API_BASE + path;
 }
 
+// Запросы к API на чужом домене без кастомных заголовков идут без CORS-preflight.
+// Поэтому If-None-Match шлём только на своём домене, а на чужом передаём ETag в ?etag=.
+function isSameOriginApi() {
+    if (!API_BASE) return true;
+    try {
+        return new URL(API_BASE, window.location.href).origin === window.location.origin;
+    } catch (e) {
+        return false;
+    }
+}
+
+// Последние ответы /api/levels и /api/me вместе с их ETag.
+// Сервер отвечает 304 без тела, если данные не изменились, — тогда используем сохранённый ответ.
+// Сами ответы не кешируются браузером (no-store), поэтому устаревших данных тут не бывает.
+let _levelsLastPath = '';
+let _levelsLastEtag = '';
+let _levelsLastData = null;
+let _meLastEtag = '';
+let _meLastData = null;
+
 
 // Синхронизация профтеста ("Что тебе больше подходит") с сервером.
 // Если админ удалил пользователя/сбросил статистику, локальный localStorage может
@@ -1008,14 +1036,24 @@ async function syncAptitudeWithServer() {
         // В этом случае apiUrl('/api/me') вернёт относительный путь и fetch() должен работать.
         if (!getTg()?.initData) return;
 
+        const headers = { 'X-Telegram-InitData': getTg().initData };
+        if (_meLastData && _meLastEtag) headers['If-None-Match'] = _meLastEtag;
+
         const res = await fetch(apiUrl('/api/me'), {
             method: 'GET',
             cache: 'no-store',
-            headers: { 'X-Telegram-InitData': getTg().initData }
+            headers
         });
-        if (!res.ok) return;
 
-        const data = await res.json();
+        let data;
+        if (res.status === 304 && _meLastData) {
+            data = _meLastData;
+        } else {
+            if (!res.ok) return;
+            data = await res.json();
+            _meLastData = data;
+            _meLastEtag = res.headers.get('ETag') || '';
+        }
 
         // 1) Глобальный сброс статистики админом:
         // если на сервере изменилась метка сброса — очищаем локальные данные (очки, рекомендации, результаты).
@@ -1120,12 +1158,70 @@ function syncResetAndRefreshUIThrottled() {
     });
 }
 
+// Push-канал событий админки (SSE /api/events): отключение уровня, сброс статистики,
+// сброс/удаление пользователя. Событие — только сигнал «перечитай состояние»;
+// периодический опрос остаётся запасным вариантом (реже, пока канал подключён).
+let _eventsSource = null;
+let _eventsConnected = false;
+function startAdminEventsStream() {
+    if (_eventsSource || typeof window.EventSource !== 'function') return;
+    try {
+        const uid = getTg()?.initDataUnsafe?.user?.id;
+        const path = uid ? `/api/events?uid=${encodeURIComponent(String(uid))}` : '/api/events';
+        const es = new EventSource(apiUrl(path));
+        _eventsSource = es;
+        es.onopen = () => { _eventsConnected = true; };
+        es.onerror = () => {
+            // EventSource переподключается сам; после 503 (лимит подписчиков) — закрывает канал.
+            _eventsConnected = false;
+            if (es.readyState === 2) _eventsSource = null;
+        };
+        const refreshLevels = () => {
+            loadLevelAvailability().then(() => {
+                try { applyLevelAvailabilityToMenu(); } catch (e) {}
+            }).catch(() => {});
+        };
+        es.addEventListener('level', refreshLevels);
+        es.addEventListener('stats_reset', () => {
+            refreshLevels();
+            syncResetAndRefreshUIThrottled();
+        });
+        es.addEventListener('user_reset', syncResetAndRefreshUIThrottled);
+        es.addEventListener('user_deleted', syncResetAndRefreshUIThrottled);
+        es.addEventListener('resync', () => {
+            refreshLevels();
+            syncResetAndRefreshUIThrottled();
+        });
+    } catch (e) {
+        _eventsSource = null;
+        _eventsConnected = false;
+    }
+}
+
 async function loadLevelAvailability() {
     try {
         const uid = getTg()?.initDataUnsafe?.user?.id;
         const levelsPath = uid ? `/api/levels?uid=${encodeURIComponent(String(uid))}` : '/api/levels';
-        const res = await fetch(apiUrl(levelsPath), { cache: 'no-store' });
-        const data = await res.json();
+        let url = apiUrl(levelsPath);
+        const headers = {};
+        const canRevalidate = _levelsLastData && _levelsLastEtag && _levelsLastPath === levelsPath;
+        if (canRevalidate) {
+            if (isSameOriginApi()) headers['If-None-Match'] = _levelsLastEtag;
+            else url += (url.includes('?') ? '&' : '?') + 'etag=' + encodeURIComponent(_levelsLastEtag);
+        }
+        const res = await fetch(url, { cache: 'no-store', headers });
+
+        let data;
+        if (res.status === 304 && canRevalidate) {
+            data = _levelsLastData;
+        } else {
+            data = await res.json();
+            if (res.ok) {
+                _levelsLastData = data;
+                _levelsLastEtag = res.headers.get('ETag') || '';
+                _levelsLastPath = levelsPath;
+            }
+        }
         // Сброс статистики в админке должен подхватываться в WebApp так же,
         // как и отключение уровней (и без зависимости от initData / CORS-preflight).
         // Поэтому используем reset_token, который сервер возвращает в /api/levels.
@@ -2234,10 +2330,18 @@ const PLATFORM_HEIGHT = 50;
 // Если рисовать весь исходник в (width,height), видимая картинка смещается
 // относительно хитбокса (player/platform), и создаётся эффект «прыжка по воздуху».
 // Поэтому рисуем только внутреннюю область с объектом.
-// (координаты подобраны под текущие assets/*.webp)
+// (координаты подобраны под текущие assets/*.webp шириной SPRITE_SOURCE_WIDTH;
+// для уменьшенных вариантов масштабируются в scaledCrop)
+const SPRITE_SOURCE_WIDTH = 1024;
 const HERO_SPRITE_CROP = { sx: 31, sy: 39, sw: 969, sh: 892 };
 const PLATFORM_SPRITE_CROP = { sx: 63, sy: 366, sw: 896, sh: 259 };
 
+function scaledCrop(img, crop) {
+    const k = img.naturalWidth / SPRITE_SOURCE_WIDTH;
+    if (!k || k === 1) return crop;
+    return { sx: crop.sx * k, sy: crop.sy * k, sw: crop.sw * k, sh: crop.sh * k };
+}
+
 const SPRING_WIDTH = 60; const SPRING_HEIGHT = 50;
 const PROPELLER_WIDTH = 60; const PROPELLER_HEIGHT = 50;
 const JETPACK_WIDTH = 60; const JETPACK_HEIGHT = 60;
@@ -2707,7 +2811,7 @@ function draw() {
     for (let i = 0; i < platforms.length; i++) {
         const p = platforms[i];
         if (imgPlatform.complete && imgPlatform.naturalWidth !== 0) {
-            const c = PLATFORM_SPRITE_CROP;
+            const c = scaledCrop(imgPlatform, PLATFORM_SPRITE_CROP);
             ctx.drawImage(imgPlatform, c.sx, c.sy, c.sw, c.sh, p.x, p.y, p.width, p.height);
         } else {
             ctx.fillStyle = '#27ae60';
@@ -2749,7 +2853,7 @@ function draw() {
         }
 
         // ГЕРОЙ (Рисуется ПОВЕРХ джетпака)
-        const hc = HERO_SPRITE_CROP;
+        const hc = scaledCrop(imgHero, HERO_SPRITE_CROP);
         ctx.drawImage(imgHero, hc.sx, hc.sy, hc.sw, hc.sh, player.x, player.y, player.width, player.height);
 
         if (player.equipment === 'propeller') {
@@ -3386,12 +3490,18 @@ window.addEventListener('DOMContentLoaded', () => {
     // Поэтому делаем лёгкий периодический синх (троттлинг внутри syncResetAndRefreshUIThrottled).
     try {
         if (!window.__apzResetSyncTimer) {
+            let ticks = 0;
             window.__apzResetSyncTimer = setInterval(() => {
+                ticks += 1;
+                // Пока подключён SSE-канал, опрашиваем сервер раз в минуту, а не каждые 15 секунд.
+                if (_eventsConnected && ticks % 4 !== 0) return;
                 syncResetAndRefreshUIThrottled();
             }, 15000);
         }
     } catch (e) {}
 
+    setTimeout(() => { startAdminEventsStream(); }, 1200);
+
     // Разблокируем звук на первом пользовательском жесте
     // (иначе в Telegram WebView/iOS Safari многие звуки не запускаются)
     document.addEventListener('pointerdown', unlockSfxOnce, { once: true, capture: true });